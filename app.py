@@ -1,21 +1,78 @@
-from flask import Flask, render_template, request, redirect, flash
+from flask import Flask, render_template, request, redirect, flash, jsonify, Response, stream_with_context, abort, send_file
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime
 import os
 import glob
+import json
 import logging
+import shutil
+import zipfile
 from werkzeug.utils import secure_filename
 
-from components.config import db, app, logger, allowed_file, datetimeformat, PICTURES_FOLDER, ALLOWED_EXTENSIONS, DATE_FORMAT
+from components.config import db, app, logger, allowed_file, datetimeformat, PICTURES_FOLDER, ALLOWED_EXTENSIONS, DATE_FORMAT, JOB_RUNNER_EMBEDDED, STORAGE_REAPER_EMBEDDED
+from components.config import BATCH_WORKERS, BATCH_MAX_FILES, BATCH_MAX_CONTENT_LENGTH, CACHE_ENABLED, LISTING_PAGE_SIZE, LISTING_MAX_PAGE_SIZE, UPLOAD_SHARD_DEPTH
+from components.config import THUMB_SIZES, THUMB_FORMAT, THUMB_MAX_AGE, SEARCH_MIN_PREFIX, VIDEO_EXTENSIONS, VIDEO_MAX_CONTENT_LENGTH, CAMERAS
 import components.lpr_eng
+from components import admission
+from components import jobs
+from components import cache
+from components import metrics
+from components import utils
+from components import storage
+from components import thumbs
+from components import video
+
+from components.lpr_eng import PictureWrapper, Crop, VideoJob, upgrade_db, recognize_batch, save_batch, list_pictures, search_pictures, STATUS_DONE
+
+with app.app_context():
+    upgrade_db()
+
+
+def wants_json():
+    return request.accept_mimetypes.best == 'application/json'
+
+
+def request_camera():
+    """
+    Camera id of an upload ('camera' form field or query argument), None when not given.
+    Raises ValueError for a camera missing in config.CAMERAS.
+    """
+    camera = request.form.get('camera') or request.args.get('camera') or None
+    if camera is not None and camera not in CAMERAS:
+        raise ValueError("Unknown camera '{}'".format(camera))
+    return camera
+
+
+def overloaded(e: admission.Overloaded):
+    """
+    503 response of a request that was not admitted, see components.admission.
+    """
+    if wants_json() or request.path != '/':
+        response = jsonify(error=str(e), reason=e.reason, retry_after=e.retry_after)
+    else:
+        response = Response(str(e), mimetype='text/plain')
+    response.status_code = 503
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
+
+@app.before_request
+def start_job_runner():
+    if JOB_RUNNER_EMBEDDED:
+        jobs.ensure_runner()
+
+
+@app.before_request
+def start_storage_reaper():
+    if STORAGE_REAPER_EMBEDDED:
+        storage.ensure_reaper()
 
-from components.lpr_eng import PictureWrapper, invoke_lpr_eng
 
 @app.route('/', methods=['GET', 'POST'])
 def index():
     if request.method == 'POST':
         try:
-            logger.debug("POST request.url:'{}', request.files['file']: '{}'".format(request.url, request.files['file']))
+            logger.debug("POST request.url:'%s', request.files['file']: '%s'", request.url, request.files['file'])
             # New picture upload
             if 'file' not in request.files:
                 flash('No file part')
@@ -26,23 +83,50 @@ def index():
                 flash('No image selected for uploading')
                 logger.error("No image selected for uploading")
                 return redirect(request.url)
+            try:
+                camera = request_camera()
+            except ValueError as e:
+                logger.error("%s", e)
+                if wants_json():
+                    return jsonify(error=str(e)), 400
+                flash(str(e))
+                return redirect(request.url)
             if file and allowed_file(file.filename):
                 filename = secure_filename(file.filename)
-                picture_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                file.save(picture_path)
-                #print('upload_image filename: ' + filename)
-                name = os.path.splitext(filename)[0]
-#                new_picture = PictureWrapper(name = name, picture_path = picture_path)
-                # invoke lpr_engine and save small_pictures list and OCR text
-                logger.debug("Calling invoke_lpr_eng for picture_path:'{}'".format(picture_path))
-                invoke_lpr_eng(name = name, picture_path = picture_path)
-#                new_picture.invoke_lpr_eng()
-                flash('Image successfully uploaded and displayed')
-                logger.debug("Image successfully uploaded and displayed".format(name, picture_path))
+                # The one copy of the upload, shared by the file writer and the job payload which outlive the request
+                data = bytes(utils.upload_buffer(file))
+                admitted = (1, utils.image_pixels(data))
+                try:
+                    jobs.check_backlog()
+                    admission.controller.acquire(*admitted)
+                except admission.Overloaded as e:
+                    return overloaded(e)
+                try:
+                    content_hash = cache.content_hash(data)
+                    picture_path = utils.sharded_path(app.config['UPLOAD_FOLDER'], content_hash, filename, UPLOAD_SHARD_DEPTH)
+                    # Crops are written next to the picture while the original is still being stored
+                    os.makedirs(os.path.dirname(picture_path), exist_ok=True)
+                    # The same frame is often sent again, don't rewrite an identical file
+                    if not os.path.exists(picture_path):
+                        utils.write_file_async(picture_path, data)
+                    #print('upload_image filename: ' + filename)
+                    name = os.path.splitext(filename)[0]
+#                    new_picture = PictureWrapper(name = name, picture_path = picture_path)
+                    # queue lpr_engine job, the job runner saves small_pictures list and OCR text
+                    logger.debug("Queueing recognition job for picture_path:'%s'", picture_path)
+                    job = jobs.enqueue(name = name, picture_path = picture_path, content_hash = content_hash, data = data, camera = camera)
+#                    new_picture.invoke_lpr_eng()
+                finally:
+                    # Admitted until the job is queued, whichever runner claims it, see jobs.check_backlog for the queue
+                    admission.controller.release(*admitted)
+                logger.debug("Image successfully uploaded, job id:'%s'", job.id)
+                if wants_json():
+                    return jsonify(job.to_dict()), 202
+                flash('Image successfully uploaded, recognition job {} queued'.format(job.id))
                 return redirect(request.url)
             else:
                 flash('Allowed image types are -> png, jpg, jpeg, gif')
-                logger.error("Allowed image types are -> png, jpg, jpeg, gif: '{}'".format(file.filename))
+                logger.error("Allowed image types are -> png, jpg, jpeg, gif: '%s'", file.filename)
                 return redirect(request.url)
             return redirect(request.url)
         except:
@@ -51,40 +135,262 @@ def index():
             return redirect(request.url)
 #            return "There was a problem adding new stuff."
     else:
-        # GET - render existing pictures
-        logger.debug("GET request.url:'{}'".format(request.url))
-        car_pictures = PictureWrapper.query.order_by(PictureWrapper.created_at.desc()).all()
-        # TODO: When small_pictures_list will be kept in DB, the below code should be cleaned
-        # extract small_pictures from db and convert it to list as following:
-        # a=car_picture.small_pictures.strip('[]') 
-        # pictures_list=a.split()
-        for car_picture in car_pictures:
-#            car_picture.large_picture = os.path.join(app.config['UPLOAD_FOLDER'], car_picture.name + ".jpg")
-#            for small_picture in glob.glob('static/pictures_photo/' + name + '*'):
-            logger.debug("car_picture.name: {} car_picture.picture_path from DB: {}".format(car_picture.name, car_picture.picture_path))
-            pictures_list = glob.glob(os.path.join(app.config['UPLOAD_FOLDER'], car_picture.name + "*"))
-            for picture_path in pictures_list:
-                small_picture_name = os.path.basename(picture_path)
-                small_picture_name = os.path.splitext(small_picture_name)[0]
-                if small_picture_name == car_picture.name:
-                    car_picture.picture_path = picture_path
-                    pictures_list.remove(picture_path)
-            car_picture.small_pictures = pictures_list
-            logger.debug("car_picture.picture_path: {}".format(car_picture.picture_path))
-            logger.debug("car_picture.small_pictures: {}".format(car_picture.small_pictures))
-        return render_template('index.html', car_pictures=car_pictures)
+        # GET - render a page of existing pictures, crops are read from the crop table
+        logger.debug("GET request.url:'%s'", request.url)
+        try:
+            car_pictures, next_after = list_pictures(page_size(), request.args.get('after'))
+        except ValueError:
+            logger.error("Bad listing cursor: '%s'", request.args.get('after'))
+            return redirect('/')
+        return render_template('index.html', car_pictures=car_pictures, next_after=next_after, limit=request.args.get('limit'))
+
+
+@app.route('/pictures')
+def pictures():
+    """
+    JSON listing, same ?limit=&after= pagination as the main page.
+    """
+    try:
+        car_pictures, next_after = list_pictures(page_size(), request.args.get('after'))
+    except ValueError:
+        return jsonify(error='Bad cursor'), 400
+    return jsonify(pictures=[car_picture.to_dict() for car_picture in car_pictures], next=next_after)
+
+
+@app.route('/search')
+def search():
+    """
+    JSON search by plate: ?plate=&prefix=1&fuzzy=1, paginated with ?limit=&after=<next of the previous page>.
+    """
+    plate = request.args.get('plate', '')
+    prefix = request.args.get('prefix') == '1'
+    fuzzy = request.args.get('fuzzy') == '1'
+    if prefix and len(plate) < SEARCH_MIN_PREFIX:
+        return jsonify(error='Prefix shorter than {} characters'.format(SEARCH_MIN_PREFIX)), 400
+    try:
+        after = int(request.args['after']) if request.args.get('after') else None
+    except ValueError:
+        return jsonify(error='Bad cursor'), 400
+    try:
+        car_pictures, next_after = search_pictures(plate, prefix, fuzzy, page_size(), after)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    logger.debug("Search plate:'%s' prefix:%s fuzzy:%s found:%s", plate, prefix, fuzzy, len(car_pictures))
+    return jsonify(pictures=[car_picture.to_dict() for car_picture in car_pictures], next=next_after)
+
+
+def page_size():
+    try:
+        limit = int(request.args.get('limit', LISTING_PAGE_SIZE))
+    except ValueError:
+        limit = LISTING_PAGE_SIZE
+    return max(1, min(limit, LISTING_MAX_PAGE_SIZE))
+
+
+def store_batch_file(data: bytes, filename: str, camera: str = None) -> tuple:
+    """
+    Stores an image of a batch under its content hash like a single upload, so images of the same name
+    do not overwrite each other or the files of earlier rows. Returns tuple (picture_path, content_hash).
+    """
+    content_hash = cache.content_hash(data)
+    picture_path = utils.sharded_path(app.config['UPLOAD_FOLDER'], content_hash, filename, UPLOAD_SHARD_DEPTH)
+    if not os.path.exists(picture_path):
+        utils.write_file(picture_path, data)
+    return (picture_path, content_hash)
+
+
+def extract_zip(file, camera: str = None):
+    """
+    Stores allowed image files of an uploaded zip archive, see store_batch_file.
+    Returns list of tuples (picture_path, content_hash).
+    """
+    stored = []
+    with zipfile.ZipFile(file.stream) as archive:
+        for member in archive.infolist():
+            filename = secure_filename(os.path.basename(member.filename))
+            if member.is_dir() or not allowed_file(filename):
+                continue
+            if len(stored) >= BATCH_MAX_FILES:
+                break
+            stored.append(store_batch_file(archive.read(member), filename, camera))
+    return stored
+
+
+@app.route('/batch', methods=['POST'])
+def batch():
+    """
+    Batch recognition of a multi-file upload ('files' field) and/or zip archives, optionally all taken
+    by one camera ('camera' field). Streams one JSON line per image as it is recognized, the last line reports the saved row ids.
+    """
+    request.max_content_length = BATCH_MAX_CONTENT_LENGTH
+    logger.debug("POST batch request.url:'%s'", request.url)
+    try:
+        camera = request_camera()
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    stored = []
+    try:
+        for file in request.files.getlist('files') + request.files.getlist('file'):
+            if file.filename.lower().endswith('.zip'):
+                stored.extend(extract_zip(file, camera))
+            elif allowed_file(file.filename):
+                stored.append(store_batch_file(file.read(), secure_filename(file.filename), camera))
+            if len(stored) > BATCH_MAX_FILES:
+                logger.error("batch: more than %s images", BATCH_MAX_FILES)
+                return jsonify(error='Too many images, the limit is {}'.format(BATCH_MAX_FILES)), 413
+    except zipfile.BadZipFile as e:
+        logger.error("batch: bad zip file: '%s'", e)
+        return jsonify(error='Bad zip file'), 400
+    picture_paths = [picture_path for picture_path, content_hash in stored]
+    content_hashes = dict(stored)
+    if len(picture_paths) == 0:
+        logger.error("batch: no images")
+        return jsonify(error='No images, allowed image types are -> png, jpg, jpeg, gif, zip'), 400
+    # The recognition processes of the batch with the largest images
+    workers = min(BATCH_WORKERS, len(picture_paths))
+    admitted = (workers, sum(sorted((utils.image_pixels(picture_path) for picture_path in picture_paths), reverse=True)[:workers]))
+    try:
+        admission.controller.acquire(*admitted)
+    except admission.Overloaded as e:
+        return overloaded(e)
+
+    def generate():
+        results = []
+        misses = []
+        for picture_path in picture_paths:
+            cached = cache.lookup(cache.cache_key(content_hashes[picture_path], camera = camera), picture_path) if CACHE_ENABLED else None
+            if cached is None:
+                misses.append(picture_path)
+                continue
+            result = {
+                'picture_path': picture_path,
+                'name': os.path.splitext(os.path.basename(picture_path))[0],
+                'status': STATUS_DONE,
+                'recognized_txt': cached[0],
+                'small_pictures': cached[1],
+                'timings': {},
+                'camera': camera,
+                'error': None,
+                'cached': True
+            }
+            results.append(result)
+            yield json.dumps(result) + '\n'
+        for result in recognize_batch(misses, workers, camera = camera):
+            if CACHE_ENABLED and result['error'] is None:
+                cache.store(cache.cache_key(content_hashes[result['picture_path']], camera = camera), result['recognized_txt'], result['small_pictures'])
+            results.append(result)
+            # Milliseconds like /video, the row keeps the seconds until save_batch
+            yield json.dumps(dict(result, timings = metrics.timings_ms(result['timings']))) + '\n'
+        for result in results:
+            result['content_hash'] = content_hashes[result['picture_path']]
+        new_pictures = save_batch(results)
+        yield json.dumps({'saved': len(new_pictures), 'ids': [new_picture.id for new_picture in new_pictures]}) + '\n'
+
+    response = Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+    response.call_on_close(lambda: admission.controller.release(*admitted))
+    return response
+
+
+@app.route('/video', methods=['POST'])
+def video_upload():
+    """
+    Queues the ingestion of an uploaded video ('file' field) of an optional camera ('camera' field), see components.video.
+    Returns 202 with the video job, /videos/<id> reports its frame counts and plate events once the job runner ingested it.
+    """
+    request.max_content_length = VIDEO_MAX_CONTENT_LENGTH
+    try:
+        camera = request_camera()
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    file = request.files.get('file')
+    if file is None or file.filename.rsplit('.', 1)[-1].lower() not in VIDEO_EXTENSIONS:
+        logger.error("video: no video file")
+        return jsonify(error='Allowed video types are -> {}'.format(', '.join(sorted(VIDEO_EXTENSIONS)))), 400
+    filename = secure_filename(file.filename)
+    # The video is kept in its event folder until it is ingested, then only the event frames and crops stay
+    folder = video.event_folder()
+    os.makedirs(folder, exist_ok=True)
+    video_path = os.path.join(folder, filename)
+    file.save(video_path)
+    logger.debug("video: saved '%s' as '%s'", filename, video_path)
+    admitted = (1, video.frame_pixels(video_path))
+    try:
+        admission.controller.acquire(*admitted)
+    except admission.Overloaded as e:
+        shutil.rmtree(folder, ignore_errors=True)
+        return overloaded(e)
+    try:
+        job = jobs.enqueue_video(os.path.splitext(filename)[0] or 'video', folder, video_path, camera)
+    except Exception:
+        shutil.rmtree(folder, ignore_errors=True)
+        raise
+    finally:
+        # The job runner bounds the ingestions, see VIDEO_JOB_WORKERS
+        admission.controller.release(*admitted)
+    return jsonify(job.to_dict()), 202
+
+
+@app.route('/videos/<int:id>')
+def video_status(id):
+    job = VideoJob.query.get_or_404(id)
+    return jsonify(dict(job.to_dict(), events=[car_picture.to_dict() for car_picture in job.events]))
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/cache/stats')
+def cache_stats():
+    return jsonify(cache.stats())
+
+
+@app.route('/admission/stats')
+def admission_stats():
+    return jsonify(admission.controller.stats())
+
+
+@app.route('/storage/stats')
+def storage_stats():
+    return jsonify(storage.stats())
+
+
+@app.route('/jobs/<int:id>')
+def job_status(id):
+    car_picture = PictureWrapper.query.get_or_404(id)
+    logger.debug("Job status id:'%s' status:'%s'", id, car_picture.status)
+    return jsonify(car_picture.to_dict())
+
+
+@app.route('/thumb/<int:id>/<size>')
+@app.route('/thumb/<int:id>/<size>/<int:position>')
+def thumb(id, size, position=None):
+    """
+    Thumbnail of the picture, or of its crop at position, size is a key of THUMB_SIZES.
+    """
+    if size not in THUMB_SIZES:
+        abort(404)
+    if position is None:
+        source_path = db.session.query(PictureWrapper.picture_path).filter(PictureWrapper.id == id).scalar()
+    else:
+        source_path = db.session.query(Crop.path).filter(Crop.picture_id == id, Crop.position == position).scalar()
+    path = thumbs.ensure_thumb(source_path, size) if source_path is not None else None
+    if path is None:
+        abort(404)
+    return send_file(os.path.abspath(path), mimetype=thumbs.MIMETYPES[THUMB_FORMAT], conditional=True, etag=True, max_age=THUMB_MAX_AGE)
 
 
 @app.route('/delete/<int:id>')
 def delete(id):
-    car_picture = PictureWrapper.query.get_or_404(id)
+    PictureWrapper.query.get_or_404(id)
     try:
-        logger.debug("Delete id:'{}'".format(id))
-        db.session.delete(car_picture)
-        db.session.commit()
+        logger.debug("Delete id:'%s'", id)
+        # The row, its crops and the files no other row references
+        storage.delete_pictures([id])
         return redirect('/')
     except:
-        logger.error("Update There was a problem deleting data id:'{}'".format(id))
+        logger.error("Update There was a problem deleting data id:'%s'", id)
         return "There was a problem deleting data."
 
 
@@ -93,18 +399,18 @@ def update(id):
     car_picture = PictureWrapper.query.get_or_404(id)
 
     if request.method == 'POST':
-        logger.debug("POST Update id:'{}'".format(id))
+        logger.debug("POST Update id:'%s'", id)
         car_picture.name = request.form['name']
 
         try:
             db.session.commit()
             return redirect('/')
         except:
-            logger.error("Update There was a problem updating data id:'{}'".format(id))
+            logger.error("Update There was a problem updating data id:'%s'", id)
             return "There was a problem updating data."
 
     else:
-        logger.debug("GET Update id:'{}'".format(id))
+        logger.debug("GET Update id:'%s'", id)
         title = "Update Data"
         return render_template('update.html', title=title, car_picture=car_picture)
 
@@ -0,0 +1,72 @@
+"""
+Compares OCR engines on plate crops: per call latency of the in-process tesserocr handle
+against pytesseract, which starts a `tesseract` process for every call.
+
+    python -m benchmarks.ocr_engines [--images 'static/pictures_photo/*_0.jpg'] [--repeat 5] [--config '--psm 13']
+"""
+import argparse
+import glob
+import time
+import numpy as np
+from PIL import Image
+
+from components import ocr_engine
+from components import utils
+
+
+def benchmark_engine(engine_name: str, images: list, config_str: str, repeat: int) -> dict:
+    """
+    Runs the engine `repeat` times over all images. Engine creation is measured separately,
+    it is paid once per worker thread.
+    Returns dict with the timings in milliseconds and the recognized texts.
+    """
+    start = time.perf_counter()
+    engine = ocr_engine.create_engine(config_str, engine_name)
+    init_ms = (time.perf_counter() - start) * 1000
+    timings = []
+    texts = []
+    for i in range(repeat):
+        for image in images:
+            start = time.perf_counter()
+            text = engine.image_to_string(image)
+            timings.append((time.perf_counter() - start) * 1000)
+            if i == 0:
+                texts.append(utils.remove_special_chars(text))
+    return {
+        'engine': engine_name,
+        'init_ms': init_ms,
+        'calls': len(timings),
+        'mean_ms': float(np.mean(timings)),
+        'p50_ms': float(np.percentile(timings, 50)),
+        'p95_ms': float(np.percentile(timings, 95)),
+        'texts': texts
+    }
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Compare OCR engines latency")
+    ap.add_argument("--images", default="static/pictures_photo/*_0.jpg",
+                    help="Glob of plate crops to recognize")
+    ap.add_argument("--repeat", type=int, default=5,
+                    help="Number of passes over the images")
+    ap.add_argument("--config", default=r"--psm 13",
+                    help="Tesseract config string")
+    args = ap.parse_args()
+
+    image_paths = sorted(glob.glob(args.images))
+    images = [Image.open(image_path).convert('RGB') for image_path in image_paths]
+    print("{} images, {} passes, config '{}'".format(len(images), args.repeat, args.config))
+    results = []
+    for engine_name in sorted(ocr_engine.ENGINES):
+        try:
+            result = benchmark_engine(engine_name, images, args.config, args.repeat)
+        except Exception as e:
+            print("{:12} skipped: {}".format(engine_name, e))
+            continue
+        results.append(result)
+        print("{engine:12} init {init_ms:8.1f} ms  calls {calls:5}  mean {mean_ms:8.2f} ms  p50 {p50_ms:8.2f} ms  p95 {p95_ms:8.2f} ms".format(**result))
+    if len(results) == 2:
+        speedup = results[0]['mean_ms'] / results[1]['mean_ms']
+        print("{} / {} mean latency: {:.1f}x".format(results[0]['engine'], results[1]['engine'], speedup))
+        mismatches = sum(1 for a, b in zip(results[0]['texts'], results[1]['texts']) if a != b)
+        print("different texts: {} of {}".format(mismatches, len(images)))
@@ -0,0 +1,224 @@
+"""
+Recognition benchmark over a labeled corpus: runs license_plate_recognition for every combination of
+blurring and binarization method and reports per stage p50/p95 latency, images/sec, peak RSS and
+exact match accuracy. Results are saved as a JSON baseline, a later run compared to it reports regressions.
+
+    python -m benchmarks.recognition [--corpus benchmarks/corpus.json] [--blur median_blur] [--binarization canny]
+        [--detector contour] [--cascade] [--repeat 1] [--save benchmarks/baselines/default.json] [--compare benchmarks/baselines/default.json]
+
+The corpus is a JSON object of image path -> expected plate text (as returned by utils.remove_special_chars).
+Every combination runs in a fresh process, so its peak RSS is not inflated by the previous ones.
+--cascade adds a row for the strategy cascade of the application (config.STRATEGIES, lpr_utils.recognize_cascade).
+"""
+import argparse
+import json
+import multiprocessing
+import platform
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import cv2
+import numpy as np
+
+from components import lpr_utils
+from components.metrics import COUNTS
+from components.config import WORK_MAX_SIDE
+from components.lpr_eng import PIPELINE
+
+BLURRING_METHODS = ('gaussian_blur', 'median_blur', 'bilateral_filter')
+BINARIZATION_METHODS = ('threshold_otsu', 'adaptive_threshold', 'canny', 'auto_canny')
+
+# Whole license_plate_recognition call, measured by the benchmark
+TOTAL = 'total'
+# Method names of the strategy cascade row
+CASCADE = 'cascade'
+
+
+def load_corpus(path: str) -> list:
+    with open(path) as f:
+        return sorted(json.load(f).items())
+
+
+def run_combination(corpus: list, blurring_method: str, binarization_method: str, pipeline: dict, repeat: int, warmup: int) -> dict:
+    """
+    Recognizes every corpus image `repeat` times with the given methods, in the calling process.
+    The methods CASCADE run the strategy cascade of the pipeline instead.
+    The first `warmup` images are recognized once before, untimed, to load the OCR engine.
+    Returns dict with the per stage durations (ms) of every run, the recognized texts of the first pass and peak RSS.
+    """
+    def recognition(img_path, **kwargs):
+        if blurring_method == CASCADE:
+            return lpr_utils.recognize_cascade(img_path, pipeline['strategies'], pipeline['config_str'], ocr_mode = pipeline['ocr_mode'], detector = pipeline['detector'], **kwargs)[:2]
+        return lpr_utils.license_plate_recognition(
+            img_path,
+            None,
+            getattr(lpr_utils, blurring_method),
+            getattr(lpr_utils, binarization_method),
+            pipeline['config_str'],
+            ocr_mode = pipeline['ocr_mode'],
+            work_max_side = pipeline['work_max_side'],
+            detector = pipeline['detector'],
+            **kwargs
+        )
+
+    for img_path, expected in corpus[:warmup]:
+        recognition(img_path, save_crops = False)
+    stages = {}
+    texts = []
+    errors = 0
+    start = time.perf_counter()
+    for i in range(repeat):
+        for img_path, expected in corpus:
+            timings = {}
+            image_start = time.perf_counter()
+            try:
+                recognized_txt, small_pictures = recognition(img_path, save_crops = False, timings = timings)
+            except cv2.error:
+                recognized_txt = None
+                errors += 1
+            timings[TOTAL] = time.perf_counter() - image_start
+            for stage, value in timings.items():
+                if stage in COUNTS:
+                    stages.setdefault(stage, []).append(value)
+                else:
+                    stages.setdefault(stage, []).append(value * 1000)
+            if i == 0:
+                texts.append(recognized_txt)
+    elapsed = time.perf_counter() - start
+    return {
+        'stages': stages,
+        'texts': texts,
+        'errors': errors,
+        'elapsed': elapsed,
+        # kilobytes on Linux
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    }
+
+
+def summarize(corpus: list, blurring_method: str, binarization_method: str, run: dict, repeat: int) -> dict:
+    expected = [plate for img_path, plate in corpus]
+    matches = sum(1 for text, plate in zip(run['texts'], expected) if text == plate)
+    stages = {}
+    for stage, values in sorted(run['stages'].items()):
+        if stage in COUNTS:
+            stages[stage] = {'mean': round(float(np.mean(values)), 2)}
+        else:
+            stages[stage] = {
+                'p50_ms': round(float(np.percentile(values, 50)), 2),
+                'p95_ms': round(float(np.percentile(values, 95)), 2)
+            }
+    return {
+        'blurring_method': blurring_method,
+        'binarization_method': binarization_method,
+        'images': len(corpus) * repeat,
+        'accuracy': round(matches / len(corpus), 4) if corpus else 0.0,
+        'matches': matches,
+        'errors': run['errors'],
+        'images_per_sec': round(len(corpus) * repeat / run['elapsed'], 3) if run['elapsed'] > 0 else 0.0,
+        'peak_rss_mb': round(run['peak_rss_mb'], 1),
+        'stages': stages,
+        'texts': dict((img_path, text) for (img_path, plate), text in zip(corpus, run['texts']))
+    }
+
+
+def benchmark(corpus: list, blurring_methods: list, binarization_methods: list, pipeline: dict, repeat: int = 1, warmup: int = 1, cascade: bool = False) -> list:
+    results = []
+    combinations = [(blur, binarization) for blur in blurring_methods for binarization in binarization_methods]
+    if cascade:
+        combinations.append((CASCADE, CASCADE))
+    for blurring_method, binarization_method in combinations:
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+            run = pool.submit(run_combination, corpus, blurring_method, binarization_method, pipeline, repeat, warmup).result()
+        result = summarize(corpus, blurring_method, binarization_method, run, repeat)
+        results.append(result)
+        print("{blurring_method:17} {binarization_method:19} accuracy {accuracy:6.1%}  {images_per_sec:7.2f} img/s  "
+              "peak RSS {peak_rss_mb:7.1f} MB".format(**result) +
+              "  total p50 {p50_ms:8.1f} ms p95 {p95_ms:8.1f} ms".format(**result['stages'][TOTAL]))
+        sys.stdout.flush()
+    return results
+
+
+def pipeline_info(pipeline: dict) -> dict:
+    return dict((key, [lpr_utils.strategy_name(s) for s in value] if key == 'strategies' else value) for key, value in pipeline.items())
+
+
+def compare(results: list, baseline: dict, tolerance: float) -> list:
+    """
+    Compares results with a saved baseline. A combination regresses when its accuracy drops, or its
+    total p95 latency or images/sec gets worse by more than `tolerance` (a fraction).
+    Returns list of regression descriptions.
+    """
+    previous = dict(((r['blurring_method'], r['binarization_method']), r) for r in baseline['results'])
+    regressions = []
+    for result in results:
+        key = (result['blurring_method'], result['binarization_method'])
+        if key not in previous:
+            continue
+        before = previous[key]
+        name = "{} + {}".format(*key)
+        if result['accuracy'] < before['accuracy']:
+            regressions.append("{}: accuracy {:.1%} -> {:.1%}".format(name, before['accuracy'], result['accuracy']))
+        p95, p95_before = result['stages'][TOTAL]['p95_ms'], before['stages'][TOTAL]['p95_ms']
+        if p95 > p95_before * (1 + tolerance):
+            regressions.append("{}: total p95 {:.1f} ms -> {:.1f} ms".format(name, p95_before, p95))
+        if result['images_per_sec'] < before['images_per_sec'] * (1 - tolerance):
+            regressions.append("{}: {:.2f} img/s -> {:.2f} img/s".format(name, before['images_per_sec'], result['images_per_sec']))
+    return regressions
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Benchmark license plate recognition over a labeled corpus")
+    ap.add_argument("--corpus", default="benchmarks/corpus.json",
+                    help="JSON object of image path -> expected plate")
+    ap.add_argument("--blur", nargs='+', default=BLURRING_METHODS, choices=BLURRING_METHODS,
+                    help="Blurring methods to run")
+    ap.add_argument("--binarization", nargs='+', default=BINARIZATION_METHODS, choices=BINARIZATION_METHODS,
+                    help="Binarization methods to run")
+    ap.add_argument("--repeat", type=int, default=1,
+                    help="Number of passes over the corpus")
+    ap.add_argument("--warmup", type=int, default=1,
+                    help="Number of corpus images recognized untimed before the passes")
+    ap.add_argument("--ocr-mode", choices=('sequential', 'parallel', 'montage'), default=PIPELINE['ocr_mode'],
+                    help="OCR mode, see LPR_OCR_MODE")
+    ap.add_argument("--detector", choices=sorted(lpr_utils.DETECTORS), default=PIPELINE['detector'],
+                    help="Plate detector, see LPR_PLATE_DETECTOR")
+    ap.add_argument("--work-max-side", type=int, default=WORK_MAX_SIDE,
+                    help="Longest side of the working image, 0 - full resolution")
+    ap.add_argument("--cascade", action="store_true",
+                    help="Also run the strategy cascade of the application")
+    ap.add_argument("--save",
+                    help="Write the results as a JSON baseline to this path")
+    ap.add_argument("--compare",
+                    help="JSON baseline to compare the results with, exits with status 1 on regressions")
+    ap.add_argument("--tolerance", type=float, default=0.2,
+                    help="Allowed latency and throughput regression, fraction of the baseline")
+    args = ap.parse_args()
+
+    corpus = load_corpus(args.corpus)
+    pipeline = dict(PIPELINE, ocr_mode = args.ocr_mode, detector = args.detector, work_max_side = args.work_max_side)
+    print("{} images, {} passes, pipeline {}".format(len(corpus), args.repeat, pipeline_info(pipeline)))
+    results = benchmark(corpus, args.blur, args.binarization, pipeline, args.repeat, args.warmup, args.cascade)
+    report = {
+        'created_at': datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S"),
+        'corpus': args.corpus,
+        'repeat': args.repeat,
+        'pipeline': pipeline_info(pipeline),
+        'machine': {'platform': platform.platform(), 'python': platform.python_version(), 'opencv': cv2.__version__},
+        'results': results
+    }
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2)
+            f.write('\n')
+        print("baseline saved: {}".format(args.save))
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print("REGRESSION {}".format(regression))
+        print("{} regressions against {}".format(len(regressions), args.compare))
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,144 @@
+"""
+Startup time benchmark: measures in fresh processes how long a web worker takes to become ready - importing
+the application, warming up the recognition pipeline (lpr_eng.warmup) and the first recognition - and how
+long the job runner's recognition pool, forked from a thread other than the warmed up one, takes to start warmed up
+(lpr_eng.recognition_pool) and to recognize its first job.
+
+    python -m benchmarks.startup [--repeat 5] [--image static/test_images/IMG_6590.jpeg]
+        [--save benchmarks/baselines/startup.json] [--compare benchmarks/baselines/startup.json]
+
+Every run uses its own temporary database and log file.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+import numpy as np
+
+# Runs in the measured process, prints one JSON object
+PROBE = r'''
+import json, os, resource, sys, threading, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+from components import lpr_utils
+from components.lpr_eng import PIPELINE, recognition_pool, warmup
+
+def recognize(path):
+    return lpr_utils.recognize_cascade(path, PIPELINE['strategies'], PIPELINE['config_str'], save_crops = False, ocr_mode = PIPELINE['ocr_mode'], detector = PIPELINE['detector'])
+
+warmup()
+warm = time.perf_counter()
+recognize(sys.argv[1])
+recognized = time.perf_counter()
+# The job runner's recognition pool, forked from another thread as by the request thread that starts the runner
+pool_times = {}
+
+def job_runner():
+    pool_start = time.perf_counter()
+    pool = recognition_pool(1)
+    pool.submit(int).result()
+    pool_ready = time.perf_counter()
+    pool.submit(recognize, sys.argv[1]).result()
+    pool_times.update(pool_warmup_ms = (pool_ready - pool_start) * 1000, pool_first_recognition_ms = (time.perf_counter() - pool_ready) * 1000)
+    pool.shutdown()
+
+thread = threading.Thread(target=job_runner)
+thread.start()
+thread.join()
+print(json.dumps({
+    'import_app_ms': (imported - start) * 1000,
+    'warmup_ms': (warm - imported) * 1000,
+    'first_recognition_ms': (recognized - warm) * 1000,
+    'pool_warmup_ms': pool_times['pool_warmup_ms'],
+    'pool_first_recognition_ms': pool_times['pool_first_recognition_ms'],
+    'matplotlib_loaded': 'matplotlib' in sys.modules,
+    'modules': len(sys.modules),
+    'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+}))
+'''
+
+METRICS = ('process_ms', 'import_app_ms', 'warmup_ms', 'first_recognition_ms', 'pool_warmup_ms', 'pool_first_recognition_ms', 'peak_rss_mb')
+
+
+def run_once(image: str) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ,
+                   LPR_DATABASE_URI = 'sqlite:///' + os.path.join(tmp, 'startup.db'),
+                   LPR_LOG_FILE = os.path.join(tmp, 'lpr_eng.log'),
+                   LPR_LOG_CONSOLE = '0',
+                   LPR_JOB_RUNNER_EMBEDDED = '0')
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, '-c', PROBE, image], env = env, check = True, capture_output = True, text = True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        result['process_ms'] = (time.perf_counter() - start) * 1000
+        return result
+
+
+def summarize(runs: list) -> dict:
+    summary = dict((metric, round(float(np.median([run[metric] for run in runs])), 1)) for metric in METRICS)
+    summary['matplotlib_loaded'] = any(run['matplotlib_loaded'] for run in runs)
+    summary['modules'] = runs[-1]['modules']
+    return summary
+
+
+def compare(summary: dict, baseline: dict, tolerance: float) -> list:
+    """
+    Returns list of the metrics that got worse than the baseline by more than `tolerance` (a fraction).
+    """
+    regressions = []
+    for metric in METRICS:
+        before = baseline['summary'].get(metric)
+        if before is not None and summary[metric] > before * (1 + tolerance):
+            regressions.append("{}: {:.1f} -> {:.1f}".format(metric, before, summary[metric]))
+    return regressions
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Benchmark web worker startup time")
+    ap.add_argument("--repeat", type=int, default=5,
+                    help="Number of measured processes, the median is reported")
+    ap.add_argument("--image", default="static/test_images/IMG_6590.jpeg",
+                    help="Image of the first recognition")
+    ap.add_argument("--save",
+                    help="Write the results as a JSON baseline to this path")
+    ap.add_argument("--compare",
+                    help="JSON baseline to compare the results with, exits with status 1 on regressions")
+    ap.add_argument("--tolerance", type=float, default=0.2,
+                    help="Allowed regression, fraction of the baseline")
+    args = ap.parse_args()
+
+    runs = []
+    for i in range(args.repeat):
+        runs.append(run_once(args.image))
+        print("run {}: ".format(i + 1) + "  ".join("{} {:.1f}".format(metric, runs[-1][metric]) for metric in METRICS), flush=True)
+    summary = summarize(runs)
+    print("median: " + "  ".join("{} {}".format(metric, summary[metric]) for metric in METRICS) +
+          "  matplotlib loaded: {}".format(summary['matplotlib_loaded']))
+    report = {
+        'created_at': datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S"),
+        'repeat': args.repeat,
+        'image': args.image,
+        'machine': {'platform': platform.platform(), 'python': platform.python_version()},
+        'summary': summary,
+        'runs': runs
+    }
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2)
+            f.write('\n')
+        print("baseline saved: {}".format(args.save))
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(summary, baseline, args.tolerance)
+        for regression in regressions:
+            print("REGRESSION {}".format(regression))
+        print("{} regressions against {}".format(len(regressions), args.compare))
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,132 @@
+"""
+Admission control in front of the recognition.
+
+Every web worker process admits at most ADMISSION_MAX_IN_FLIGHT recognitions and ADMISSION_MAX_MEGAPIXELS of
+decoded images at a time:
+- an upload (POST /) counts one recognition of its image size until its job is queued, whichever runner claims
+  it later. The queue itself is bounded by jobs.check_backlog: while ADMISSION_MAX_QUEUED_JOBS jobs are pending
+  or running in the database, uploads of every web worker get a 503 ('backlog') without waiting,
+- a batch (POST /batch) counts its recognition processes and its largest images until the response is closed,
+- a video (POST /video) counts one recognition of its frame size until it is queued, the job runner bounds the
+  ingestions (VIDEO_JOB_WORKERS).
+Requests over the limits wait in arrival order, at most ADMISSION_MAX_WAITING of them for up to ADMISSION_WAIT
+seconds. A request that finds the queue full or is not admitted in time gets a 503 with Retry-After right away,
+so a burst is pushed back to the clients instead of slowing down every request.
+A single request bigger than the limits is admitted when nothing else runs.
+
+In flight, waiting and rejected counts are exported by /metrics and GET /admission/stats.
+"""
+import threading
+import time
+from collections import deque
+
+from components import metrics
+from components.config import logger, ADMISSION_MAX_IN_FLIGHT, ADMISSION_MAX_MEGAPIXELS, ADMISSION_MAX_WAITING, ADMISSION_WAIT, ADMISSION_RETRY_AFTER
+
+
+class Overloaded(Exception):
+    """
+    The request was not admitted, reason is 'queue_full', 'timeout' or 'backlog', retry_after the suggested delay in seconds.
+    """
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__("Recognition is overloaded ({}), retry after {} seconds".format(reason, retry_after))
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    Counting limits of in-flight recognitions and decoded pixels with a bounded FIFO wait queue.
+    """
+    def __init__(self, max_in_flight: int = ADMISSION_MAX_IN_FLIGHT, max_megapixels: float = ADMISSION_MAX_MEGAPIXELS,
+                 max_waiting: int = ADMISSION_MAX_WAITING, wait: float = ADMISSION_WAIT, retry_after: int = ADMISSION_RETRY_AFTER):
+        self.max_in_flight = max_in_flight
+        self.max_pixels = int(max_megapixels * 1000000)
+        self.max_waiting = max_waiting
+        self.wait = wait
+        self.retry_after = retry_after
+        self.in_flight = 0
+        self.pixels = 0
+        self._waiting = deque()
+        self._condition = threading.Condition()
+
+    def _fits(self, count: int, pixels: int) -> bool:
+        if self.in_flight == 0:
+            return True
+        return ((not self.max_in_flight or self.in_flight + count <= self.max_in_flight) and
+                (not self.max_pixels or self.pixels + pixels <= self.max_pixels))
+
+    def _update_gauges(self):
+        metrics.ADMISSION_IN_FLIGHT.set(self.in_flight)
+        metrics.ADMISSION_MEGAPIXELS.set(round(self.pixels / 1000000, 1))
+        metrics.ADMISSION_WAITING.set(len(self._waiting))
+
+    def reject(self, reason: str):
+        """
+        Counts a rejected request and raises Overloaded, see jobs.check_backlog for the 'backlog' reason.
+        """
+        metrics.ADMISSION_REJECTED.inc(reason = reason)
+        logger.info("admission: rejected (%s), in flight %s, %.1f MP, waiting %s", reason, self.in_flight, self.pixels / 1000000, len(self._waiting))
+        raise Overloaded(reason, self.retry_after)
+
+    def acquire(self, count: int = 1, pixels: int = 0, wait: float = None):
+        """
+        Admits count recognitions of pixels decoded pixels in total, waiting up to `wait` seconds
+        (default ADMISSION_WAIT) behind the requests that came first. Raises Overloaded when not admitted.
+        """
+        wait = self.wait if wait is None else wait
+        start = time.monotonic()
+        with self._condition:
+            if len(self._waiting) == 0 and self._fits(count, pixels):
+                self._admit(count, pixels, start)
+                return
+            if len(self._waiting) >= self.max_waiting:
+                self.reject('queue_full')
+            ticket = object()
+            self._waiting.append(ticket)
+            self._update_gauges()
+            try:
+                while self._waiting[0] is not ticket or not self._fits(count, pixels):
+                    remaining = start + wait - time.monotonic()
+                    if remaining <= 0:
+                        self.reject('timeout')
+                    self._condition.wait(remaining)
+            finally:
+                self._waiting.remove(ticket)
+                # The next request may be first in the queue now
+                self._condition.notify_all()
+                self._update_gauges()
+            self._admit(count, pixels, start)
+
+    def _admit(self, count: int, pixels: int, start: float):
+        self.in_flight += count
+        self.pixels += pixels
+        self._update_gauges()
+        metrics.ADMISSION_ADMITTED.inc()
+        metrics.ADMISSION_WAIT_SECONDS.observe(time.monotonic() - start)
+
+    def release(self, count: int = 1, pixels: int = 0):
+        with self._condition:
+            self.in_flight -= count
+            self.pixels -= pixels
+            self._condition.notify_all()
+            self._update_gauges()
+
+    def stats(self) -> dict:
+        with self._condition:
+            return {
+                'in_flight': self.in_flight,
+                'megapixels': round(self.pixels / 1000000, 1),
+                'waiting': len(self._waiting),
+                'max_in_flight': self.max_in_flight,
+                'max_megapixels': self.max_pixels / 1000000,
+                'max_waiting': self.max_waiting,
+                'admitted': metrics.ADMISSION_ADMITTED.value(),
+                'rejected_queue_full': metrics.ADMISSION_REJECTED.value(reason = 'queue_full'),
+                'rejected_timeout': metrics.ADMISSION_REJECTED.value(reason = 'timeout'),
+                'rejected_backlog': metrics.ADMISSION_REJECTED.value(reason = 'backlog')
+            }
+
+
+# The web process' controller, a gunicorn worker forked from a preloaded master starts with nothing admitted
+controller = AdmissionController()
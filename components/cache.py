@@ -0,0 +1,190 @@
+"""
+Content addressed recognition result cache.
+
+An upload is identified by the sha256 of its bytes (content_hash), which also names the directory the original is
+stored in. The cache key (cache_key) adds to it what changes the result: the pipeline settings (strategies, config_str,
+OCR mode, detector), the camera and the character classifier model file, so a changed setting or a retrained
+model misses the cache instead of serving stale text, while the originals stay where they are.
+The same frame uploaded again - under any name - reuses the stored recognized_txt and crops instead of running
+license_plate_recognition.
+The cache keeps its own hard links (or copies) of the crops in CACHE_FOLDER, a cache hit links them
+to the new picture's crop names. Least recently used entries are evicted above CACHE_MAX_ENTRIES or
+CACHE_MAX_BYTES of crops.
+"""
+import ast
+import hashlib
+import os
+import shutil
+from datetime import datetime
+from sqlalchemy import func
+
+from components import metrics
+from components.config import db, logger, CACHE_FOLDER, CACHE_MAX_ENTRIES, CACHE_MAX_BYTES, OCR_CLASSIFIER_MODEL
+from components.lpr_eng import PIPELINE
+
+
+class RecognitionCache(db.Model):
+    # The cache key, see cache_key
+    content_hash = db.Column(db.String(64), primary_key=True)
+    recognized_txt = db.Column(db.String(80), nullable=False)
+    small_pictures = db.Column(db.String(1024), nullable=False)
+    size_bytes = db.Column(db.Integer, nullable=False, default=0)
+    hits = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    last_used_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+    def __repr__(self):
+        return '<RecognitionCache: %r>' % self.content_hash
+
+
+def pipeline_signature(pipeline: dict = PIPELINE) -> str:
+    parts = []
+    for key in sorted(pipeline):
+        value = pipeline[key]
+        parts.append("{}={}".format(key, getattr(value, '__name__', value)))
+    return ";".join(parts)
+
+
+def content_hash(data: bytes) -> str:
+    """
+    sha256 of the image bytes, names the stored original and the rows' content_hash.
+    """
+    return hashlib.sha256(data).hexdigest()
+
+
+def file_hash(path: str) -> str:
+    with open(path, 'rb') as f:
+        return content_hash(f.read())
+
+
+def model_signature(path: str = OCR_CLASSIFIER_MODEL) -> str:
+    """
+    Size and modification time of the character classifier model, 'none' without it.
+    """
+    try:
+        stat = os.stat(path)
+    except (OSError, TypeError):
+        return 'none'
+    return "{}:{}".format(stat.st_size, stat.st_mtime_ns)
+
+
+def cache_key(content_hash: str, pipeline: dict = PIPELINE, camera: str = None) -> str:
+    """
+    Key of the recognition result of an image (its content_hash) with the pipeline settings, the camera and
+    the character classifier model.
+    """
+    h = hashlib.sha256(content_hash.encode())
+    h.update(pipeline_signature(pipeline).encode())
+    if camera is not None:
+        # The camera's ROI and plate size change the result
+        h.update(";camera={}".format(camera).encode())
+    h.update(";model={}".format(model_signature(OCR_CLASSIFIER_MODEL)).encode())
+    return h.hexdigest()
+
+
+def _link(src: str, dst: str):
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def lookup(key: str, picture_path: str):
+    """
+    Looks up a cached result and links its crops next to picture_path as <name>_<i>.jpg.
+    Returns tuple (recognized_txt, small_pictures) or None on a miss.
+    """
+    entry = RecognitionCache.query.get(key)
+    cached_pictures = ast.literal_eval(entry.small_pictures) if entry is not None else []
+    if entry is None or not all(os.path.exists(p) for p in cached_pictures):
+        if entry is not None:
+            # Crops removed behind our back, the entry is useless
+            db.session.delete(entry)
+            db.session.commit()
+        metrics.CACHE_MISSES.inc()
+        logger.debug("cache: miss '%s'", key)
+        return None
+    picture_dir_name = os.path.dirname(picture_path)
+    name = os.path.splitext(os.path.basename(picture_path))[0]
+    small_pictures = []
+    for i, cached_picture in enumerate(cached_pictures):
+        small_picture = "{}/{}_{}.jpg".format(picture_dir_name, name, i)
+        _link(cached_picture, small_picture)
+        small_pictures.append(small_picture)
+    entry.hits += 1
+    entry.last_used_at = datetime.utcnow()
+    db.session.commit()
+    metrics.CACHE_HITS.inc()
+    logger.debug("cache: hit '%s' recognized_txt: '%s'", key, entry.recognized_txt)
+    return (entry.recognized_txt, small_pictures)
+
+
+def store(key: str, recognized_txt: str, small_pictures: list):
+    """
+    Stores a recognition result, the crops are linked into CACHE_FOLDER. Evicts entries above the limits.
+    """
+    if not os.path.exists(CACHE_FOLDER):
+        os.makedirs(CACHE_FOLDER)
+    cached_pictures = []
+    size_bytes = 0
+    for i, small_picture in enumerate(small_pictures):
+        if not os.path.exists(small_picture):
+            continue
+        cached_picture = "{}/{}_{}.jpg".format(CACHE_FOLDER, key, i)
+        _link(small_picture, cached_picture)
+        cached_pictures.append(cached_picture)
+        size_bytes += os.path.getsize(cached_picture)
+    db.session.merge(RecognitionCache(
+        content_hash = key,
+        recognized_txt = recognized_txt,
+        small_pictures = str(cached_pictures),
+        size_bytes = size_bytes,
+        hits = 0
+    ))
+    db.session.commit()
+    logger.debug("cache: stored '%s' recognized_txt: '%s'", key, recognized_txt)
+    evict()
+
+
+def evict(max_entries: int = CACHE_MAX_ENTRIES, max_bytes: int = CACHE_MAX_BYTES) -> int:
+    """
+    Removes least recently used entries and their crops until the cache is within the limits.
+    Returns number of evicted entries.
+    """
+    entries, total_bytes = db.session.query(func.count(RecognitionCache.content_hash), func.coalesce(func.sum(RecognitionCache.size_bytes), 0)).one()
+    if entries <= max_entries and total_bytes <= max_bytes:
+        return 0
+    evicted = []
+    for entry in RecognitionCache.query.order_by(RecognitionCache.last_used_at).yield_per(100):
+        if entries <= max_entries and total_bytes <= max_bytes:
+            break
+        evicted.append(entry)
+        entries -= 1
+        total_bytes -= entry.size_bytes
+    for entry in evicted:
+        for cached_picture in ast.literal_eval(entry.small_pictures):
+            if os.path.exists(cached_picture):
+                os.remove(cached_picture)
+        db.session.delete(entry)
+    db.session.commit()
+    metrics.CACHE_EVICTIONS.inc(len(evicted))
+    logger.debug("cache: evicted %s entries", len(evicted))
+    return len(evicted)
+
+
+def stats() -> dict:
+    entries, total_bytes, hits = db.session.query(
+        func.count(RecognitionCache.content_hash),
+        func.coalesce(func.sum(RecognitionCache.size_bytes), 0),
+        func.coalesce(func.sum(RecognitionCache.hits), 0)
+    ).one()
+    return {
+        'hits': metrics.CACHE_HITS.value(),
+        'misses': metrics.CACHE_MISSES.value(),
+        'evictions': metrics.CACHE_EVICTIONS.value(),
+        'entries': entries,
+        'size_bytes': int(total_bytes),
+        'total_hits': int(hits)
+    }
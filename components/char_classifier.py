@@ -0,0 +1,244 @@
+"""
+Built-in plate character classifier, the fast OCR path.
+
+A plate is a single line of 7-8 digits and uppercase letters of one font, a narrow problem for a general purpose
+OCR engine. segment() finds the characters of a prepared crop (lpr_utils.prepare_ocr) as the connected components
+of the Otsu binarized crop that have the same height and lie on one, possibly tilted, line. Every glyph is scaled
+into a GLYPH_SIZE square, described by its HOG features and labeled by its K nearest neighbors among the training
+glyphs. license_plate_recognition reads every candidate crop with it first, Tesseract only runs when the
+classifier is not confident, see config.OCR_CLASSIFIER_CONFIDENT.
+
+The model is a compressed .npz of the training glyph features and labels, trained offline from labeled crops:
+
+    python -m components.char_classifier --labels crops.json [--out models/chars.npz]
+
+crops.json is a JSON object of crop path -> plate text, labeled by hand: the DB does not record which candidate
+crop of a picture its recognized text was read from, the other crops would be trained with a wrong text.
+Only crops segmented into exactly as many glyphs as their text has characters are used.
+"""
+import argparse
+import json
+import os
+import cv2
+import numpy as np
+
+from components import utils
+from components.config import logger, OCR_CLASSIFIER_MODEL
+
+# Side of the square a glyph is scaled into
+GLYPH_SIZE = 20
+# Crops are segmented at most this high, glyphs stay several times bigger than GLYPH_SIZE
+SEGMENT_HEIGHT = 160
+# Number of neighbors voting for the label of a glyph
+K = 3
+# Glyph height relative to the crop height
+MIN_HEIGHT = 0.3
+MAX_HEIGHT = 0.95
+# Glyph pixels relative to its bounding box, solid blobs (logos, bolts) and thin frames are not characters
+MIN_FILL = 0.2
+MAX_FILL = 0.75
+
+_hog = cv2.HOGDescriptor((GLYPH_SIZE, GLYPH_SIZE), (10, 10), (5, 5), (5, 5), 9)
+
+
+def segment(image: np.ndarray) -> list:
+    """
+    Finds the characters of a plate crop, dark on a light plate.
+
+    Parameters
+    ----------
+    image : numpy.ndarray
+       Plate crop (BGR colorscale or grayscale), usually the output of lpr_utils.prepare_ocr
+
+    Returns
+    -------
+    list of numpy.ndarray
+       Binary glyphs (characters white on black), left to right
+    """
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    if gray.shape[0] > SEGMENT_HEIGHT:
+        scale = SEGMENT_HEIGHT / gray.shape[0]
+        gray = cv2.resize(gray, (max(1, int(round(gray.shape[1] * scale))), SEGMENT_HEIGHT), interpolation=cv2.INTER_AREA)
+    height, width = gray.shape[:2]
+    binary = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)[1]
+    n, labels, stats, centroids = cv2.connectedComponentsWithStats(binary, connectivity=4)
+    x, y, w, h, area = stats[1:].T.astype(np.float64)
+    fill = area / (w * h)
+    keep = np.flatnonzero(
+        (h >= MIN_HEIGHT * height) &
+        (h <= MAX_HEIGHT * height) &
+        (w >= 0.08 * h) &
+        (w <= 2.5 * h) &
+        (fill >= MIN_FILL) &
+        (fill <= MAX_FILL) &
+        # The plate frame and whatever is cut by the crop
+        (x > 0) &
+        (x + w < width)
+    )
+    if len(keep) < 2:
+        return []
+    median_height = np.median(h[keep])
+    keep = keep[np.abs(h[keep] - median_height) <= 0.2 * median_height]
+    if len(keep) < 2:
+        return []
+    # Centers of the characters of a tilted plate are on a line
+    cx, cy = x[keep] + w[keep] / 2, y[keep] + h[keep] / 2
+    slope, intercept = np.polyfit(cx, cy, 1) if len(keep) > 2 else (0.0, np.median(cy))
+    keep = keep[np.abs(cy - (slope * cx + intercept)) <= 0.2 * median_height]
+    glyphs = []
+    for i in keep[np.argsort(x[keep])]:
+        left, top, right, bottom = int(x[i]), int(y[i]), int(x[i] + w[i]), int(y[i] + h[i])
+        glyph = np.where(labels[top:bottom, left:right] == i + 1, 255, 0).astype(np.uint8)
+        # Touching characters are one component, split it into parts of about a character width
+        parts = max(1, int(round(w[i] / (0.6 * h[i]))))
+        for k in range(parts):
+            glyphs.append(glyph[:, k * glyph.shape[1] // parts:(k + 1) * glyph.shape[1] // parts])
+    return glyphs
+
+
+def normalize(glyph: np.ndarray) -> np.ndarray:
+    """
+    Centers the glyph in a square keeping its aspect ratio (a '1' stays narrow) and scales it to GLYPH_SIZE.
+    """
+    h, w = glyph.shape[:2]
+    side = max(h, w) + 2
+    square = np.zeros((side, side), dtype=np.uint8)
+    top, left = (side - h) // 2, (side - w) // 2
+    square[top:top + h, left:left + w] = glyph
+    return cv2.resize(square, (GLYPH_SIZE, GLYPH_SIZE), interpolation=cv2.INTER_AREA)
+
+
+def features(glyphs: list) -> np.ndarray:
+    """
+    L2 normalized HOG features of the glyphs, one row per glyph.
+    """
+    if len(glyphs) == 0:
+        return np.zeros((0, _hog.getDescriptorSize()), dtype=np.float32)
+    rows = np.stack([_hog.compute(normalize(glyph)).ravel() for glyph in glyphs])
+    return rows / np.maximum(np.linalg.norm(rows, axis=1, keepdims=True), 1e-6)
+
+
+class CharClassifier:
+    """
+    K nearest neighbors over the HOG features of the training glyphs.
+    A glyph farther than reject_distance from every training glyph (not a known character) gets confidence 0.
+    """
+    def __init__(self, train_features: np.ndarray, train_labels: np.ndarray, reject_distance: float):
+        self.features = train_features.astype(np.float32)
+        self.labels = train_labels
+        self.reject_distance = reject_distance
+
+    @classmethod
+    def train(cls, glyphs: list, labels: list) -> 'CharClassifier':
+        """
+        Builds the model from glyphs and their characters. The reject distance is 1.5 times the 95th percentile
+        of the distance of every training glyph to its nearest other training glyph.
+        """
+        train_features = features(glyphs)
+        distances = np.sqrt(np.maximum(2 - 2 * train_features @ train_features.T, 0))
+        np.fill_diagonal(distances, np.inf)
+        nearest = distances.min(axis=1)
+        reject_distance = 1.5 * float(np.percentile(nearest[np.isfinite(nearest)], 95)) if len(glyphs) > 1 else 2.0
+        return cls(train_features, np.array(labels), reject_distance)
+
+    @classmethod
+    def load(cls, path: str) -> 'CharClassifier':
+        with np.load(path) as model:
+            return cls(model['features'], model['labels'], float(model['reject_distance']))
+
+    def save(self, path: str):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # float16 features halve the file, the distances do not need more precision
+        np.savez_compressed(path, features=self.features.astype(np.float16), labels=self.labels, reject_distance=self.reject_distance)
+
+    def classify(self, glyphs: list) -> tuple:
+        """
+        Returns tuple (characters, list of confidences 0-100: share of the K neighbors voting for the character).
+        """
+        if len(glyphs) == 0:
+            return ('', [])
+        # Rows are unit vectors, |a - b|^2 = 2 - 2 a.b
+        distances = np.sqrt(np.maximum(2 - 2 * features(glyphs) @ self.features.T, 0))
+        k = min(K, len(self.labels))
+        nearest = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        characters = []
+        confidences = []
+        for row, neighbors in zip(distances, nearest):
+            neighbors = neighbors[np.argsort(row[neighbors])]
+            votes = self.labels[neighbors]
+            values, counts = np.unique(votes, return_counts=True)
+            # The nearest neighbor's label breaks ties
+            best = max(range(len(values)), key=lambda i: (counts[i], values[i] == votes[0]))
+            characters.append(str(values[best]))
+            confidences.append(0.0 if row[neighbors[0]] > self.reject_distance else 100.0 * counts[best] / k)
+        return (''.join(characters), confidences)
+
+    def read(self, image: np.ndarray) -> tuple:
+        """
+        Reads the plate crop. Returns tuple (text, confidence 0-100 of its least confident character),
+        confidence is -1 when no characters were found.
+        """
+        text, confidences = self.classify(segment(image))
+        if len(text) == 0:
+            return ('', -1.0)
+        return (text, min(confidences))
+
+
+_classifier = None
+_classifier_loaded = False
+
+
+def get_classifier(path: str = OCR_CLASSIFIER_MODEL) -> CharClassifier:
+    """
+    Returns the model of the application, loaded once per process. None when the model file does not exist.
+    """
+    global _classifier, _classifier_loaded
+    if not _classifier_loaded:
+        if path and os.path.exists(path):
+            _classifier = CharClassifier.load(path)
+            logger.info("char_classifier: loaded '%s', %s glyphs", path, len(_classifier.labels))
+        _classifier_loaded = True
+    return _classifier
+
+
+def training_glyphs(samples: list) -> tuple:
+    """
+    Segments labeled crops, list of (crop path, plate text).
+    Returns tuple (glyphs, characters, number of used crops).
+    """
+    glyphs = []
+    characters = []
+    used = 0
+    for path, text in samples:
+        text = utils.remove_special_chars(text or '')
+        image = cv2.imread(path)
+        if len(text) == 0 or image is None:
+            continue
+        crop_glyphs = segment(image)
+        if len(crop_glyphs) != len(text):
+            logger.debug("char_classifier: '%s' %s glyphs for '%s', not used", path, len(crop_glyphs), text)
+            continue
+        glyphs.extend(crop_glyphs)
+        characters.extend(text)
+        used += 1
+    return (glyphs, characters, used)
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Train the plate character classifier from labeled crops")
+    ap.add_argument("--labels", required=True,
+                    help="JSON object of crop path -> plate text")
+    ap.add_argument("--out", default=OCR_CLASSIFIER_MODEL,
+                    help="Model file (.npz)")
+    args = ap.parse_args()
+
+    with open(args.labels) as f:
+        samples = sorted(json.load(f).items())
+    glyphs, characters, used = training_glyphs(samples)
+    if len(glyphs) == 0:
+        raise SystemExit("No crop was segmented into its text, nothing to train")
+    classifier = CharClassifier.train(glyphs, characters)
+    classifier.save(args.out)
+    print("{} of {} crops, {} glyphs of {} characters, reject distance {:.3f}, saved {} ({} bytes)".format(
+        used, len(samples), len(glyphs), len(set(characters)), classifier.reject_distance, args.out, os.path.getsize(args.out)))
@@ -1,43 +1,275 @@
-from flask import Flask, render_template, request, redirect, flash
+from flask import Flask, Request, render_template, request, redirect, flash
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 from datetime import datetime
+import io
+import json
 import os
+import sqlite3
 import glob
 from werkzeug.utils import secure_filename
 from components import utils
 from components.utils import init_logger
 
+# Uploads up to this size stay in memory instead of being spooled to a temporary file
+UPLOAD_IN_MEMORY_MAX = int(os.environ.get('LPR_UPLOAD_IN_MEMORY_MAX', 64 * 1024 * 1024))
+# Originals are stored under PICTURES_FOLDER/<hh>/<hh>/ (UPLOAD_SHARD_DEPTH levels) named after their content hash
+UPLOAD_SHARD_DEPTH = int(os.environ.get('LPR_UPLOAD_SHARD_DEPTH', 2))
+
+
+class UploadRequest(Request):
+    """
+    Keeps uploads up to UPLOAD_IN_MEMORY_MAX in an io.BytesIO, so the upload handler can hash,
+    decode and store them straight from the buffer, see utils.upload_buffer.
+    """
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if total_content_length is not None and total_content_length <= UPLOAD_IN_MEMORY_MAX:
+            return io.BytesIO()
+        return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+
+
 app = Flask(__name__, template_folder='../templates', static_folder='../static')
+app.request_class = UploadRequest
 app.secret_key = "secret key"
 #app = Flask(__name__, static_folder=os.path.join(os.path.pardir, '..', 'static'))
 
-app.config['MAX_CONTENT_LENGTH'] = 8 * 1024 * 1024 # 8 MB
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('LPR_MAX_CONTENT_LENGTH', 32 * 1024 * 1024)) # 32 MB
 
 PICTURES_FOLDER = os.path.join('static', 'pictures_photo')
 app.config['UPLOAD_FOLDER'] = PICTURES_FOLDER
 
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///../static/test_pictures.db'
+# Database: LPR_DATABASE_URI, or DATABASE_URL as set by Heroku Postgres
+DATABASE_URI = os.environ.get('LPR_DATABASE_URI', os.environ.get('DATABASE_URL', 'sqlite:///../static/test_pictures.db'))
+if DATABASE_URI.startswith('postgres://'):
+    DATABASE_URI = 'postgresql://' + DATABASE_URI[len('postgres://'):]
+# Connection pool of server databases (PostgreSQL, MySQL), recycled connections avoid server side idle timeouts
+DB_POOL_SIZE = int(os.environ.get('LPR_DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('LPR_DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = int(os.environ.get('LPR_DB_POOL_TIMEOUT', 30))
+DB_POOL_RECYCLE = int(os.environ.get('LPR_DB_POOL_RECYCLE', 1800))
+# SQLite: seconds a writer waits for the database lock before 'database is locked', WAL lets readers run
+# alongside the writer (web workers and job runners share the file)
+DB_BUSY_TIMEOUT = float(os.environ.get('LPR_DB_BUSY_TIMEOUT', 30))
+DB_SQLITE_WAL = os.environ.get('LPR_DB_SQLITE_WAL', '1') == '1'
+
+app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URI
+if DATABASE_URI.startswith('sqlite'):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'connect_args': {'timeout': DB_BUSY_TIMEOUT}}
+else:
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'pool_timeout': DB_POOL_TIMEOUT,
+        'pool_recycle': DB_POOL_RECYCLE,
+        'pool_pre_ping': True
+    }
 # app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 db = SQLAlchemy(app)
 
+
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA busy_timeout = {}".format(int(DB_BUSY_TIMEOUT * 1000)))
+    if DB_SQLITE_WAL:
+        cursor.execute("PRAGMA journal_mode = WAL")
+        # Durable at checkpoints, commits no longer wait for an fsync of the database file
+        cursor.execute("PRAGMA synchronous = NORMAL")
+    cursor.execute("PRAGMA foreign_keys = ON")
+    cursor.close()
+
 ALLOWED_EXTENSIONS = set(['png', 'jpg', 'jpeg', 'gif'])
+# Background recognition jobs (components/jobs.py)
+# JOB_WORKERS - number of recognition processes per job runner. Every web worker process (WEB_CONCURRENCY, gunicorn's
+# number of workers) embeds its own runner, so by default the CPUs are divided between them; a standalone runner uses all
+# JOB_MAX_ATTEMPTS - a failed job is retried until it has been attempted this many times
+# JOB_LEASE_TIMEOUT - seconds after which a 'running' job is considered abandoned and claimed again
+# JOB_RUNNER_EMBEDDED - run the job runner inside the web process, set to 0 when running `python -m components.jobs`
+JOB_RUNNER_EMBEDDED = os.environ.get('LPR_JOB_RUNNER_EMBEDDED', '1') == '1'
+WEB_WORKERS = max(1, int(os.environ.get('WEB_CONCURRENCY', 1)))
+JOB_WORKERS = int(os.environ.get('LPR_JOB_WORKERS', max(1, (os.cpu_count() or 1) // (WEB_WORKERS if JOB_RUNNER_EMBEDDED else 1))))
+JOB_MAX_ATTEMPTS = int(os.environ.get('LPR_JOB_MAX_ATTEMPTS', 3))
+JOB_POLL_INTERVAL = float(os.environ.get('LPR_JOB_POLL_INTERVAL', 2.0))
+JOB_LEASE_TIMEOUT = int(os.environ.get('LPR_JOB_LEASE_TIMEOUT', 300))
+# JOB_MAX_PAYLOAD_BYTES - uploads queued in this process are handed to the job runner in memory up to this total
+JOB_MAX_PAYLOAD_BYTES = int(os.environ.get('LPR_JOB_MAX_PAYLOAD_BYTES', 256 * 1024 * 1024))
+
+# Admission control (components/admission.py), per web worker process: at most ADMISSION_MAX_IN_FLIGHT recognitions
+# (queued uploads, batch recognition processes, videos) and ADMISSION_MAX_MEGAPIXELS of decoded images at a time.
+# A request over the limits waits up to ADMISSION_WAIT seconds, behind at most ADMISSION_MAX_WAITING others, and is
+# answered 503 with Retry-After: ADMISSION_RETRY_AFTER seconds otherwise. 0 - no limit
+# ADMISSION_MAX_QUEUED_JOBS - uploads are answered 503 right away while this many jobs are pending or running in the
+# database, counted over all web workers and runners. 0 - no limit
+ADMISSION_MAX_IN_FLIGHT = int(os.environ.get('LPR_ADMISSION_MAX_IN_FLIGHT', 4 * JOB_WORKERS))
+ADMISSION_MAX_MEGAPIXELS = float(os.environ.get('LPR_ADMISSION_MAX_MEGAPIXELS', 200))
+ADMISSION_MAX_WAITING = int(os.environ.get('LPR_ADMISSION_MAX_WAITING', 16))
+ADMISSION_WAIT = float(os.environ.get('LPR_ADMISSION_WAIT', 2.0))
+ADMISSION_RETRY_AFTER = int(os.environ.get('LPR_ADMISSION_RETRY_AFTER', 5))
+ADMISSION_MAX_QUEUED_JOBS = int(os.environ.get('LPR_ADMISSION_MAX_QUEUED_JOBS', 256))
+
+# Storage of the pictures and crops (components/storage.py)
+# STORAGE_MAX_AGE_DAYS - rows older than this are deleted with their files, 0 - keep them
+# STORAGE_MAX_BYTES - the oldest rows are deleted while their pictures and crops take more than this, 0 - no limit
+# STORAGE_EVICT_BATCH - rows deleted per transaction by the retention
+# STORAGE_ORPHAN_MIN_AGE - seconds before a file no row references is removed (uploads are written before their row)
+# STORAGE_REAPER_EMBEDDED - run the reaper every STORAGE_REAP_INTERVAL seconds inside the web process,
+# set to 0 when running `python -m components.storage --loop`
+STORAGE_MAX_AGE_DAYS = float(os.environ.get('LPR_STORAGE_MAX_AGE_DAYS', 0))
+STORAGE_MAX_BYTES = int(os.environ.get('LPR_STORAGE_MAX_BYTES', 0))
+STORAGE_EVICT_BATCH = int(os.environ.get('LPR_STORAGE_EVICT_BATCH', 500))
+STORAGE_ORPHAN_MIN_AGE = int(os.environ.get('LPR_STORAGE_ORPHAN_MIN_AGE', 3600))
+STORAGE_REAP_INTERVAL = int(os.environ.get('LPR_STORAGE_REAP_INTERVAL', 3600))
+STORAGE_REAPER_EMBEDDED = os.environ.get('LPR_STORAGE_REAPER_EMBEDDED', '1') == '1'
+
+# Batch recognition (POST /batch and `python -m components.lpr_eng --dir`)
+BATCH_WORKERS = int(os.environ.get('LPR_BATCH_WORKERS', os.cpu_count() or 1))
+BATCH_MAX_FILES = int(os.environ.get('LPR_BATCH_MAX_FILES', 500))
+BATCH_MAX_CONTENT_LENGTH = int(os.environ.get('LPR_BATCH_MAX_CONTENT_LENGTH', 256 * 1024 * 1024))
+
+# OCR engine (components/ocr_engine.py): 'auto' uses in-process tesserocr when installed, else pytesseract
+OCR_ENGINE = os.environ.get('LPR_OCR_ENGINE', 'auto')
+# OCR_MODE - 'sequential' stops at the first candidate with text, 'parallel' runs OCR on all candidates in
+# OCR_THREADS threads and picks the most confident result, stopping early at OCR_CONFIDENT (0-100),
+# 'montage' recognizes all candidates with one OCR call
+OCR_MODE = os.environ.get('LPR_OCR_MODE', 'sequential')
+OCR_THREADS = int(os.environ.get('LPR_OCR_THREADS', 4))
+OCR_CONFIDENT = float(os.environ.get('LPR_OCR_CONFIDENT', 80))
+# OCR_MODE 'montage' stacks all candidate crops into one image as tiles OCR_MONTAGE_HEIGHT pixels high and
+# recognizes it with a single engine call in page segmentation mode OCR_MONTAGE_PSM (6 - a block of text lines)
+OCR_MONTAGE_HEIGHT = int(os.environ.get('LPR_OCR_MONTAGE_HEIGHT', 96))
+OCR_MONTAGE_PSM = int(os.environ.get('LPR_OCR_MONTAGE_PSM', 6))
+# Built-in character classifier (components/char_classifier.py), trained with `python -m components.char_classifier`.
+# Every candidate crop is read by it first, OCR only runs when its confidence (0-100) is below
+# OCR_CLASSIFIER_CONFIDENT. Without the OCR_CLASSIFIER_MODEL file only the OCR engine is used
+OCR_CLASSIFIER_MODEL = os.environ.get('LPR_OCR_CLASSIFIER_MODEL', 'models/chars.npz')
+OCR_CLASSIFIER_CONFIDENT = float(os.environ.get('LPR_OCR_CLASSIFIER_CONFIDENT', 70))
+
+# Plates are detected on a working image with this longest side (pixels) and cropped from the full
+# resolution image, so large uploads take predictable time and memory. 0 - detect on the full resolution
+WORK_MAX_SIDE = int(os.environ.get('LPR_WORK_MAX_SIDE', 1024))
+
+# Preprocessing strategy cascade (lpr_utils.recognize_cascade), tried in order until a plate is recognized:
+# blurring_method:binarization_method:size:budget;... size is the working image longest side (0 - full
+# resolution) or WxH for a fixed new_size, budget - seconds after which no more candidates are passed to OCR.
+# A plate is recognized when the text has at least STRATEGY_MIN_CHARS characters
+STRATEGIES = os.environ.get('LPR_STRATEGIES', ';'.join([
+    'median_blur:adaptive_threshold:{}:3'.format(WORK_MAX_SIDE),
+    'gaussian_blur:adaptive_threshold:{}:3'.format(WORK_MAX_SIDE),
+    'bilateral_filter:canny:{}:6'.format(WORK_MAX_SIDE)
+]))
+STRATEGY_MIN_CHARS = int(os.environ.get('LPR_STRATEGY_MIN_CHARS', 5))
+
+# Fixed cameras (lpr_utils.camera_options): JSON file of camera id -> {"roi": [[x, y], ...], "plate_width": [min, max],
+# "detector": "cascade"}. roi is the polygon plates can appear in and plate_width the expected plate width range, both
+# relative to the image size (0-1), detector overrides PLATE_DETECTOR.
+# Uploads name their camera with the 'camera' field, detection then runs on the ROI only
+CAMERAS_FILE = os.environ.get('LPR_CAMERAS_FILE', 'cameras.json')
+CAMERAS = {}
+if os.path.exists(CAMERAS_FILE):
+    with open(CAMERAS_FILE) as f:
+        CAMERAS = json.load(f)
+
+# Plate candidate filtering (lpr_utils.plate_candidates), area ratios are relative to the binarized image area
+# and aspect is width / height of the bounding box
+PLATE_MIN_AREA_RATIO = 0.0005
+PLATE_MAX_AREA_RATIO = 0.5
+PLATE_MIN_ASPECT = 0.8
+PLATE_MAX_ASPECT = 8.0
+PLATE_ASPECT = 3.0
+PLATE_MIN_RECTANGULARITY = 0.4
+PLATE_MAX_CANDIDATES = 10
+# Plate detector (lpr_utils.get_detector): 'contour' - 4 point contours of the binarized working image,
+# 'cascade' - OpenCV cascade classifier PLATE_CASCADE (a path, or a file name in OpenCV's cascade data directory)
+# on a grayscale copy of the working image downscaled to PLATE_CASCADE_MAX_SIDE. Cameras may set their own "detector".
+# The cascade XML is not shipped, the application does not start with the cascade detector until PLATE_CASCADE is set
+PLATE_DETECTOR = os.environ.get('LPR_PLATE_DETECTOR', 'contour')
+PLATE_CASCADE = os.environ.get('LPR_PLATE_CASCADE', '')
+PLATE_CASCADE_MAX_SIDE = int(os.environ.get('LPR_PLATE_CASCADE_MAX_SIDE', 640))
+PLATE_CASCADE_MIN_NEIGHBORS = int(os.environ.get('LPR_PLATE_CASCADE_MIN_NEIGHBORS', 3))
+
+# Save candidate plate crops (small pictures) next to the uploaded image
+SAVE_CROPS = os.environ.get('LPR_SAVE_CROPS', '1') == '1'
+
+# Recognition result cache (components/cache.py), keyed by the upload content and the pipeline settings
+# CACHE_MAX_ENTRIES / CACHE_MAX_BYTES - least recently used entries and their crops are evicted above these limits
+CACHE_ENABLED = os.environ.get('LPR_CACHE_ENABLED', '1') == '1'
+CACHE_FOLDER = os.path.join('static', 'pictures_cache')
+CACHE_MAX_ENTRIES = int(os.environ.get('LPR_CACHE_MAX_ENTRIES', 10000))
+CACHE_MAX_BYTES = int(os.environ.get('LPR_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+
+# Video and frame stream ingestion (components/video.py): frames are sampled at VIDEO_SAMPLE_FPS, a frame whose
+# perceptual hash is within VIDEO_DEDUP_DISTANCE bits of the last recognized frame is skipped, plates seen again
+# within VIDEO_EVENT_GAP seconds (plate keys differing by at most VIDEO_MERGE_DISTANCE characters) are one event
+VIDEO_EXTENSIONS = set(['mp4', 'avi', 'mov', 'mkv', 'mjpeg', 'mjpg'])
+VIDEO_SAMPLE_FPS = float(os.environ.get('LPR_VIDEO_SAMPLE_FPS', 2.0))
+VIDEO_DEDUP_DISTANCE = int(os.environ.get('LPR_VIDEO_DEDUP_DISTANCE', 6))
+VIDEO_EVENT_GAP = float(os.environ.get('LPR_VIDEO_EVENT_GAP', 3.0))
+VIDEO_MERGE_DISTANCE = int(os.environ.get('LPR_VIDEO_MERGE_DISTANCE', 1))
+VIDEO_MAX_CONTENT_LENGTH = int(os.environ.get('LPR_VIDEO_MAX_CONTENT_LENGTH', 512 * 1024 * 1024))
+# Every video gets its own event folder VIDEO_FOLDER/<uuid>/ for the upload, the event frames and their crops
+VIDEO_FOLDER = os.path.join(PICTURES_FOLDER, 'videos')
+# Uploaded videos are queued and ingested by the job runner, at most VIDEO_JOB_WORKERS of its JOB_WORKERS processes
+# at a time; a running video is claimed again by another runner after VIDEO_JOB_LEASE_TIMEOUT seconds
+VIDEO_JOB_WORKERS = int(os.environ.get('LPR_VIDEO_JOB_WORKERS', 1))
+VIDEO_JOB_LEASE_TIMEOUT = int(os.environ.get('LPR_VIDEO_JOB_LEASE_TIMEOUT', 3600))
+
+# Thumbnails of uploads and crops (components/thumbs.py) served by /thumb/<id>/<size>, size name -> longest side
+THUMB_FOLDER = os.path.join('static', 'thumbs')
+THUMB_SIZES = {'s': 160, 'm': 320, 'l': 640}
+# THUMB_FORMAT - 'webp' or 'jpg'
+THUMB_FORMAT = os.environ.get('LPR_THUMB_FORMAT', 'webp')
+THUMB_QUALITY = int(os.environ.get('LPR_THUMB_QUALITY', 80))
+# Cache-Control max-age (seconds) of the thumbnails, the listing adds the row's creation time to the URL
+THUMB_MAX_AGE = int(os.environ.get('LPR_THUMB_MAX_AGE', 30 * 24 * 3600))
+
+# Listing page size (GET / and /pictures ?limit=)
+LISTING_PAGE_SIZE = 20
+LISTING_MAX_PAGE_SIZE = 200
+# Shortest plate prefix /search?prefix=1 accepts, shorter prefixes match too many rows
+SEARCH_MIN_PREFIX = 3
+
 # DATE_FORMAT is the date format in the files. Watch out - changing this requires server cleanup
 DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
 
-logger = init_logger()
+# Logging (utils.init_logger): records are queued and written by a background thread to the console and
+# LOG_FILE, which rotates at LOG_MAX_BYTES keeping LOG_BACKUP_COUNT old files. All processes append to LOG_FILE,
+# the one that finds it full rotates it under a lock of LOG_FILE.lock (utils.SharedRotatingFileHandler)
+LOG_LEVEL = os.environ.get('LPR_LOG_LEVEL', 'INFO').upper()
+LOG_FILE = os.environ.get('LPR_LOG_FILE', 'lpr_eng.log')
+LOG_MAX_BYTES = int(os.environ.get('LPR_LOG_MAX_BYTES', 10 * 1024 * 1024))
+LOG_BACKUP_COUNT = int(os.environ.get('LPR_LOG_BACKUP_COUNT', 5))
+LOG_CONSOLE = os.environ.get('LPR_LOG_CONSOLE', '1') == '1'
+# Metrics (components/metrics.py) are kept per process. With METRICS_DIR every process writes its values there
+# at most every METRICS_FLUSH_INTERVAL seconds and /metrics adds up all processes (gunicorn.conf.py sets it)
+METRICS_DIR = os.environ.get('LPR_METRICS_DIR', '')
+METRICS_FLUSH_INTERVAL = float(os.environ.get('LPR_METRICS_FLUSH_INTERVAL', 1.0))
+
+logger = init_logger(LOG_LEVEL, LOG_FILE, LOG_MAX_BYTES, LOG_BACKUP_COUNT, LOG_CONSOLE)
 # Nasty hack for Heroku environment due to Windows shell bug - unable to perform
 #   heroku config:set TESSDATA_PREFIX=/app/.apt/usr/share/tesseract-ocr/4.00/tessdata
 #if 'heroku' in os.environ.get('PATH'):
 if 'DYNO' in os.environ:
     os.environ['TESSDATA_PREFIX'] = '/app/.apt/usr/share/tesseract-ocr/4.00/tessdata'
-else:
+elif 'TESSDATA_PREFIX' not in os.environ:
     os.environ['TESSDATA_PREFIX'] = r"C:\Program Files\Tesseract-OCR\tessdata"
 #os.environ['TESSDATA_PREFIX'] = r'C:\Program Files\Tesseract-OCR\tessdata'
 #    pytesseract.pytesseract.tesseract_cmd = r'C:\Program Files\Tesseract-OCR\tesseract.exe'
-logger.debug("config:TESSDATA_PREFIX '{}'\n\n PATH:\n '{}'".format(os.environ.get('TESSDATA_PREFIX'), os.environ.get('PATH')))
+logger.debug("config:TESSDATA_PREFIX '%s'", os.environ.get('TESSDATA_PREFIX'))
 #
 #     os.environ['TESSDATA_PREFIX'] = 'C:\Program Files\Tesseract-OCR\tessdata'
 
+def dispose_engines(close: bool = True):
+    """
+    Drops the pooled DB connections. After a fork the child calls it with close=False: the inherited
+    connections belong to the parent, they are discarded without closing them under the parent.
+    """
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=close)
+
 def allowed_file(filename):
 	return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
@@ -0,0 +1,347 @@
+"""
+Background recognition jobs.
+
+The picture_wrapper table is the queue: an upload is stored as a 'pending' PictureWrapper row and
+the row id is the job id. A JobRunner claims pending rows with a compare-and-swap UPDATE, runs the
+recognition in a bounded process pool and writes the result back to the row. Failed jobs are
+retried until JOB_MAX_ATTEMPTS. Several runners (one per web worker or standalone) may share a database.
+Uploaded videos are queued the same way as VideoJob rows, a runner ingests at most VIDEO_JOB_WORKERS of them at a
+time in its pool (see video.ingest_video) and saves their plate events when the video is done.
+
+Standalone runner:
+    python -m components.jobs
+"""
+import json
+import os
+import threading
+import time
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta
+from sqlalchemy import and_, or_, func
+
+from components import admission
+from components import cache
+from components import metrics
+from components import utils
+from components import video
+from components.config import db, app, logger, JOB_WORKERS, JOB_MAX_ATTEMPTS, JOB_POLL_INTERVAL, JOB_LEASE_TIMEOUT, JOB_MAX_PAYLOAD_BYTES, CACHE_ENABLED
+from components.config import VIDEO_JOB_WORKERS, VIDEO_JOB_LEASE_TIMEOUT, ADMISSION_MAX_QUEUED_JOBS
+from components.lpr_eng import PictureWrapper, VideoJob, recognize, recognition_pool, commit_timings, save_batch, upgrade_db, PIPELINE, STATUS_PENDING, STATUS_RUNNING, STATUS_DONE, STATUS_FAILED
+
+
+def check_backlog(max_queued: int = ADMISSION_MAX_QUEUED_JOBS):
+    """
+    Raises admission.Overloaded ('backlog') while max_queued jobs are pending or running (0 - no limit).
+    They are counted in the database, the limit holds for all web workers and runners together.
+    """
+    if not max_queued:
+        return
+    queued = db.session.query(func.count(PictureWrapper.id)).filter(PictureWrapper.status.in_((STATUS_PENDING, STATUS_RUNNING))).scalar()
+    db.session.commit()
+    if queued >= max_queued:
+        admission.controller.reject('backlog')
+
+
+def enqueue(name, picture_path, content_hash=None, data=None, camera=None):
+    """
+    Adds a pending PictureWrapper row for a picture and wakes up the job runner.
+    data is the encoded picture, when given it is handed to this process' runner in memory, so the
+    picture may still be being written to picture_path.
+    camera is the id of the fixed camera that took the picture, see config.CAMERAS.
+    When the content_hash is found in the result cache the row is stored as done right away.
+    Returns the new row, its id is the job id.
+    """
+    runner = get_runner()
+    cached = cache.lookup(cache.cache_key(content_hash, camera = camera), picture_path) if CACHE_ENABLED and content_hash else None
+    if cached is not None:
+        recognized_txt, small_pictures = cached
+        new_picture = PictureWrapper(name = name, picture_path = picture_path, recognized_txt = recognized_txt, status = STATUS_DONE, content_hash = content_hash, camera = camera)
+        new_picture.set_small_pictures(small_pictures)
+        db.session.add(new_picture)
+        db.session.commit()
+        logger.debug("jobs: cached result for picture_path:'%s', no job queued", picture_path)
+        return new_picture
+    new_picture = PictureWrapper(name = name, picture_path = picture_path, recognized_txt = '', small_pictures = str([]), status = STATUS_PENDING, content_hash = content_hash, camera = camera)
+    db.session.add(new_picture)
+    db.session.flush()
+    # Handed over before the commit, the runner can not claim the job without its payload
+    if runner is None or data is None or not runner.add_payload(new_picture.id, data):
+        # The job reads picture_path, it must be written before any runner can claim the job
+        utils.wait_image_writes()
+    db.session.commit()
+    logger.debug("jobs: enqueued job id:'%s' picture_path:'%s'", new_picture.id, picture_path)
+    if runner is not None:
+        runner.wake()
+    return new_picture
+
+
+def enqueue_video(name, folder, video_path, camera=None):
+    """
+    Adds a pending VideoJob row for a video stored in its event folder (see video.event_folder) and wakes up the job runner.
+    Returns the new row, its id is the video job id.
+    """
+    job = VideoJob(name = name, folder = folder, video_path = video_path, camera = camera, status = STATUS_PENDING)
+    db.session.add(job)
+    db.session.commit()
+    logger.debug("jobs: enqueued video job id:'%s' video_path:'%s'", job.id, video_path)
+    runner = get_runner()
+    if runner is not None:
+        runner.wake()
+    return job
+
+
+class JobRunner:
+    """
+    Claims pending jobs and runs at most `workers` recognitions at a time.
+    All DB access is done by the dispatcher thread, pool processes only run the recognition pipeline.
+    """
+    def __init__(self, workers: int = JOB_WORKERS):
+        self.workers = max(1, workers)
+        self._pool = None
+        self._in_flight = {}
+        # future -> video job id
+        self._videos_in_flight = {}
+        # job id -> (encoded picture, time added) of jobs enqueued by this process
+        self._payloads = {}
+        self._payload_bytes = 0
+        self._payload_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        # Forked by the calling thread (before_request, ahead of the request) rather than by the runner thread:
+        # a process forked while another thread is importing a module inherits the module lock held forever
+        self._pool = self._new_pool()
+        self._thread = threading.Thread(target=self.run, name="lpr-job-runner", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, wait: bool = True):
+        self._stop.set()
+        self._wake.set()
+        if wait and self._thread is not None:
+            self._thread.join()
+
+    def wake(self):
+        self._wake.set()
+
+    def add_payload(self, job_id, data) -> bool:
+        """
+        Keeps the encoded picture of a job in memory so the worker does not read it from disk.
+        Returns False when JOB_MAX_PAYLOAD_BYTES would be exceeded.
+        """
+        with self._payload_lock:
+            if self._payload_bytes + len(data) > JOB_MAX_PAYLOAD_BYTES:
+                return False
+            # bytes are kept as is, other buffers are copied once
+            self._payloads[job_id] = (data if isinstance(data, bytes) else bytes(data), time.monotonic())
+            self._payload_bytes += len(data)
+        return True
+
+    def _take_payload(self, job_id):
+        with self._payload_lock:
+            # Jobs claimed by other runners never come back here
+            stale = time.monotonic() - JOB_LEASE_TIMEOUT
+            for stale_id in [i for i, (data, added) in self._payloads.items() if added < stale]:
+                self._payload_bytes -= len(self._payloads.pop(stale_id)[0])
+            if job_id not in self._payloads:
+                return None
+            data = self._payloads.pop(job_id)[0]
+            self._payload_bytes -= len(data)
+            return data
+
+    def run(self):
+        logger.info("jobs: runner started, workers: %s", self.workers)
+        if self._pool is None:
+            self._pool = self._new_pool()
+        with app.app_context():
+            while not self._stop.is_set():
+                try:
+                    self._collect()
+                    self._dispatch()
+                except Exception as e:
+                    db.session.rollback()
+                    logger.error("jobs: runner error: '%s'", e)
+                self._wake.wait(JOB_POLL_INTERVAL)
+                self._wake.clear()
+        self._pool.shutdown(wait=True)
+        logger.info("jobs: runner stopped")
+
+    def _new_pool(self):
+        pool = recognition_pool(self.workers)
+        # Starts and warms up the processes now instead of at the first job
+        pool.submit(int)
+        return pool
+
+    def _submit(self, fn, *args):
+        try:
+            future = self._pool.submit(fn, *args)
+        except BrokenProcessPool:
+            self._pool = self._new_pool()
+            future = self._pool.submit(fn, *args)
+        future.add_done_callback(lambda f: self.wake())
+        return future
+
+    def _busy(self) -> int:
+        return len(self._in_flight) + len(self._videos_in_flight)
+
+    def _dispatch(self):
+        while self._busy() < self.workers:
+            job = self._claim_next()
+            if job is None:
+                break
+            job_id, picture_path, camera = job
+            data = self._take_payload(job_id)
+            self._in_flight[self._submit(recognize, picture_path, PIPELINE, data, camera)] = job_id
+        # Videos take the processes pictures left free
+        while self._busy() < self.workers and len(self._videos_in_flight) < VIDEO_JOB_WORKERS:
+            job = self._claim_next_video()
+            if job is None:
+                return
+            video_id, name, folder, video_path, camera = job
+            self._videos_in_flight[self._submit(video.ingest_video, video_path, name, folder, PIPELINE, camera)] = video_id
+
+    def _claim_next(self):
+        """
+        Claims the oldest pending job, or a running job whose lease has expired.
+        Returns tuple (job_id, picture_path, camera) or None when the queue is empty.
+        """
+        return self._claim(PictureWrapper, (PictureWrapper.id, PictureWrapper.picture_path, PictureWrapper.camera), JOB_LEASE_TIMEOUT)
+
+    def _claim_next_video(self):
+        """
+        Claims the oldest pending video job, or a running one whose lease has expired.
+        Returns tuple (video_id, name, folder, video_path, camera) or None when no video is queued.
+        """
+        return self._claim(VideoJob, (VideoJob.id, VideoJob.name, VideoJob.folder, VideoJob.video_path, VideoJob.camera), VIDEO_JOB_LEASE_TIMEOUT)
+
+    def _claim(self, model, columns: tuple, lease_timeout: int):
+        stale = datetime.utcnow() - timedelta(seconds=lease_timeout)
+        # Abandoned jobs that used up their attempts are not claimed again
+        model.query.filter(
+            model.status == STATUS_RUNNING,
+            model.claimed_at < stale,
+            model.attempts >= JOB_MAX_ATTEMPTS
+        ).update({'status': STATUS_FAILED, 'error': 'lease expired'}, synchronize_session=False)
+        claimable = or_(
+            model.status == STATUS_PENDING,
+            and_(model.status == STATUS_RUNNING, model.claimed_at < stale)
+        )
+        while True:
+            candidate = db.session.query(*columns).filter(claimable).order_by(model.id).first()
+            if candidate is None:
+                db.session.commit()
+                return None
+            # Another runner may have claimed the row between the SELECT and the UPDATE
+            claimed = model.query.filter(model.id == candidate.id, claimable).update({
+                'status': STATUS_RUNNING,
+                'claimed_at': datetime.utcnow(),
+                'attempts': model.attempts + 1
+            }, synchronize_session=False)
+            db.session.commit()
+            if claimed == 1:
+                logger.debug("jobs: claimed %s id:'%s'", model.__tablename__, candidate.id)
+                return tuple(candidate)
+
+    def _collect(self):
+        for future in [f for f in self._videos_in_flight if f.done()]:
+            self._finish_video(self._videos_in_flight.pop(future), future)
+        finished = [f for f in self._in_flight if f.done()]
+        if len(finished) == 0:
+            return
+        done = []
+        for future in finished:
+            job_id = self._in_flight.pop(future)
+            try:
+                recognized_txt, small_pictures, timings, strategy = future.result()
+            except Exception as e:
+                metrics.observe_recognition({}, STATUS_FAILED)
+                self._fail(job_id, e)
+            else:
+                metrics.observe_recognition(timings, STATUS_DONE)
+                picture = PictureWrapper.query.get(job_id)
+                if picture is None:
+                    logger.debug("jobs: job id:'%s' deleted while running", job_id)
+                    continue
+                picture.status = STATUS_DONE
+                picture.recognized_txt = recognized_txt
+                picture.set_small_pictures(small_pictures)
+                picture.strategy = strategy
+                picture.error = None
+                logger.debug("jobs: job id:'%s' done, recognized_txt: '%s'", job_id, recognized_txt)
+                if CACHE_ENABLED and picture.content_hash:
+                    cache.store(cache.cache_key(picture.content_hash, camera = picture.camera), recognized_txt, small_pictures)
+                done.append((picture, timings))
+        # One transaction for the jobs finished since the last round
+        commit_timings(done)
+
+    def _finish_video(self, video_id, future):
+        """
+        Saves the plate events of an ingested video in one transaction with its job, the video is removed once
+        it is done or failed for good, the event frames and crops stay in its folder.
+        """
+        try:
+            results, stats, frames = future.result()
+        except Exception as e:
+            job = self._fail(video_id, e, VideoJob)
+            db.session.commit()
+            if job is not None and job.status == STATUS_FAILED:
+                utils.remove_file(job.video_path)
+            return
+        video.observe_frames(stats, frames)
+        job = VideoJob.query.get(video_id)
+        if job is None:
+            return
+        job.status = STATUS_DONE
+        job.stats = json.dumps(stats)
+        job.error = None
+        for result in results:
+            result['video_id'] = video_id
+        save_batch(results)
+        utils.remove_file(job.video_path)
+        logger.debug("jobs: video job id:'%s' done, %s events", video_id, len(results))
+
+    def _fail(self, job_id, error, model=PictureWrapper):
+        """
+        Puts a failed job of the model back to pending, or marks it failed after JOB_MAX_ATTEMPTS. Returns the row.
+        """
+        job = model.query.get(job_id)
+        if job is None:
+            return None
+        job.error = str(error)[:256]
+        if job.attempts < JOB_MAX_ATTEMPTS:
+            job.status = STATUS_PENDING
+            logger.error("jobs: %s id:'%s' attempt %s failed, retrying: '%s'", model.__tablename__, job_id, job.attempts, error)
+        else:
+            job.status = STATUS_FAILED
+            logger.error("jobs: %s id:'%s' failed after %s attempts: '%s'", model.__tablename__, job_id, job.attempts, error)
+        return job
+
+
+_runner = None
+_runner_pid = None
+_runner_lock = threading.Lock()
+
+
+def get_runner():
+    return _runner if _runner_pid == os.getpid() else None
+
+
+def ensure_runner(workers: int = JOB_WORKERS):
+    """
+    Starts the job runner of this process if it is not running yet.
+    The runner belongs to the process that started it, a forked child starts its own.
+    """
+    global _runner, _runner_pid
+    with _runner_lock:
+        if get_runner() is None:
+            _runner = JobRunner(workers).start()
+            _runner_pid = os.getpid()
+    return _runner
+
+
+if __name__ == "__main__":
+    with app.app_context():
+        upgrade_db()
+    JobRunner().run()
@@ -1,66 +1,572 @@
 # run.py
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, inspect, text, and_, or_
+from sqlalchemy.exc import IntegrityError, DatabaseError
+from sqlalchemy.orm import selectinload
 from datetime import datetime
 
 import argparse
-import pytesseract
+import ast
+import json
+import logging
+import time
+import cv2
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import sys, os
 from components import lpr_utils
-from components.config import db, app, logger, allowed_file, datetimeformat, PICTURES_FOLDER, ALLOWED_EXTENSIONS, DATE_FORMAT
+from components import utils
+from components import metrics
+from components import thumbs
+from components.config import db, app, logger, allowed_file, datetimeformat, PICTURES_FOLDER, ALLOWED_EXTENSIONS, DATE_FORMAT, BATCH_WORKERS, OCR_MODE, STRATEGIES, THUMB_SIZES, PLATE_DETECTOR
+
+
+# Recognition status of a PictureWrapper row. Rows created by the synchronous path are 'done' right away,
+# uploads handled by components.jobs start as 'pending' and are picked up by the job runner.
+STATUS_PENDING = 'pending'
+STATUS_RUNNING = 'running'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
 
 
 class PictureWrapper(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(80), nullable=False)
-    picture_path = db.Column(db.String(180), nullable=False)
-    recognized_txt = db.Column(db.String(80), nullable=False)
+    picture_path = db.Column(db.String(180), nullable=False, index=True)
+    recognized_txt = db.Column(db.String(80), nullable=False, index=True)
     small_pictures  = db.Column(db.String(1024), nullable=False)
     created_at = db.Column(db.DateTime, nullable=False,
                            default=datetime.utcnow)
+    status = db.Column(db.String(16), nullable=False, default=STATUS_DONE, server_default=STATUS_DONE)
+    attempts = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    error = db.Column(db.String(256))
+    claimed_at = db.Column(db.DateTime)
+    content_hash = db.Column(db.String(64), index=True)
+    # JSON of the recognition stage durations (ms) and counts, see metrics.timings_json
+    timings = db.Column(db.String(512))
+    # Preprocessing strategy that recognized the plate, see lpr_utils.recognize_cascade
+    strategy = db.Column(db.String(64))
+    # utils.plate_key of recognized_txt, kept up to date by an attribute event, see search_pictures
+    plate_key = db.Column(db.String(80), index=True)
+    # Fixed camera the picture was taken by, see config.CAMERAS
+    camera = db.Column(db.String(64))
+    # Video job of a plate event, see components.video
+    video_id = db.Column(db.Integer, db.ForeignKey('video_job.id'), index=True)
+    crops = db.relationship('Crop', order_by='Crop.position', cascade='all, delete-orphan', backref='picture')
+
+    # Keyset pagination of the listing, see list_pictures, and the job claims, see jobs.JobRunner._claim_next
+    __table_args__ = (db.Index('ix_picture_wrapper_created_at_id', 'created_at', 'id'),
+                      db.Index('ix_picture_wrapper_status_id', 'status', 'id'))
 
     def __repr__(self):
         return '<Picture: %r>' % self.name
 
-def invoke_lpr_eng(name, picture_path):
-    logger.debug("invoke_lpr_eng for picture_path:'{}'".format(picture_path))
-    config = r'--psm 13'
-    recognized_txt, small_pictures = lpr_utils.license_plate_recognition(
-        img_path = picture_path,
-        new_size = None,
-#        blurring_method=alpr.bilateral_filter,
-#        binarization_method=alpr.adaptive_threshold
-#        blurring_method=alpr.gaussian_blur,
-#        binarization_method=alpr.adaptive_threshold
-        blurring_method = lpr_utils.median_blur,
-        binarization_method = lpr_utils.adaptive_threshold,
-        config_str = config
-    )
-    logger.debug("Going to update DB with new picture: '{}', '{}' ".format(name, picture_path))
-    new_picture = PictureWrapper(name = name, picture_path = picture_path, recognized_txt = recognized_txt, small_pictures = str(small_pictures))
-    db.session.add(new_picture)
+    def set_small_pictures(self, small_pictures: list):
+        """
+        Stores the crop paths in the crop table, small_pictures column keeps them as a string for older readers.
+        """
+        self.small_pictures = str(small_pictures)
+        self.crops = [Crop(position = i, path = path) for i, path in enumerate(small_pictures)]
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'status': self.status,
+            'attempts': self.attempts,
+            'error': self.error,
+            'recognized_txt': self.recognized_txt,
+            'picture_path': self.picture_path,
+            'small_pictures': self.small_pictures,
+            'crops': [crop.path for crop in self.crops],
+            'content_hash': self.content_hash,
+            'timings': json.loads(self.timings) if self.timings else None,
+            'strategy': self.strategy,
+            'camera': self.camera,
+            'video_id': self.video_id,
+            'created_at': self.created_at.strftime(DATE_FORMAT) if self.created_at else None,
+        }
+
+
+@event.listens_for(PictureWrapper.recognized_txt, 'set')
+def set_plate_key(picture, value, old_value, initiator):
+    picture.plate_key = utils.plate_key(value)
+
+
+class Crop(db.Model):
+    """
+    Candidate plate crop (small picture) of a PictureWrapper row.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    picture_id = db.Column(db.Integer, db.ForeignKey('picture_wrapper.id', ondelete='CASCADE'), nullable=False, index=True)
+    position = db.Column(db.Integer, nullable=False)
+    # Indexed for the lookup of the rows sharing a file, see storage.delete_pictures
+    path = db.Column(db.String(180), nullable=False, index=True)
+
+    def __repr__(self):
+        return '<Crop: %r>' % self.path
+
+
+class VideoJob(db.Model):
+    """
+    Queued ingestion of an uploaded video, claimed by components.jobs like a picture job. The video is stored in its
+    own event folder with the frames and crops of its plate events, which become PictureWrapper rows with its video_id.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(80), nullable=False)
+    folder = db.Column(db.String(180), nullable=False)
+    video_path = db.Column(db.String(180), nullable=False)
+    camera = db.Column(db.String(64))
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    status = db.Column(db.String(16), nullable=False, default=STATUS_PENDING)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.String(256))
+    claimed_at = db.Column(db.DateTime)
+    # JSON of the frame and event counts, see video.ingest
+    stats = db.Column(db.String(256))
+    events = db.relationship('PictureWrapper', order_by='PictureWrapper.id', backref='video')
+
+    __table_args__ = (db.Index('ix_video_job_status_id', 'status', 'id'),)
+
+    def __repr__(self):
+        return '<VideoJob: %r>' % self.name
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'status': self.status,
+            'attempts': self.attempts,
+            'error': self.error,
+            'camera': self.camera,
+            'stats': json.loads(self.stats) if self.stats else None,
+            'created_at': self.created_at.strftime(DATE_FORMAT) if self.created_at else None,
+        }
+
+
+class SchemaVersion(db.Model):
+    """
+    Applied migrations, see MIGRATIONS and upgrade_db.
+    """
+    __tablename__ = 'schema_version'
+    version = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(80), nullable=False)
+    applied_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return '<SchemaVersion: %r>' % self.version
+
+
+def add_column(model, name):
+    """
+    ALTER TABLE ADD COLUMN for a model column missing in the database, existing rows get the column's server default.
+    """
+    table = model.__table__
+    if name in set(column['name'] for column in inspect(db.session.connection()).get_columns(table.name)):
+        return
+    column = table.columns[name]
+    ddl = "ALTER TABLE {} ADD COLUMN {} {}".format(table.name, column.name, column.type.compile(dialect=db.engine.dialect))
+    if column.server_default is not None:
+        ddl += " NOT NULL DEFAULT '{}'".format(column.server_default.arg)
+    logger.debug("upgrade_db: '%s'", ddl)
+    db.session.execute(text(ddl))
+
+
+def create_index(model, name):
+    index = next(index for index in model.__table__.indexes if index.name == name)
+    logger.debug("upgrade_db: create index '%s'", name)
+    index.create(bind=db.session.connection(), checkfirst=True)
+
+
+def migrate_job_columns():
+    # Columns added to picture_wrapper after the first release, databases upgraded before the versioned
+    # migrations may already have some of them
+    for name in ('status', 'attempts', 'error', 'claimed_at', 'content_hash', 'timings', 'strategy'):
+        add_column(PictureWrapper, name)
+    create_index(PictureWrapper, 'ix_picture_wrapper_created_at_id')
+    if db.session.query(Crop.id).first() is None:
+        backfill_crops()
+
+
+def migrate_picture_indexes():
+    for name in ('ix_picture_wrapper_recognized_txt', 'ix_picture_wrapper_content_hash'):
+        create_index(PictureWrapper, name)
+
+
+def migrate_plate_key():
+    add_column(PictureWrapper, 'plate_key')
+    for (recognized_txt,) in db.session.query(PictureWrapper.recognized_txt).distinct().all():
+        PictureWrapper.query.filter(PictureWrapper.recognized_txt == recognized_txt).update(
+            {'plate_key': utils.plate_key(recognized_txt)}, synchronize_session=False)
+    create_index(PictureWrapper, 'ix_picture_wrapper_plate_key')
+
+
+def migrate_camera():
+    add_column(PictureWrapper, 'camera')
+
+
+def migrate_job_claim_index():
+    create_index(PictureWrapper, 'ix_picture_wrapper_status_id')
+
+
+def migrate_video_id():
+    add_column(PictureWrapper, 'video_id')
+    create_index(PictureWrapper, 'ix_picture_wrapper_video_id')
+
+
+def migrate_path_indexes():
+    create_index(PictureWrapper, 'ix_picture_wrapper_picture_path')
+    create_index(Crop, 'ix_crop_path')
+
+
+# Ordered schema migrations: (version, name, function). Append new migrations at the end,
+# new tables are created by create_all with their current columns and indexes
+MIGRATIONS = [
+    (1, 'job_columns', migrate_job_columns),
+    (2, 'picture_indexes', migrate_picture_indexes),
+    (3, 'plate_key', migrate_plate_key),
+    (4, 'camera', migrate_camera),
+    (5, 'job_claim_index', migrate_job_claim_index),
+    (6, 'video_id', migrate_video_id),
+    (7, 'path_indexes', migrate_path_indexes),
+]
+
+
+def upgrade_db():
+    """
+    Creates missing tables and applies the pending MIGRATIONS in order. Every migration runs in its own
+    transaction together with its schema_version row, so concurrently starting processes apply it once.
+    """
+    try:
+        db.create_all()
+    except DatabaseError:
+        # Another process created a table between the check and the CREATE TABLE
+        db.session.rollback()
+        db.create_all()
+    applied = set(version for (version,) in db.session.query(SchemaVersion.version))
     db.session.commit()
+    for version, name, migration in MIGRATIONS:
+        if version in applied:
+            continue
+        try:
+            # Inserted first: the row lock makes a concurrent upgrade wait, then fail on the primary key
+            db.session.add(SchemaVersion(version = version, name = name))
+            db.session.flush()
+            migration()
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            logger.debug("upgrade_db: migration %s '%s' applied by another process", version, name)
+            continue
+        logger.info("upgrade_db: applied migration %s '%s'", version, name)
+
+
+def backfill_crops():
+    """
+    Fills the crop table from the small_pictures column of rows created before it existed.
+    Paths saved on Windows are normalized to '/' separators.
+    """
+    # Only the columns of the first release are read, later migrations may not have added the others yet
+    rows = db.session.query(PictureWrapper.id, PictureWrapper.picture_path, PictureWrapper.small_pictures).all()
+    for id, picture_path, small_pictures in rows:
+        small_pictures = [path.replace('\\', '/') for path in ast.literal_eval(small_pictures or '[]')]
+        PictureWrapper.query.filter(PictureWrapper.id == id).update({
+            'picture_path': picture_path.replace('\\', '/'),
+            'small_pictures': str(small_pictures)
+        }, synchronize_session=False)
+        db.session.add_all([Crop(picture_id = id, position = i, path = path) for i, path in enumerate(small_pictures)])
+    logger.info("upgrade_db: crop table filled from small_pictures")
+
+
+def list_pictures(limit: int, after: str = None) -> tuple:
+    """
+    Newest pictures first with their crops, keyset pagination over (created_at, id).
+
+    Parameters
+    ----------
+    limit : int
+        Page size
+    after : str
+        Cursor returned with the previous page, None for the first page
+
+    Returns
+    -------
+    tuple
+        List of PictureWrapper rows and the cursor of the next page (None on the last page)
+    """
+    query = PictureWrapper.query.options(selectinload(PictureWrapper.crops)).order_by(PictureWrapper.created_at.desc(), PictureWrapper.id.desc())
+    if after:
+        created_at, id = parse_cursor(after)
+        query = query.filter(or_(
+            PictureWrapper.created_at < created_at,
+            and_(PictureWrapper.created_at == created_at, PictureWrapper.id < id)
+        ))
+    pictures = query.limit(limit + 1).all()
+    if len(pictures) <= limit:
+        return (pictures, None)
+    pictures = pictures[:limit]
+    return (pictures, make_cursor(pictures[-1]))
+
+
+def search_pictures(plate: str, prefix: bool = False, fuzzy: bool = False, limit: int = 20, after: int = None) -> tuple:
+    """
+    Pictures whose recognized text matches the plate, newest (highest id) first.
+    Every lookup is an index range over recognized_txt or plate_key.
+
+    Parameters
+    ----------
+    plate : str
+        Plate text, special characters are ignored
+    prefix : bool
+        Match texts that start with the plate instead of the whole text
+    fuzzy : bool
+        Compare plate keys, which tolerate OCR confusions like 0/O, 1/I and 8/B, see utils.plate_key
+    limit : int
+        Page size
+    after : int
+        Id of the last picture of the previous page, None for the first page
+
+    Returns
+    -------
+    tuple
+        List of PictureWrapper rows and the after value of the next page (None on the last page)
+    """
+    if fuzzy:
+        column, value = PictureWrapper.plate_key, utils.plate_key(plate) or ''
+    else:
+        column, value = PictureWrapper.recognized_txt, utils.remove_special_chars(plate.upper())
+    if len(value) == 0:
+        raise ValueError("Empty plate")
+    if prefix:
+        # A range instead of LIKE, so the index is used regardless of the database's LIKE collation
+        condition = and_(column >= value, column < value + '\uffff')
+    else:
+        condition = column == value
+    query = PictureWrapper.query.options(selectinload(PictureWrapper.crops)).filter(condition)
+    if after is not None:
+        query = query.filter(PictureWrapper.id < after)
+    pictures = query.order_by(PictureWrapper.id.desc()).limit(limit + 1).all()
+    if len(pictures) <= limit:
+        return (pictures, None)
+    pictures = pictures[:limit]
+    return (pictures, pictures[-1].id)
+
+
+CURSOR_DATE_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+
+def make_cursor(picture: PictureWrapper) -> str:
+    return "{}_{}".format(picture.created_at.strftime(CURSOR_DATE_FORMAT), picture.id)
+
 
-    return new_picture
+def parse_cursor(cursor: str) -> tuple:
+    """
+    Returns tuple (created_at, id), raises ValueError for a malformed cursor.
+    """
+    created_at, id = cursor.rsplit('_', 1)
+    return (datetime.strptime(created_at, CURSOR_DATE_FORMAT), int(id))
+
+
+# Recognition pipeline settings used by the application, also part of the result cache key (components/cache.py)
+# Cheap strategies come first, e.g. median_blur + adaptive_threshold, bilateral_filter only for the hard images
+PIPELINE = dict(
+    strategies = lpr_utils.parse_strategies(STRATEGIES),
+    config_str = r'--psm 13',
+    ocr_mode = OCR_MODE,
+    detector = PLATE_DETECTOR
+)
+# A cascade detector without its XML file or an invalid camera fails here, on startup
+lpr_utils.check_detectors()
+
+
+def recognize(picture_path, pipeline: dict = PIPELINE, data = None, camera = None):
+    """
+    Runs the recognition pipeline, by default with the application's settings.
+    data is the encoded image already in memory, picture_path is then only used to name the crops.
+    camera limits the detection to the camera's ROI and plate size and may choose its detector, see lpr_utils.camera_options.
+    Thumbnails of the picture and its crops are generated too, see components.thumbs.
+    Returns tuple (recognized_txt, small_pictures, timings, strategy), see lpr_utils.recognize_cascade.
+    """
+    options = lpr_utils.camera_options(camera)
+    timings = {}
+    start = time.perf_counter()
+    with metrics.timed(timings, 'imread'):
+        image = utils.decode_image(data) if data is not None else cv2.imread(picture_path)
+    if image is None:
+        raise ValueError("Not a supported image: '{}'".format(picture_path))
+    try:
+        recognized_txt, small_pictures, strategy = lpr_utils.recognize_cascade(img_path = picture_path, timings = timings, image = image, **dict(pipeline, **options))
+    finally:
+        # Crops are written in the background, the row must not point at files that do not exist yet
+        with metrics.timed(timings, 'save'):
+            utils.wait_image_writes()
+    with metrics.timed(timings, 'thumbs'):
+        thumbs.make_thumbs(picture_path, image)
+        for small_picture in small_pictures:
+            thumbs.make_thumbs(small_picture, sizes = {thumbs.CROP_THUMB_SIZE: THUMB_SIZES[thumbs.CROP_THUMB_SIZE]})
+    timings['total'] = time.perf_counter() - start
+    if logger.isEnabledFor(logging.INFO):
+        # The one record per recognition, stage details are logged at DEBUG
+        summary = {
+            'picture_path': picture_path,
+            'recognized_txt': recognized_txt,
+            'strategy': strategy,
+            'camera': camera,
+            'crops': len(small_pictures),
+            'timings': metrics.timings_ms(timings)
+        }
+        logger.info("recognition: %s", json.dumps(summary), extra={'recognition': summary})
+    return (recognized_txt, small_pictures, timings, strategy)
+
+
+def warmup(pipeline: dict = PIPELINE) -> float:
+    """
+    Runs the pipeline on a small synthetic plate, so OpenCV is initialized and the OCR engine of the calling
+    thread is loaded before the first upload. With gunicorn preload_app the master runs it once and the
+    workers inherit it, see gunicorn.conf.py. The OCR engine is thread local, processes forked from another
+    thread (the job runner's recognition pool) load their own, see recognition_pool.
+    Returns duration in seconds.
+    """
+    start = time.perf_counter()
+    image = np.zeros((160, 480, 3), dtype=np.uint8)
+    cv2.rectangle(image, (60, 50), (420, 110), (255, 255, 255), -1)
+    cv2.putText(image, '1234567', (90, 98), cv2.FONT_HERSHEY_SIMPLEX, 1.5, (0, 0, 0), 3)
+    lpr_utils.recognize_cascade('warmup.jpg', pipeline['strategies'], pipeline['config_str'], save_crops = False, ocr_mode = pipeline['ocr_mode'], image = image, detector = pipeline['detector'])
+    duration = time.perf_counter() - start
+    logger.info("warmup: pipeline ready in %.3fs", duration)
+    return duration
+
+
+def warmup_worker(pipeline: dict = PIPELINE):
+    """
+    Initializer of the recognition pool processes, a failed warmup only leaves the engine to the first job.
+    """
+    try:
+        warmup(pipeline)
+    except Exception as e:
+        logger.error("warmup: failed: '%s'", e)
+
+
+def recognition_pool(workers: int, pipeline: dict = PIPELINE) -> ProcessPoolExecutor:
+    """
+    Process pool of the job runner. Each process warms up its own OCR engine when it starts: the thread that
+    starts the runner (a request thread) forks them, they do not inherit the engine of the thread that ran warmup.
+    """
+    return ProcessPoolExecutor(max_workers=workers, initializer=warmup_worker, initargs=(pipeline,))
+
+
+def recognize_batch(picture_paths, workers: int = BATCH_WORKERS, pipeline: dict = PIPELINE, camera: str = None):
+    """
+    Runs recognize() for many pictures over a process pool, all taken by the same camera (or None).
+    Yields one result dict per picture in completion order: picture_path, name, status, recognized_txt,
+    small_pictures, timings, strategy, camera and error.
+    """
+    picture_paths = list(picture_paths)
+    if len(picture_paths) == 0:
+        return
+    with ProcessPoolExecutor(max_workers=max(1, min(workers, len(picture_paths)))) as pool:
+        futures = dict((pool.submit(recognize, picture_path, pipeline, None, camera), picture_path) for picture_path in picture_paths)
+        for future in as_completed(futures):
+            picture_path = futures[future]
+            result = {
+                'picture_path': picture_path,
+                'name': os.path.splitext(os.path.basename(picture_path))[0],
+                'status': STATUS_DONE,
+                'recognized_txt': 'None',
+                'small_pictures': [],
+                'timings': {},
+                'strategy': None,
+                'camera': camera,
+                'error': None
+            }
+            try:
+                result['recognized_txt'], result['small_pictures'], result['timings'], result['strategy'] = future.result()
+            except Exception as e:
+                logger.error("recognize_batch: picture_path:'%s' error: '%s'", picture_path, e)
+                result['status'] = STATUS_FAILED
+                result['error'] = str(e)[:256]
+            metrics.observe_recognition(result['timings'], result['status'])
+            yield result
+
+
+def save_batch(results):
+    """
+    Inserts PictureWrapper rows for recognize_batch() results in one transaction.
+    Returns the new rows.
+    """
+    new_pictures = []
+    for result in results:
+        new_picture = PictureWrapper(
+            name = result['name'],
+            picture_path = result['picture_path'],
+            recognized_txt = result['recognized_txt'],
+            status = result['status'],
+            attempts = 1,
+            error = result['error'],
+            content_hash = result.get('content_hash'),
+            strategy = result.get('strategy'),
+            camera = result.get('camera'),
+            video_id = result.get('video_id')
+        )
+        new_picture.set_small_pictures(result['small_pictures'])
+        new_pictures.append(new_picture)
+    db.session.add_all(new_pictures)
+    commit_timings([(new_picture, result['timings']) for new_picture, result in zip(new_pictures, results) if result.get('timings')])
+    logger.debug("save_batch: saved %s pictures", len(new_pictures))
+    return new_pictures
+
+
+def commit_timings(pictures: list):
+    """
+    Commits the session, then stores the timings of the rows, list of (PictureWrapper, timings dict), with the
+    duration of that commit as their db_commit stage. The timings are written by a second, untimed commit.
+    """
+    timings = {}
+    with metrics.timed(timings, 'db_commit'):
+        db.session.commit()
+    metrics.STAGE_SECONDS.observe(timings['db_commit'], stage = 'db_commit')
+    if len(pictures) == 0:
+        return
+    for picture, picture_timings in pictures:
+        picture_timings['db_commit'] = timings['db_commit']
+        picture.timings = metrics.timings_json(picture_timings)
+    db.session.commit()
 
 
 if __name__ == "__main__":
-    ap = argparse.ArgumentParser()
-    ap.add_argument("-i", "--image", required=True,
+    ap = argparse.ArgumentParser(description="Recognize license plates, prints one JSON line per image")
+    source = ap.add_mutually_exclusive_group(required=True)
+    source.add_argument("-i", "--image",
                     help="Path to the image")
-    args = vars(ap.parse_args())
-
-#    recognized_text = alpr.license_plate_recognition(args['image'], None, gaussian_blur, threshold_otsu)
-    recognized_text = alpr.license_plate_recognition(
-        img_path=args['image'],
-        new_size=None,
-#        blurring_method=alpr.bilateral_filter,
-#        binarization_method=alpr.adaptive_threshold
-#        blurring_method=alpr.gaussian_blur,
-#        binarization_method=alpr.adaptive_threshold
-        blurring_method=alpr.median_blur,
-        binarization_method=alpr.adaptive_threshold
-    )
-
-    print("Recognized text: {}",(recognized_text))
-    print(recognized_text)
+    source.add_argument("-d", "--dir",
+                    help="Directory with images, all allowed image files are processed")
+    ap.add_argument("-w", "--workers", type=int, default=BATCH_WORKERS,
+                    help="Number of recognition processes")
+    ap.add_argument("--ocr-mode", choices=['sequential', 'parallel', 'montage'], default=OCR_MODE,
+                    help="OCR candidates one by one or concurrently, see lpr_utils.license_plate_recognition")
+    ap.add_argument("--strategies", default=STRATEGIES,
+                    help="Strategy cascade 'blurring_method:binarization_method:size:budget;...', see config.STRATEGIES")
+    ap.add_argument("--detector", choices=sorted(lpr_utils.DETECTORS), default=PLATE_DETECTOR,
+                    help="Plate detector, see lpr_utils.get_detector")
+    ap.add_argument("--camera",
+                    help="Camera id the images were taken by, see config.CAMERAS")
+    ap.add_argument("--save", action="store_true",
+                    help="Store the results in the pictures DB")
+    args = ap.parse_args()
+    pipeline = dict(PIPELINE, ocr_mode = args.ocr_mode, strategies = lpr_utils.parse_strategies(args.strategies), detector = args.detector)
+
+    if args.image:
+        picture_paths = [args.image]
+    else:
+        picture_paths = sorted(os.path.join(args.dir, f) for f in os.listdir(args.dir) if allowed_file(f))
+
+    results = []
+    for result in recognize_batch(picture_paths, args.workers, pipeline, args.camera):
+        print(json.dumps(result), flush=True)
+        results.append(result)
+
+    if args.save:
+        with app.app_context():
+            upgrade_db()
+            save_batch(results)
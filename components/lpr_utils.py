@@ -1,13 +1,24 @@
 import numpy as np
 import cv2
 import imutils
-import pytesseract
 from PIL import Image
 from typing import Callable
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import namedtuple
+import logging
 import os
+import re
+import time
 
 from components import utils
-from components.config import logger, allowed_file, datetimeformat, PICTURES_FOLDER, ALLOWED_EXTENSIONS, DATE_FORMAT
+from components import ocr_engine
+from components import char_classifier
+from components import metrics
+from components.config import logger, allowed_file, datetimeformat, PICTURES_FOLDER, ALLOWED_EXTENSIONS, DATE_FORMAT, SAVE_CROPS
+from components.config import OCR_MODE, OCR_THREADS, OCR_CONFIDENT, OCR_MONTAGE_HEIGHT, OCR_MONTAGE_PSM, OCR_CLASSIFIER_CONFIDENT
+from components.config import WORK_MAX_SIDE, STRATEGY_MIN_CHARS, CAMERAS
+from components.config import PLATE_MIN_AREA_RATIO, PLATE_MAX_AREA_RATIO, PLATE_MIN_ASPECT, PLATE_MAX_ASPECT, PLATE_ASPECT, PLATE_MIN_RECTANGULARITY, PLATE_MAX_CANDIDATES
+from components.config import PLATE_DETECTOR, PLATE_CASCADE, PLATE_CASCADE_MAX_SIDE, PLATE_CASCADE_MIN_NEIGHBORS
 
 
 def gaussian_blur(image: np.ndarray) -> np.ndarray:
@@ -203,42 +214,277 @@ def preprocess(image: np.ndarray, new_size: tuple, blurring_method: Callable, bi
     return binary_img
 
 
-def plate_contours(image: np.ndarray) -> list:
+def working_image(image: np.ndarray, new_size: tuple, max_side: int) -> tuple:
     """
-    Finding contours on the binarized image.
-    Returns only 10 (or less) the biggest rectangle contours found on the image.
+    Downscales the image to the resolution used for plate detection.
 
     Parameters
     ----------
     image : numpy.ndarray
-       Binarized image as numpy array
+        Image as numpy array
+    new_size  : tuple of integers
+        Explicit (width, height) as in preprocess, None to use max_side
+    max_side : int
+        Longest side of the working image, images that are not bigger are not resized. 0 or None - no limit
 
     Returns
     -------
-    list of numpy.ndarray
-       List of found OpenCV's contours.
+    tuple
+        Working image and its scale relative to the original image (1.0 when not resized)
 
     Contribute
     ----------
-    Finding contours: https://docs.opencv.org/2.4/modules/imgproc/doc/structural_analysis_and_shape_descriptors.html?highlight=findcontours#findcontours
+    Resizing: https://docs.opencv.org/2.4/modules/imgproc/doc/geometric_transformations.html#resize
+    """
+    if new_size is not None:
+        resized = imutils.resize(image, width=new_size[0], height=new_size[1])
+        return (resized, resized.shape[1] / float(image.shape[1]))
+    longest = max(image.shape[:2])
+    if not max_side or longest <= max_side:
+        return (image, 1.0)
+    scale = max_side / float(longest)
+    resized = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    return (resized, scale)
+
+
+def scale_contour(cnt: np.ndarray, scale: float) -> np.ndarray:
+    """
+    Maps a contour found on the working image back to the original image coordinates.
+    """
+    if scale == 1.0:
+        return cnt
+    return np.round(cnt / scale).astype(np.int32)
+
+
+def contour_features(cnts: list) -> tuple:
+    """
+    Area and bounding box of all contours at once.
+    Points of all contours are concatenated and reduced per contour, so the cost is a few NumPy
+    passes instead of a cv2.contourArea and cv2.boundingRect call per contour.
+
+    Parameters
+    ----------
+    cnts : list of numpy.ndarray
+       OpenCV contours
+
+    Returns
+    -------
+    tuple of numpy.ndarray
+       area (same as cv2.contourArea), x, y, w, h (same as cv2.boundingRect) of every contour
+    """
+    lengths = np.fromiter((len(c) for c in cnts), dtype=np.int64, count=len(cnts))
+    points = np.concatenate(cnts).reshape(-1, 2).astype(np.float64)
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    # Shoelace formula, the point after the last point of a contour is its first point
+    following = np.arange(1, len(points) + 1)
+    following[starts + lengths - 1] = starts
+    cross = points[:, 0] * points[following, 1] - points[following, 0] * points[:, 1]
+    area = np.abs(np.add.reduceat(cross, starts)) / 2
+    mins = np.minimum.reduceat(points, starts, axis=0)
+    maxs = np.maximum.reduceat(points, starts, axis=0)
+    return (area, mins[:, 0], mins[:, 1], maxs[:, 0] - mins[:, 0] + 1, maxs[:, 1] - mins[:, 1] + 1)
+
+
+def plate_candidates(image: np.ndarray, max_candidates: int = PLATE_MAX_CANDIDATES, width_range: tuple = None) -> list:
     """
+    Finding plate candidates on the binarized image.
+    Contours are filtered by area (relative to the image), bounding box aspect ratio and rectangularity
+    (contour area / bounding box area) before any polygon approximation. The biggest survivors are
+    selected with a partial sort, approximated and the 4 point polygons are ranked by
+    score = rectangularity * aspect score * relative area, where the aspect score is 1 at PLATE_ASPECT.
+
+    Parameters
+    ----------
+    image : numpy.ndarray
+       Binarized image as numpy array
+    max_candidates : int
+       Maximal number of returned candidates
+    width_range : tuple
+       Expected (min, max) plate bounding box width in pixels, replaces the area ratio limits
+
+    Returns
+    -------
+    list of tuple
+       (OpenCV contour, score) sorted by descending score
+    """
+    # The contour hierarchy is not used, RETR_LIST finds the same contours as RETR_TREE several times faster
     cnts = cv2.findContours(
         image,
-        cv2.RETR_TREE,
+        cv2.RETR_LIST,
         cv2.CHAIN_APPROX_SIMPLE
     )
     cnts = imutils.grab_contours(cnts)
-    cnts = sorted(cnts, key=cv2.contourArea, reverse=True)[:10]
-    plate_cnts = []
+    if len(cnts) == 0:
+        return []
+    area, x, y, w, h = contour_features(cnts)
+    image_area = float(image.shape[0] * image.shape[1])
+    aspect = w / h
+    rectangularity = area / (w * h)
+    if width_range is not None:
+        size = (w >= width_range[0]) & (w <= width_range[1])
+    else:
+        size = (area >= PLATE_MIN_AREA_RATIO * image_area) & (area <= PLATE_MAX_AREA_RATIO * image_area)
+    keep = np.flatnonzero(
+        size &
+        (aspect >= PLATE_MIN_ASPECT) &
+        (aspect <= PLATE_MAX_ASPECT) &
+        (rectangularity >= PLATE_MIN_RECTANGULARITY)
+    )
+    if len(keep) == 0:
+        return []
+    # Not every contour approximates to 4 points, look at a few more than needed
+    selected = 3 * max_candidates
+    if len(keep) > selected:
+        keep = keep[np.argpartition(-area[keep], selected)[:selected]]
+    keep = keep[np.argsort(-area[keep])]
+    aspect_score = np.exp(-2 * np.log(aspect[keep] / PLATE_ASPECT) ** 2)
+    scores = rectangularity[keep] * aspect_score * area[keep] / area[keep[0]]
+
+    candidates = []
+    for i, score in zip(keep, scores):
+        peri = cv2.arcLength(cnts[i], True)
+        approx = cv2.approxPolyDP(cnts[i], 0.02 * peri, True)
+        if len(approx) == 4:
+            candidates.append((approx, float(score)))
+    candidates.sort(key=lambda candidate: candidate[1], reverse=True)
+    return candidates[:max_candidates]
 
-    for c in cnts:
-        peri = cv2.arcLength(c, True)
-        approx = cv2.approxPolyDP(c, 0.02 * peri, True)
 
-        if len(approx) == 4:
-            plate_cnts.append(approx)
+class ContourDetector:
+    """
+    Plate detector of 4 point contours on the binarized working image, see preprocess and plate_candidates.
+    """
+    name = 'contour'
+    # The candidates depend on the blurring and binarization methods of the strategy
+    per_strategy = True
+
+    def detect(self, image: np.ndarray, blurring_method: Callable, binarization_method: Callable, mask: np.ndarray = None, width_range: tuple = None, timings: dict = None) -> list:
+        """
+        Finds plate candidates on the working image.
+
+        Parameters
+        ----------
+        image : numpy.ndarray
+            Working image (BGR colorscale)
+        blurring_method, binarization_method : function
+            See preprocess
+        mask : numpy.ndarray
+            Region of interest, candidates are only searched where the mask is not 0
+        width_range : tuple
+            Expected (min, max) plate width in working image pixels
+        timings : dict
+            Filled with the duration of the stages preprocess and plate_contours
+
+        Returns
+        -------
+        list of tuple
+           (OpenCV contour in working image coordinates, score) sorted by descending score
+        """
+        if timings is None:
+            timings = {}
+        with metrics.timed(timings, 'preprocess'):
+            binary_img = preprocess(image, None, blurring_method, binarization_method)
+            if mask is not None:
+                binary_img = cv2.bitwise_and(binary_img, mask)
+        with metrics.timed(timings, 'plate_contours'):
+            return plate_candidates(binary_img, width_range = width_range)
+
+
+class CascadeDetector:
+    """
+    Plate detector of an OpenCV cascade classifier, e.g. haarcascade_russian_plate_number.xml.
+    The cascade file is not shipped with the application, see config.PLATE_CASCADE.
+    The classifier is loaded once (see get_detector) and runs on a grayscale copy of the working image
+    downscaled to max_side, the blurring and binarization methods are not used.
+    Boxes are ranked by the number of overlapping detections and padded, cascades fit the plate tightly.
+    """
+    name = 'cascade'
+    # The same candidates for every strategy, recognize_cascade detects once
+    per_strategy = False
+    # Padding on every side, fraction of the box width and height
+    padding = (0.05, 0.1)
+    scale_factor = 1.2
+
+    def __init__(self, path: str = PLATE_CASCADE, max_side: int = PLATE_CASCADE_MAX_SIDE, min_neighbors: int = PLATE_CASCADE_MIN_NEIGHBORS):
+        if not path:
+            raise ValueError("The cascade plate detector needs LPR_PLATE_CASCADE, the path of a cascade XML file")
+        if not os.path.exists(path) and hasattr(cv2, 'data'):
+            path = os.path.join(cv2.data.haarcascades, path)
+        self.classifier = cv2.CascadeClassifier(path)
+        if self.classifier.empty():
+            raise ValueError("Can not load plate cascade '{}', set LPR_PLATE_CASCADE to the path of a cascade XML file".format(path))
+        self.max_side = max_side
+        self.min_neighbors = min_neighbors
+
+    def detect(self, image: np.ndarray, blurring_method: Callable = None, binarization_method: Callable = None, mask: np.ndarray = None, width_range: tuple = None, timings: dict = None) -> list:
+        """
+        Finds plate candidates on the working image, see ContourDetector.detect.
+        """
+        if timings is None:
+            timings = {}
+        with metrics.timed(timings, 'preprocess'):
+            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+            gray, scale = working_image(gray, None, self.max_side)
+            gray = cv2.equalizeHist(gray)
+        with metrics.timed(timings, 'plate_contours'):
+            sizes = {}
+            if width_range is not None:
+                min_w, max_w = width_range[0] * scale, width_range[1] * scale
+                sizes = dict(minSize = (max(1, int(min_w)), max(1, int(min_w / PLATE_MAX_ASPECT))),
+                             maxSize = (int(max_w) + 1, int(max_w / PLATE_MIN_ASPECT) + 1))
+            boxes, neighbors = self.classifier.detectMultiScale2(
+                gray,
+                scaleFactor = self.scale_factor,
+                minNeighbors = self.min_neighbors,
+                **sizes
+            )
+            if len(boxes) == 0:
+                return []
+            neighbors = np.ravel(neighbors).astype(np.float64)
+            height, width = image.shape[:2]
+            candidates = []
+            for (x, y, w, h), n in zip(np.asarray(boxes, dtype=np.float64) / scale, neighbors):
+                if mask is not None and mask[min(int(y + h / 2), height - 1), min(int(x + w / 2), width - 1)] == 0:
+                    continue
+                x0 = max(0, int(x - self.padding[0] * w))
+                y0 = max(0, int(y - self.padding[1] * h))
+                x1 = min(width - 1, int(x + w * (1 + self.padding[0])))
+                y1 = min(height - 1, int(y + h * (1 + self.padding[1])))
+                contour = np.array([[[x0, y0]], [[x1, y0]], [[x1, y1]], [[x0, y1]]], dtype=np.int32)
+                candidates.append((contour, float(n / neighbors.max())))
+            candidates.sort(key=lambda candidate: candidate[1], reverse=True)
+            return candidates[:PLATE_MAX_CANDIDATES]
+
+
+DETECTORS = {ContourDetector.name: ContourDetector, CascadeDetector.name: CascadeDetector}
+_detectors = {}
+
+
+def get_detector(name: str = PLATE_DETECTOR):
+    """
+    Plate detector by name, see DETECTORS. Every detector is created once per process (forked workers
+    inherit the detectors of a preloaded master), so the cascade file is not loaded per call.
+    Raises ValueError for an unknown detector or a cascade that can not be loaded.
+    """
+    detector = _detectors.get(name)
+    if detector is None:
+        if name not in DETECTORS:
+            raise ValueError("Unknown plate detector '{}'".format(name))
+        detector = _detectors[name] = DETECTORS[name]()
+    return detector
 
-    return plate_cnts
+
+def check_detectors():
+    """
+    Loads the configured detector and the detectors of all cameras, so that a missing cascade file or
+    an invalid camera fails on startup instead of on every recognition.
+    Raises ValueError, see get_detector and camera_options.
+    """
+    names = {PLATE_DETECTOR}
+    for camera in CAMERAS:
+        names.add(camera_options(camera).get('detector', PLATE_DETECTOR))
+    for name in sorted(names):
+        get_detector(name)
 
 
 def crop_image(original_img: np.ndarray, plate_cnt: np.ndarray) -> np.ndarray:
@@ -295,14 +541,14 @@ def prepare_ocr(image: np.ndarray) -> np.ndarray:
     return image
 
 
-def ocr(img_path: str, config_str: str) -> str:
+def ocr(image: np.ndarray, config_str: str) -> str:
     """
-    Wrapper for Tesseract image_to_string function
+    Wrapper for the OCR engine image_to_string function, see components.ocr_engine
 
     Parameters
     ----------
-    img_path : str
-       Path to the image
+    image : numpy.ndarray
+       Image (BGR colorscale) as numpy array, usually the output of prepare_ocr
     config_str: str
         Config string for tesseract
     Returns
@@ -313,6 +559,7 @@ def ocr(img_path: str, config_str: str) -> str:
     Contribute
     ----------
     PyTesseract: https://pypi.org/project/pytesseract/
+    tesserocr: https://pypi.org/project/tesserocr/
     """
 #    config=r'--oem 3 --psm 13'
 #    tessdata_dir_config = r'--tessdata-dir "/c/work/Enigmatos/Projects/lpr-poc/results"'
@@ -320,73 +567,466 @@ def ocr(img_path: str, config_str: str) -> str:
 #    return pytesseract.image_to_string(Image.open(img_path), config=tessdata_dir_config)
     recognized_txt = ''
     try:
-        recognized_txt = pytesseract.image_to_string(Image.open(img_path), config = config_str)
+        recognized_txt = ocr_engine.image_to_string(Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB)), config_str)
     except Exception as e:
-        logger.debug("ocr: error: e '{}'".format(e))
-    logger.debug("ocr: recognized_txt '{}'".format(recognized_txt))
+        logger.debug("ocr: error: e '%s'", e)
+    logger.debug("ocr: recognized_txt '%s'", recognized_txt)
     return recognized_txt
 #    return pytesseract.image_to_string(Image.open(img_path), config = config_str)
 
 
-def license_plate_recognition(img_path: str, new_size: tuple, blurring_method: Callable, binarization_method: Callable, config_str: str="") -> str:
+def ocr_conf(image: np.ndarray, config_str: str) -> tuple:
+    """
+    Like ocr(), but also returns the OCR engine confidence
+
+    Parameters
+    ----------
+    image : numpy.ndarray
+       Image (BGR colorscale) as numpy array, usually the output of prepare_ocr
+    config_str: str
+        Config string for tesseract
+    Returns
+    -------
+    tuple
+       Text recognized on the image without special characters and confidence 0-100 (-1 for no text)
+    """
+    try:
+        recognized_txt, conf = ocr_engine.image_to_string_conf(Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB)), config_str)
+    except Exception as e:
+        logger.debug("ocr_conf: error: e '%s'", e)
+        return ('', -1.0)
+    recognized_txt = utils.remove_special_chars(recognized_txt)
+    logger.debug("ocr_conf: recognized_txt '%s' conf %s", recognized_txt, conf)
+    return (recognized_txt, conf if len(recognized_txt) > 0 else -1.0)
+
+
+_ocr_pool = None
+_ocr_pool_pid = None
+
+
+def ocr_pool() -> ThreadPoolExecutor:
+    """
+    Thread pool for parallel OCR, Tesseract releases the GIL while recognizing.
+    Every pool thread gets its own OCR engine handle, see ocr_engine.get_engine.
+    """
+    global _ocr_pool, _ocr_pool_pid
+    if _ocr_pool is None or _ocr_pool_pid != os.getpid():
+        _ocr_pool = ThreadPoolExecutor(max_workers=OCR_THREADS, thread_name_prefix="lpr-ocr")
+        _ocr_pool_pid = os.getpid()
+    return _ocr_pool
+
+
+def best_ocr(futures: list, confident: float = OCR_CONFIDENT) -> tuple:
+    """
+    Collects ocr_conf results of candidate crops as they complete.
+    Stops at the first result with confidence >= confident and cancels the candidates that did not start yet.
+
+    Parameters
+    ----------
+    futures : list of concurrent.futures.Future
+       ocr_conf futures, in candidate order
+    confident : float
+        Confidence (0-100) that is good enough to stop
+    Returns
+    -------
+    tuple
+       Most confident text ('None' if no candidate has text), its confidence and candidate index (-1 for none)
+    """
+    best = ('None', -1.0, -1)
+    indexes = dict((future, i) for i, future in enumerate(futures))
+    for future in as_completed(futures):
+        recognized_txt, conf = future.result()
+        if len(recognized_txt) > 0 and conf > best[1]:
+            best = (recognized_txt, conf, indexes[future])
+        if best[1] >= confident:
+            for pending in futures:
+                pending.cancel()
+            break
+    return best
+
+
+def montage(images: list, tile_height: int = OCR_MONTAGE_HEIGHT) -> tuple:
+    """
+    Stacks images vertically as Otsu binarized tiles of tile_height pixels (aspect ratio kept), separated and
+    surrounded by white gaps of half the tile height, so OCR reads every tile as its own text line.
+    Binarization evens out the contrast of the crops, the layout analysis of a montage of raw crops drops most of them.
+
+    Parameters
+    ----------
+    images : list of numpy.ndarray
+       Images (BGR colorscale or grayscale), usually the outputs of prepare_ocr
+    tile_height : int
+        Height of every tile in pixels
+    Returns
+    -------
+    tuple
+       Montage image (binary) and list of (top, bottom) rows of every tile
+    """
+    gap = tile_height // 2
+    tiles = []
+    for image in images:
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+        h, w = gray.shape[:2]
+        interpolation = cv2.INTER_AREA if h > tile_height else cv2.INTER_CUBIC
+        tile = cv2.resize(gray, (max(1, int(round(w * tile_height / h))), tile_height), interpolation=interpolation)
+        tiles.append(cv2.threshold(tile, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[1])
+    canvas = np.full((gap + len(tiles) * (tile_height + gap), max(tile.shape[1] for tile in tiles) + 2 * gap), 255, dtype=np.uint8)
+    rows = []
+    for i, tile in enumerate(tiles):
+        top = gap + i * (tile_height + gap)
+        canvas[top:top + tile_height, gap:gap + tile.shape[1]] = tile
+        rows.append((top, top + tile_height))
+    return (canvas, rows)
+
+
+def montage_config(config_str: str, psm: int = OCR_MONTAGE_PSM) -> str:
+    """
+    config_str with its page segmentation mode replaced by psm, single line modes can not read a montage.
+    """
+    return (re.sub(r'--psm\s+\d+', '', config_str).strip() + ' --psm {}'.format(psm)).strip()
+
+
+def montage_ocr(images: list, config_str: str) -> list:
+    """
+    Recognizes all images with a single OCR call on their montage, words are mapped back to their tile
+    by the center of the word box.
+
+    Parameters
+    ----------
+    images : list of numpy.ndarray
+       Images (BGR colorscale), usually the outputs of prepare_ocr
+    config_str: str
+        Config string for tesseract, see montage_config
+    Returns
+    -------
+    list
+       (text without special characters, mean word confidence 0-100 or -1 for no text) of every image
+    """
+    canvas, rows = montage(images)
+    words = [[] for image in images]
+    try:
+        data = ocr_engine.image_to_data(Image.fromarray(canvas), montage_config(config_str))
+    except Exception as e:
+        logger.debug("montage_ocr: error: e '%s'", e)
+        data = []
+    for text, conf, left, top, width, height in data:
+        center = top + height / 2
+        for i, (row_top, row_bottom) in enumerate(rows):
+            if row_top <= center < row_bottom:
+                words[i].append((left, text, conf))
+                break
+    results = []
+    for tile_words in words:
+        recognized_txt = utils.remove_special_chars(''.join(text for left, text, conf in sorted(tile_words)))
+        conf = sum(conf for left, text, conf in tile_words) / len(tile_words) if len(recognized_txt) > 0 else -1.0
+        results.append((recognized_txt, conf))
+    return results
+
+
+def license_plate_recognition(img_path: str, new_size: tuple, blurring_method: Callable, binarization_method: Callable, config_str: str="", save_crops: bool=SAVE_CROPS, ocr_mode: str=OCR_MODE, work_max_side: int=WORK_MAX_SIDE, timings: dict=None, image: np.ndarray=None, min_chars: int=1, deadline: float=None, roi: np.ndarray=None, plate_width: tuple=None, detector: str=PLATE_DETECTOR) -> str:
     """
     Automatic license plate recognition algorithm.
-    Found license plate is stored in ./results/ directiory as license_plate.jpg
+    Plates are detected on a working image of at most work_max_side pixels (or new_size) and cropped
+    from the full resolution image for OCR.
+    Candidate crops are passed to OCR in memory. With save_crops they are also written next to the image
+    as <name>_<i>.jpg by a background thread, see utils.save_image_async.
 
     Parameters
     ----------
     img_path : str
-       Path to the image
+       Path to the image, crops are saved next to it
     new_size  : tuple of integers
-        First argument of the tuple is new width, second is the new height of the image
+        First argument of the tuple is new width, second is the new height of the working image
     blurring_method : function
         Function as an object. Suggested functions from this module: gaussian_blur, median_blur, bilateral_filter
     binarization_method : function
         Function as an object. Suggested functions from this module: threshold_otsu, adaptive_threshold, canny, auto_canny
     config_str: str=""
         Config string for tesseract
+    work_max_side: int
+        Longest side of the working image when new_size is None, 0 - detect on the full resolution
+    save_crops: bool
+        Save the candidate crops (the small pictures) to disk
+    ocr_mode: str
+        With a character classifier model (see components.char_classifier) every candidate is read by it first
+        and its text of at least min_chars characters is returned when it is confident, OCR only runs otherwise.
+        'sequential' - OCR candidates one by one and return the first text found,
+        'parallel' - OCR all candidates concurrently and return the most confident text, see best_ocr,
+        'montage' - OCR all candidates with one call and return the most confident text of at least
+        min_chars characters, see montage_ocr
+    timings: dict=None
+        Filled with the duration (seconds) of the stages imread, preprocess, plate_contours, crop, prepare_ocr,
+        save, classify and ocr, and the counts candidates and ocr_calls, see components.metrics
+    image: numpy.ndarray=None
+        Already decoded image (BGR colorscale), img_path is not read when given
+    min_chars: int=1
+        In 'sequential' mode OCR continues with the next candidate until a text of at least min_chars
+        characters is found, the longest text is returned otherwise
+    deadline: float=None
+        time.perf_counter() value after which no more candidates are passed to OCR
+    roi: numpy.ndarray=None
+        Polygon (N x 2, relative to the image size 0-1) plates are searched in, the image is cropped to its
+        bounding box before preprocessing and contours outside of it are ignored, see camera_options
+    plate_width: tuple=None
+        Expected (min, max) plate width relative to the image width, see plate_candidates
+    detector: str
+        Plate detector name, 'contour' or 'cascade', see get_detector. The cascade detector does not use
+        the blurring and binarization methods
     Returns
     -------
-    str
-       Text recognized on the image
+    tuple
+       Text recognized on the image and list of the saved crop paths
     """
-    logger.debug("lpr: img_path: '{}' ".format(img_path))
-    image = cv2.imread(img_path)
-    binary_img = preprocess(
-        image,
-        new_size,
-        blurring_method,
-        binarization_method
-    )
+    if timings is None:
+        timings = {}
+    if image is None:
+        with metrics.timed(timings, 'imread'):
+            image = cv2.imread(img_path)
+    image_width = image.shape[1]
+    polygon = None
+    if roi is not None:
+        polygon = np.round(np.asarray(roi) * [image.shape[1], image.shape[0]]).astype(np.int32)
+        x, y, w, h = cv2.boundingRect(polygon)
+        # A view, crops are cut from it at full resolution as from the whole image
+        image = image[y:y + h, x:x + w]
+        polygon -= [x, y]
+    with metrics.timed(timings, 'preprocess'):
+        work_img, scale = working_image(image, new_size, work_max_side)
+        logger.debug("lpr: working image %s scale %.3f img_path: '%s' ", work_img.shape, scale, img_path)
+        mask = None
+        if polygon is not None:
+            mask = np.zeros(work_img.shape[:2], dtype=np.uint8)
+            cv2.fillPoly(mask, [np.round(polygon * scale).astype(np.int32)], 255)
     recognized_txt = 'None'
     small_pictures = []
-    plate_cnts = plate_contours(binary_img)
-    logger.debug("lpr: plate_contours(binary_img) ok img_path: '{}' ".format(img_path))
+    width_range = None
+    if plate_width is not None:
+        width_range = (plate_width[0] * image_width * scale, plate_width[1] * image_width * scale)
+    candidates = get_detector(detector).detect(work_img, blurring_method, binarization_method, mask, width_range, timings)
+    plate_cnts = [scale_contour(c, scale) for c, score in candidates]
+    timings['candidates'] = len(plate_cnts)
+    timings['ocr_calls'] = 0
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("lpr: %s detector ok img_path: '%s' scores: %s", detector, img_path, [round(score, 3) for c, score in candidates])
     if len(plate_cnts) == 0:
-        logger.debug("lpr: len(plate_cnts) == 0, return img_path: '{}' ".format(img_path))
+        logger.debug("lpr: len(plate_cnts) == 0, return img_path: '%s' ", img_path)
         return (recognized_txt, small_pictures)
-    i=0
-    for c in plate_cnts:
-        cropped = crop_image(image, c)
-        logger.debug("lpr: crop_image ok img_path: '{}' ".format(img_path))
-        cropped = prepare_ocr(cropped)
-        logger.debug("lpr: prepare_ocr(cropped) ok img_path: '{}' ".format(img_path))
-
-        picture_dir_name = os.path.dirname(img_path)
-        small_picture_name = os.path.basename(img_path)
-        small_picture_name_no_ext = os.path.splitext(small_picture_name)[0]
-        picture_file_name = small_picture_name_no_ext + "_" + str(i)
-        img_path = utils.save_image_plt(
-            picture_dir_name,
-            picture_file_name,
-            cropped
-        )
-        logger.debug("lpr: save_image_plt picture_dir_name: '{}' picture_file_name: '{}'".format(picture_dir_name, picture_file_name))
-        small_pictures.append(img_path)
-        i=i+1
-        recognized_txt = utils.remove_special_chars(ocr(img_path, config_str))
-        logger.debug("lpr: ocr(img_path, config_str) ok: '{}' '{}'".format(img_path, config_str))
-        if len(recognized_txt) > 0:
-            logger.debug("lpr: ok: (recognized_txt, small_pictures) '{}' '{}'".format(recognized_txt, small_pictures))
+    picture_dir_name = os.path.dirname(img_path)
+    small_picture_name_no_ext = os.path.splitext(os.path.basename(img_path))[0]
+    ocr_futures = []
+    ocr_crops = []
+    best_txt = ''
+    classifier = char_classifier.get_classifier()
+    for i, c in enumerate(plate_cnts):
+        if i > 0 and deadline is not None and time.perf_counter() > deadline:
+            logger.debug("lpr: time budget exceeded after %s of %s candidates img_path: '%s'", i, len(plate_cnts), img_path)
+            break
+        with metrics.timed(timings, 'crop'):
+            cropped = crop_image(image, c)
+        with metrics.timed(timings, 'prepare_ocr'):
+            cropped = prepare_ocr(cropped)
+
+        if save_crops:
+            picture_file_name = small_picture_name_no_ext + "_" + str(i)
+            with metrics.timed(timings, 'save'):
+                small_pictures.append(utils.save_image_async(
+                    picture_dir_name,
+                    picture_file_name,
+                    cropped
+                ))
+        if classifier is not None:
+            with metrics.timed(timings, 'classify'):
+                classified_txt, conf = classifier.read(cropped)
+            if conf >= OCR_CLASSIFIER_CONFIDENT and len(classified_txt) >= max(min_chars, 1):
+                logger.debug("lpr: classifier: '%s' conf %s candidate %s img_path: '%s'", classified_txt, conf, i, img_path)
+                if ocr_mode == 'parallel':
+                    for future in ocr_futures:
+                        future.cancel()
+                    timings['ocr_calls'] = sum(1 for future in ocr_futures if not future.cancelled())
+                return (classified_txt, small_pictures)
+        if ocr_mode == 'parallel':
+            ocr_futures.append(ocr_pool().submit(ocr_conf, cropped, config_str))
+            continue
+        if ocr_mode == 'montage':
+            ocr_crops.append(cropped)
+            continue
+        with metrics.timed(timings, 'ocr'):
+            recognized_txt = utils.remove_special_chars(ocr(cropped, config_str))
+        timings['ocr_calls'] += 1
+        if len(recognized_txt) >= max(min_chars, 1):
+            logger.debug("lpr: ok: (recognized_txt, small_pictures) '%s' '%s'", recognized_txt, small_pictures)
             return (recognized_txt, small_pictures)
+        if len(recognized_txt) > len(best_txt):
+            best_txt = recognized_txt
+    if ocr_mode not in ('parallel', 'montage') and len(best_txt) > 0:
+        recognized_txt = best_txt
+    if ocr_mode == 'montage':
+        with metrics.timed(timings, 'ocr'):
+            results = montage_ocr(ocr_crops, config_str)
+        timings['ocr_calls'] = 1
+        # Long enough texts first, then the most confident
+        best = max(range(len(results)), key=lambda i: (len(results[i][0]) >= min_chars, results[i][1]))
+        if results[best][1] >= 0:
+            recognized_txt = results[best][0]
+        logger.debug("lpr: montage ocr: %s candidate %s of %s", results, best, len(results))
+    if ocr_mode == 'parallel':
+        # OCR already runs while the next candidates are cropped, only the remaining wait is counted
+        with metrics.timed(timings, 'ocr'):
+            recognized_txt, conf, best = best_ocr(ocr_futures)
+        timings['ocr_calls'] = sum(1 for future in ocr_futures if not future.cancelled())
+        logger.debug("lpr: parallel ocr: recognized_txt '%s' conf %s candidate %s of %s", recognized_txt, conf, best, len(ocr_futures))
     return (recognized_txt, small_pictures)
+
+
+def camera_options(camera: str) -> dict:
+    """
+    Detection options of a fixed camera from config.CAMERAS, as keyword arguments of
+    license_plate_recognition and recognize_cascade: roi (numpy array of relative points), plate_width and detector.
+    Returns empty dict for camera None. Raises ValueError for an unknown camera or an invalid definition.
+    """
+    if camera is None:
+        return {}
+    if camera not in CAMERAS:
+        raise ValueError("Unknown camera '{}'".format(camera))
+    options = {}
+    roi = CAMERAS[camera].get('roi')
+    if roi is not None:
+        roi = np.clip(np.asarray(roi, dtype=np.float64), 0.0, 1.0)
+        if roi.ndim != 2 or roi.shape[1] != 2 or len(roi) < 3:
+            raise ValueError("Camera '{}' roi must be a polygon of at least 3 [x, y] points".format(camera))
+        options['roi'] = roi
+    plate_width = CAMERAS[camera].get('plate_width')
+    if plate_width is not None:
+        if len(plate_width) != 2 or not 0 <= plate_width[0] < plate_width[1]:
+            raise ValueError("Camera '{}' plate_width must be [min, max]".format(camera))
+        options['plate_width'] = tuple(plate_width)
+    detector = CAMERAS[camera].get('detector')
+    if detector is not None:
+        if detector not in DETECTORS:
+            raise ValueError("Camera '{}' detector must be one of {}".format(camera, sorted(DETECTORS)))
+        options['detector'] = detector
+    return options
+
+
+# Preprocessing pipeline of the cascade: blurring and binarization method names (functions of this module),
+# new_size or work_max_side of the working image and time budget in seconds (None - unlimited)
+Strategy = namedtuple('Strategy', ['blurring_method', 'binarization_method', 'new_size', 'work_max_side', 'budget'])
+
+
+def parse_strategies(spec: str) -> list:
+    """
+    Parses a strategy cascade 'blurring_method:binarization_method:size:budget;...', see config.STRATEGIES.
+    size is the working image longest side (0 - full resolution) or WxH for a fixed new_size,
+    size and budget may be omitted.
+
+    Parameters
+    ----------
+    spec : str
+        Strategy cascade, e.g. 'median_blur:adaptive_threshold:1024:3;bilateral_filter:canny:0'
+    Returns
+    -------
+    list
+       List of Strategy, in cascade order
+    """
+    strategies = []
+    for item in spec.split(';'):
+        if len(item.strip()) == 0:
+            continue
+        parts = [part.strip() for part in item.split(':')]
+        if len(parts) < 2 or len(parts) > 4:
+            raise ValueError("Invalid strategy '{}'".format(item))
+        for method in parts[:2]:
+            if not callable(globals().get(method)):
+                raise ValueError("Unknown method '{}' in strategy '{}'".format(method, item))
+        new_size, work_max_side, budget = None, WORK_MAX_SIDE, None
+        if len(parts) > 2 and parts[2]:
+            if 'x' in parts[2]:
+                new_size = tuple(int(v) for v in parts[2].split('x'))
+            else:
+                work_max_side = int(parts[2])
+        if len(parts) > 3 and parts[3]:
+            budget = float(parts[3])
+        strategies.append(Strategy(parts[0], parts[1], new_size, work_max_side, budget))
+    return strategies
+
+
+def strategy_name(strategy: Strategy) -> str:
+    """
+    Short strategy name stored with the recognition result, e.g. 'median_blur+adaptive_threshold@1024'.
+    """
+    size = "{}x{}".format(*strategy.new_size) if strategy.new_size else strategy.work_max_side
+    return "{}+{}@{}".format(strategy.blurring_method, strategy.binarization_method, size)
+
+
+def recognize_cascade(img_path: str, strategies: list, config_str: str="", save_crops: bool=SAVE_CROPS, ocr_mode: str=OCR_MODE, timings: dict=None, image: np.ndarray=None, min_chars: int=STRATEGY_MIN_CHARS, roi: np.ndarray=None, plate_width: tuple=None, detector: str=PLATE_DETECTOR) -> tuple:
+    """
+    Runs license_plate_recognition with the strategies in order, cheapest first, until one recognizes
+    a text of at least min_chars characters. Every strategy gets its own time budget.
+    Stage timings of all tried strategies add up, timings['strategies'] is the number of tried strategies.
+    A detector that does not use the preprocessing of the strategies (see CascadeDetector) only runs the first one,
+    the others would detect and read the same candidates again.
+
+    Parameters
+    ----------
+    img_path : str
+        Path to the image, the crops are saved next to it
+    strategies : list
+        List of Strategy, see parse_strategies
+    config_str, save_crops, ocr_mode, timings, image, roi, plate_width, detector
+        See license_plate_recognition
+    min_chars : int
+        Minimal length of a recognized plate
+    Returns
+    -------
+    tuple
+       Text recognized on the image, list of the saved crop paths and name of the strategy that recognized it
+       (None when no strategy did, the text and crops are then those of the last strategy)
+    """
+    if timings is None:
+        timings = {}
+    if image is None:
+        with metrics.timed(timings, 'imread'):
+            image = cv2.imread(img_path)
+    result = ('None', [])
+    saved = set()
+    winner = None
+    timings['strategies'] = 0
+    if not get_detector(detector).per_strategy:
+        strategies = strategies[:1]
+    for strategy in strategies:
+        deadline = time.perf_counter() + strategy.budget if strategy.budget else None
+        attempt = {}
+        result = license_plate_recognition(
+            img_path,
+            strategy.new_size,
+            globals()[strategy.blurring_method],
+            globals()[strategy.binarization_method],
+            config_str,
+            save_crops,
+            ocr_mode,
+            strategy.work_max_side,
+            attempt,
+            image,
+            min_chars,
+            deadline,
+            roi,
+            plate_width,
+            detector
+        )
+        for stage, value in attempt.items():
+            timings[stage] = timings.get(stage, 0) + value
+        timings['strategies'] += 1
+        saved.update(result[1])
+        logger.debug("lpr: strategy '%s' recognized_txt: '%s' img_path: '%s'", strategy_name(strategy), result[0], img_path)
+        if result[0] != 'None' and len(result[0]) >= min_chars:
+            winner = strategy_name(strategy)
+            break
+    # Later strategies overwrite crops with the same names, remove the ones left over from earlier strategies
+    leftovers = saved - set(result[1])
+    if leftovers:
+        with metrics.timed(timings, 'save'):
+            utils.wait_image_writes()
+            for path in leftovers:
+                if os.path.exists(path):
+                    os.remove(path)
+    return (result[0], result[1], winner)
@@ -0,0 +1,314 @@
+"""
+Metrics in the Prometheus text format, see render() and the /metrics route.
+
+Recognition runs in pool processes, they only collect a timings dict (see metrics.timed and
+lpr_utils.license_plate_recognition), which is observed here by the process that stores the result.
+Every process keeps its own values. With METRICS_DIR (gunicorn.conf.py sets it for the web workers) every process
+also writes them to METRICS_DIR/<pid>.json at most every METRICS_FLUSH_INTERVAL seconds and render() adds up
+the values of all processes, so /metrics reports the same totals whichever worker answers. Counters and histograms
+of exited processes are kept, their gauges are zeroed, see mark_process_dead.
+"""
+import atexit
+import glob
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from components import utils
+from components.config import logger, METRICS_DIR, METRICS_FLUSH_INTERVAL
+
+_lock = threading.Lock()
+REGISTRY = []
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name: str, help: str, labelnames: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        # label values -> value
+        self._values = {}
+        REGISTRY.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(label, '') for label in self.labelnames)
+
+    def merge(self, values: dict, other: dict):
+        """
+        Adds the values of another process to values.
+        """
+        for key, value in other.items():
+            values[key] = values.get(key, 0) + value
+
+    def render(self, values: dict) -> list:
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} {}".format(self.name, self.kind)]
+        for key, value in sorted(values.items()):
+            lines.append("{}{} {}".format(self.name, _labels(self.labelnames, key), value))
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, help: str, labelnames: tuple = ()):
+        super().__init__(name, help, labelnames)
+        if not labelnames:
+            self._values[()] = 0
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+        _changed()
+
+    def value(self, **labels) -> float:
+        """
+        Value of this process.
+        """
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, name: str, help: str):
+        super().__init__(name, help)
+        self._values[()] = 0
+
+    def set(self, value: float):
+        self._values[()] = value
+        _changed()
+
+    def value(self) -> float:
+        return self._values[()]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, buckets: tuple, labelnames: tuple = ()):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [bucket counts..., sum, count]
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with _lock:
+            values = self._values.setdefault(key, [0] * (len(self.buckets) + 2))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    values[i] += 1
+            values[-2] += value
+            values[-1] += 1
+        _changed()
+
+    def merge(self, values: dict, other: dict):
+        for key, counts in other.items():
+            values[key] = [a + b for a, b in zip(values[key], counts)] if key in values else list(counts)
+
+    def render(self, values: dict) -> list:
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} histogram".format(self.name)]
+        for key, counts in sorted(values.items()):
+            for bound, count in zip(self.buckets, counts):
+                lines.append("{}_bucket{} {}".format(self.name, _labels(self.labelnames + ('le',), key + (repr(float(bound)),)), count))
+            lines.append("{}_bucket{} {}".format(self.name, _labels(self.labelnames + ('le',), key + ('+Inf',)), counts[-1]))
+            lines.append("{}_sum{} {}".format(self.name, _labels(self.labelnames, key), counts[-2]))
+            lines.append("{}_count{} {}".format(self.name, _labels(self.labelnames, key), counts[-1]))
+        return lines
+
+
+def _labels(names: tuple, values: tuple) -> str:
+    if len(names) == 0:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, value) for name, value in zip(names, values)) + '}'
+
+
+def snapshot() -> dict:
+    """
+    Values of this process, dict of metric name -> list of [label values, value].
+    """
+    with _lock:
+        return dict((metric.name, [[list(key), list(value) if isinstance(value, list) else value] for key, value in metric._values.items()])
+                    for metric in REGISTRY)
+
+
+_dirty = threading.Event()
+_flusher_pid = None
+
+
+def _changed():
+    if not METRICS_DIR:
+        return
+    _dirty.set()
+    if _flusher_pid != os.getpid():
+        _start_flusher()
+
+
+def _start_flusher():
+    global _flusher_pid
+    with _lock:
+        # A forked process does not inherit the flusher thread
+        if _flusher_pid == os.getpid():
+            return
+        _flusher_pid = os.getpid()
+    threading.Thread(target=_flush_loop, name="lpr-metrics-flusher", daemon=True).start()
+
+
+def _flush_loop():
+    while True:
+        _dirty.wait()
+        time.sleep(METRICS_FLUSH_INTERVAL)
+        flush()
+
+
+def flush():
+    """
+    Writes the values of this process to METRICS_DIR/<pid>.json.
+    """
+    if not METRICS_DIR:
+        return
+    _dirty.clear()
+    try:
+        utils.write_file(os.path.join(METRICS_DIR, '{}.json'.format(os.getpid())), json.dumps(snapshot()).encode())
+    except OSError as e:
+        _dirty.set()
+        logger.error("metrics: can not write '%s': '%s'", METRICS_DIR, e)
+
+
+def _flush_at_exit():
+    if _flusher_pid == os.getpid() and _dirty.is_set():
+        flush()
+
+
+def _reset_after_fork():
+    global _lock
+    # A lock held by another thread of the parent is never released in the child
+    _lock = threading.Lock()
+    # The values inherited from the parent are counted by the parent's file
+    for metric in REGISTRY:
+        for key in metric._values:
+            metric._values[key] = [0] * len(metric._values[key]) if isinstance(metric._values[key], list) else 0
+    _dirty.clear()
+
+
+atexit.register(_flush_at_exit)
+if METRICS_DIR:
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def mark_process_dead(pid: int):
+    """
+    Zeroes the gauges of an exited process, its counters and histograms still count.
+    """
+    path = os.path.join(METRICS_DIR, '{}.json'.format(pid))
+    try:
+        with open(path) as f:
+            values = json.load(f)
+    except (OSError, ValueError):
+        return
+    for metric in REGISTRY:
+        if isinstance(metric, Gauge) and metric.name in values:
+            values[metric.name] = [[key, 0] for key, value in values[metric.name]]
+    utils.write_file(path, json.dumps(values).encode())
+
+
+def collect() -> dict:
+    """
+    Values of this process added to those written by the other processes, dict of metric name -> dict of values.
+    """
+    collected = {}
+    for name, values in snapshot().items():
+        collected[name] = dict((tuple(key), value) for key, value in values)
+    if not METRICS_DIR:
+        return collected
+    own = os.path.join(METRICS_DIR, '{}.json'.format(os.getpid()))
+    metrics = dict((metric.name, metric) for metric in REGISTRY)
+    for path in glob.glob(os.path.join(METRICS_DIR, '*.json')):
+        if path == own:
+            continue
+        try:
+            with open(path) as f:
+                other = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for name, values in other.items():
+            if name in metrics:
+                metrics[name].merge(collected.setdefault(name, {}), dict((tuple(key), value) for key, value in values))
+    return collected
+
+
+def render() -> str:
+    lines = []
+    collected = collect()
+    for metric in REGISTRY:
+        lines.extend(metric.render(collected.get(metric.name, {})))
+    return '\n'.join(lines) + '\n'
+
+
+@contextmanager
+def timed(timings: dict, stage: str):
+    """
+    Adds the duration (seconds) of the with block to timings[stage].
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - start
+
+
+STAGE_SECONDS = Histogram('lpr_stage_seconds', 'Duration of recognition pipeline stages per image',
+                          (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30), ('stage',))
+IMAGES = Counter('lpr_images_total', 'Recognized images', ('status',))
+CANDIDATES = Histogram('lpr_candidates_per_image', 'Plate candidates per image', (0, 1, 2, 3, 5, 10))
+OCR_CALLS = Histogram('lpr_ocr_calls_per_image', 'OCR engine calls per image', (0, 1, 2, 3, 5, 10))
+VIDEO_FRAMES = Counter('lpr_video_frames_total', 'Sampled video frames, recognized or skipped as near identical', ('result',))
+STRATEGIES = Histogram('lpr_strategies_per_image', 'Preprocessing strategies tried per image', (1, 2, 3, 5))
+CACHE_HITS = Counter('lpr_cache_hits_total', 'Recognition result cache hits')
+CACHE_MISSES = Counter('lpr_cache_misses_total', 'Recognition result cache misses')
+CACHE_EVICTIONS = Counter('lpr_cache_evictions_total', 'Recognition result cache evicted entries')
+ADMISSION_IN_FLIGHT = Gauge('lpr_admission_in_flight', 'Admitted recognitions not finished yet')
+ADMISSION_MEGAPIXELS = Gauge('lpr_admission_megapixels', 'Decoded image megapixels of the admitted recognitions')
+ADMISSION_WAITING = Gauge('lpr_admission_waiting', 'Requests waiting for admission')
+ADMISSION_ADMITTED = Counter('lpr_admission_admitted_total', 'Admitted requests')
+ADMISSION_REJECTED = Counter('lpr_admission_rejected_total', 'Requests rejected with 503, queue full, wait expired or job backlog', ('reason',))
+ADMISSION_WAIT_SECONDS = Histogram('lpr_admission_wait_seconds', 'Wait of the admitted requests', (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5))
+STORAGE_DELETED_ROWS = Counter('lpr_storage_deleted_rows_total', 'Rows deleted with their files, by the user or the retention', ('reason',))
+STORAGE_REMOVED_FILES = Counter('lpr_storage_removed_files_total', 'Removed pictures, crops and thumbnails', ('reason',))
+STORAGE_REMOVED_BYTES = Counter('lpr_storage_removed_bytes_total', 'Bytes of the removed files', ('reason',))
+
+# Keys of a timings dict that are counts, not durations
+COUNTS = ('candidates', 'ocr_calls', 'strategies', 'frames')
+
+
+def observe_recognition(timings: dict, status: str):
+    """
+    Records the timings dict of one recognized image.
+    """
+    IMAGES.inc(status = status)
+    for stage, value in timings.items():
+        if stage not in COUNTS:
+            STAGE_SECONDS.observe(value, stage = stage)
+    if 'candidates' in timings:
+        CANDIDATES.observe(timings['candidates'])
+        OCR_CALLS.observe(timings.get('ocr_calls', 0))
+    if 'strategies' in timings:
+        STRATEGIES.observe(timings['strategies'])
+
+
+def timings_ms(timings: dict) -> dict:
+    """
+    Timings dict with the durations in milliseconds.
+    """
+    return dict((stage, value if stage in COUNTS else round(value * 1000, 1)) for stage, value in timings.items())
+
+
+def timings_json(timings: dict) -> str:
+    """
+    Timings dict as JSON for the PictureWrapper.timings column, durations in milliseconds.
+    """
+    return json.dumps(timings_ms(timings))
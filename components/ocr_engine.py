@@ -0,0 +1,174 @@
+"""
+OCR engine layer.
+
+TesserocrEngine keeps a Tesseract API handle (libtesseract through tesserocr) open for the lifetime of the
+thread, so the language model is loaded once instead of forking a `tesseract` process for every crop.
+PytesseractEngine is the fallback when tesserocr is not installed or the config string uses options that
+cannot be mapped to the API, pytesseract is imported only then. Engines are cached per thread and per
+config string, use get_engine(); lpr_eng.warmup() creates the engine of the calling thread ahead of the first image.
+"""
+import os
+import shlex
+import threading
+from PIL import Image
+
+from components.config import logger, OCR_ENGINE
+
+try:
+    import tesserocr
+except ImportError:
+    tesserocr = None
+# Imported by the first PytesseractEngine
+pytesseract = None
+
+
+class PytesseractEngine:
+    """
+    Runs the `tesseract` executable through pytesseract, one process per call.
+    """
+    name = 'pytesseract'
+
+    def __init__(self, config_str: str = ""):
+        global pytesseract
+        if pytesseract is None:
+            import pytesseract
+        self.config_str = config_str
+
+    def image_to_string(self, image: Image.Image) -> str:
+        return pytesseract.image_to_string(image, config = self.config_str)
+
+    def image_to_string_conf(self, image: Image.Image) -> tuple:
+        """
+        Returns tuple (text, mean word confidence 0-100), confidence is -1 when nothing was recognized.
+        """
+        words = self.image_to_data(image)
+        if len(words) == 0:
+            return ('', -1.0)
+        return (' '.join(word[0] for word in words), sum(word[1] for word in words) / len(words))
+
+    def image_to_data(self, image: Image.Image) -> list:
+        """
+        Returns list of the recognized words as tuples (text, confidence 0-100, left, top, width, height).
+        """
+        data = pytesseract.image_to_data(image, config = self.config_str, output_type = pytesseract.Output.DICT)
+        return [(word, float(conf), left, top, width, height)
+                for word, conf, left, top, width, height in zip(data['text'], data['conf'], data['left'], data['top'], data['width'], data['height'])
+                if float(conf) >= 0 and word.strip()]
+
+
+class TesserocrEngine:
+    """
+    Persistent in-process Tesseract API handle. Not thread safe, get_engine() returns one handle per thread.
+    Supported config string options: --psm, --oem, -l, --tessdata-dir and -c name=value.
+    """
+    name = 'tesserocr'
+
+    def __init__(self, config_str: str = ""):
+        if tesserocr is None:
+            raise RuntimeError("tesserocr is not installed")
+        self.config_str = config_str
+        options = {'lang': 'eng'}
+        variables = []
+        tessdata = os.environ.get('TESSDATA_PREFIX')
+        if tessdata and os.path.isdir(tessdata):
+            options['path'] = tessdata
+        tokens = shlex.split(config_str)
+        while tokens:
+            token = tokens.pop(0)
+            if token == '--psm' and tokens:
+                options['psm'] = int(tokens.pop(0))
+            elif token == '--oem' and tokens:
+                options['oem'] = int(tokens.pop(0))
+            elif token == '-l' and tokens:
+                options['lang'] = tokens.pop(0)
+            elif token == '--tessdata-dir' and tokens:
+                options['path'] = tokens.pop(0)
+            elif token == '-c' and tokens and '=' in tokens[0]:
+                variables.append(tokens.pop(0).split('=', 1))
+            else:
+                raise ValueError("Unsupported tesseract option '{}'".format(token))
+        self._api = tesserocr.PyTessBaseAPI(**options)
+        for name, value in variables:
+            self._api.SetVariable(name, value)
+
+    def image_to_string(self, image: Image.Image) -> str:
+        self._api.SetImage(image)
+        return self._api.GetUTF8Text()
+
+    def image_to_string_conf(self, image: Image.Image) -> tuple:
+        """
+        Returns tuple (text, mean word confidence 0-100), confidence is -1 when nothing was recognized.
+        """
+        self._api.SetImage(image)
+        text = self._api.GetUTF8Text()
+        if len(text.strip()) == 0:
+            return ('', -1.0)
+        return (text, float(self._api.MeanTextConf()))
+
+    def image_to_data(self, image: Image.Image) -> list:
+        """
+        Returns list of the recognized words as tuples (text, confidence 0-100, left, top, width, height).
+        """
+        self._api.SetImage(image)
+        self._api.Recognize()
+        words = []
+        for word in tesserocr.iterate_level(self._api.GetIterator(), tesserocr.RIL.WORD):
+            try:
+                text = word.GetUTF8Text(tesserocr.RIL.WORD)
+            except RuntimeError:
+                # Raised for an empty page
+                continue
+            box = word.BoundingBox(tesserocr.RIL.WORD)
+            if not text.strip() or box is None:
+                continue
+            left, top, right, bottom = box
+            words.append((text, float(word.Confidence(tesserocr.RIL.WORD)), left, top, right - left, bottom - top))
+        return words
+
+
+ENGINES = {
+    PytesseractEngine.name: PytesseractEngine,
+    TesserocrEngine.name: TesserocrEngine,
+}
+
+_local = threading.local()
+
+
+def create_engine(config_str: str = "", engine: str = OCR_ENGINE):
+    """
+    Creates OCR engine by name: 'tesserocr', 'pytesseract' or 'auto'.
+    'auto' uses tesserocr when it is available and supports the config string, pytesseract otherwise.
+    """
+    if engine != 'auto':
+        return ENGINES[engine](config_str)
+    try:
+        return TesserocrEngine(config_str)
+    except Exception as e:
+        logger.info("ocr_engine: tesserocr not used for config '%s', falling back to pytesseract: '%s'", config_str, e)
+        return PytesseractEngine(config_str)
+
+
+def get_engine(config_str: str = "", engine: str = OCR_ENGINE):
+    """
+    Returns the OCR engine of the calling thread for the config string, creating it on first use.
+    """
+    engines = getattr(_local, 'engines', None)
+    if engines is None:
+        engines = _local.engines = {}
+    key = (engine, config_str)
+    if key not in engines:
+        engines[key] = create_engine(config_str, engine)
+        logger.debug("ocr_engine: created '%s' engine for config '%s'", engines[key].name, config_str)
+    return engines[key]
+
+
+def image_to_string(image: Image.Image, config_str: str = "", engine: str = OCR_ENGINE) -> str:
+    return get_engine(config_str, engine).image_to_string(image)
+
+
+def image_to_string_conf(image: Image.Image, config_str: str = "", engine: str = OCR_ENGINE) -> tuple:
+    return get_engine(config_str, engine).image_to_string_conf(image)
+
+
+def image_to_data(image: Image.Image, config_str: str = "", engine: str = OCR_ENGINE) -> list:
+    return get_engine(config_str, engine).image_to_data(image)
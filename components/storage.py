@@ -0,0 +1,356 @@
+"""
+Storage of the pictures, crops and thumbnails.
+
+A PictureWrapper row owns its picture_path, its crops (crop table) and their thumbnails (components.thumbs).
+Rows may share files: a repeated upload is stored at the same content hash path and gets the same crop names.
+delete_pictures deletes rows with their crops in one transaction and then removes the files no remaining row
+references. A file that can not be removed is an orphan the reaper removes later.
+
+The reaper reconciles the disk with the DB every STORAGE_REAP_INTERVAL seconds:
+- retention: rows older than STORAGE_MAX_AGE_DAYS are deleted, then the oldest rows while the pictures and crops
+  of all rows take more than STORAGE_MAX_BYTES, STORAGE_EVICT_BATCH rows per transaction. Queued jobs are kept,
+- orphans: images in the subdirectories of PICTURES_FOLDER the application creates (content hash shards, video
+  events) and thumbnails no row references, e.g. crops of deleted rows, once they are older than
+  STORAGE_ORPHAN_MIN_AGE seconds (an upload is written before its row is committed), and the empty directories
+  left behind. Files directly in PICTURES_FOLDER (the sample pictures, uploads of older versions) are never orphans,
+  nor the files of queued videos, their events are saved when the video is done.
+The result cache evicts its own links in CACHE_FOLDER, see components.cache.
+
+Standalone reaper:
+    python -m components.storage [--dry-run] [--loop]
+"""
+import argparse
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from components import metrics
+from components import thumbs
+from components.config import db, app, logger, PICTURES_FOLDER, THUMB_FOLDER, THUMB_SIZES, ALLOWED_EXTENSIONS
+from components.config import STORAGE_MAX_AGE_DAYS, STORAGE_MAX_BYTES, STORAGE_EVICT_BATCH, STORAGE_ORPHAN_MIN_AGE, STORAGE_REAP_INTERVAL
+from components.lpr_eng import PictureWrapper, Crop, VideoJob, upgrade_db, STATUS_PENDING, STATUS_RUNNING
+
+QUEUED = (STATUS_PENDING, STATUS_RUNNING)
+
+
+def normalized(path: str) -> str:
+    """
+    Path as found on disk, rows stored on Windows use backslashes.
+    """
+    return os.path.normpath(path.replace('\\', '/'))
+
+
+def _chunks(items: list, size: int):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def row_files(ids: list = None) -> dict:
+    """
+    Returns dict of row id -> list of its stored paths, the picture first and then the crops, for all rows when ids is None.
+    """
+    pictures = db.session.query(PictureWrapper.id, PictureWrapper.picture_path)
+    crops = db.session.query(Crop.picture_id, Crop.path).order_by(Crop.picture_id, Crop.position)
+    queries = [(pictures, crops)] if ids is None else [
+        (pictures.filter(PictureWrapper.id.in_(chunk)), crops.filter(Crop.picture_id.in_(chunk))) for chunk in _chunks(list(ids), STORAGE_EVICT_BATCH)]
+    files = {}
+    for pictures, crops in queries:
+        for id, picture_path in pictures:
+            files[id] = [picture_path]
+        for picture_id, path in crops:
+            files.setdefault(picture_id, []).append(path)
+    return files
+
+
+def referenced_paths(paths: list = None) -> set:
+    """
+    Normalized paths of the pictures and crops of all rows, or only those of paths that rows reference.
+    The paths are looked up with '/' and '\\' separators, rows stored on Windows use backslashes.
+    """
+    if paths is None:
+        referenced = set(normalized(path) for path, in db.session.query(PictureWrapper.picture_path))
+        referenced.update(normalized(path) for path, in db.session.query(Crop.path))
+        return referenced
+    spellings = set()
+    for path in paths:
+        spellings.update((path, path.replace('\\', '/'), path.replace('/', '\\')))
+    referenced = set()
+    # Index lookups (ix_picture_wrapper_picture_path, ix_crop_path), a delete does not read every row
+    for chunk in _chunks(sorted(spellings), STORAGE_EVICT_BATCH):
+        referenced.update(normalized(path) for path, in db.session.query(PictureWrapper.picture_path).filter(PictureWrapper.picture_path.in_(chunk)))
+        referenced.update(normalized(path) for path, in db.session.query(Crop.path).filter(Crop.path.in_(chunk)))
+    return referenced
+
+
+def _remove(path: str, reason: str, dry_run: bool = False):
+    """
+    Removes a file. Returns its size in bytes, None when it does not exist or can not be removed.
+    """
+    try:
+        size = os.path.getsize(path)
+        if not dry_run:
+            os.remove(path)
+    except FileNotFoundError:
+        return None
+    except OSError as e:
+        logger.error("storage: can not remove '%s': '%s'", path, e)
+        return None
+    if dry_run:
+        logger.debug("storage: would remove '%s' (%s)", path, reason)
+        return size
+    metrics.STORAGE_REMOVED_FILES.inc(reason = reason)
+    metrics.STORAGE_REMOVED_BYTES.inc(size, reason = reason)
+    logger.debug("storage: removed '%s' (%s)", path, reason)
+    return size
+
+
+def remove_files(paths: list, reason: str) -> tuple:
+    """
+    Removes pictures or crops and their thumbnails. Returns tuple (removed files, bytes).
+    """
+    files = 0
+    size = 0
+    for path in paths:
+        for file_path in [normalized(path)] + [thumbs.thumb_path(path, thumb_size) for thumb_size in THUMB_SIZES]:
+            removed = _remove(file_path, reason)
+            if removed is not None:
+                files += 1
+                size += removed
+    return (files, size)
+
+
+def delete_pictures(ids: list, reason: str = 'deleted') -> dict:
+    """
+    Deletes the rows and their crops in one transaction, then removes their files no remaining row references.
+    Returns dict with the number of deleted rows, removed files and bytes.
+    """
+    files = row_files(ids)
+    if len(files) == 0:
+        return {'rows': 0, 'files': 0, 'bytes': 0}
+    try:
+        for chunk in _chunks(list(files), STORAGE_EVICT_BATCH):
+            Crop.query.filter(Crop.picture_id.in_(chunk)).delete(synchronize_session=False)
+            PictureWrapper.query.filter(PictureWrapper.id.in_(chunk)).delete(synchronize_session=False)
+        paths = set(path for row_paths in files.values() for path in row_paths)
+        # Files shared with rows that stay
+        referenced = referenced_paths(paths)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    removed_files, removed_bytes = remove_files([path for path in paths if normalized(path) not in referenced], reason)
+    metrics.STORAGE_DELETED_ROWS.inc(len(files), reason = reason)
+    logger.info("storage: deleted %s rows (%s), removed %s files, %s bytes", len(files), reason, removed_files, removed_bytes)
+    return {'rows': len(files), 'files': removed_files, 'bytes': removed_bytes}
+
+
+def expired_ids(max_age_days: float) -> list:
+    """
+    Rows created more than max_age_days ago, oldest first.
+    """
+    cutoff = datetime.utcnow() - timedelta(days = max_age_days)
+    query = db.session.query(PictureWrapper.id).filter(PictureWrapper.created_at < cutoff, PictureWrapper.status.notin_(QUEUED))
+    return [id for id, in query.order_by(PictureWrapper.created_at, PictureWrapper.id)]
+
+
+def over_quota_ids(max_bytes: int) -> tuple:
+    """
+    Oldest rows to delete so the pictures and crops of the remaining rows take at most max_bytes.
+    A file shared by several rows is counted once and freed with the last of them.
+    Returns tuple (row ids, bytes of the pictures and crops of all rows).
+    """
+    files = row_files()
+    references = {}
+    for row_paths in files.values():
+        for path in set(map(normalized, row_paths)):
+            references[path] = references.get(path, 0) + 1
+    sizes = {}
+    for path in references:
+        try:
+            sizes[path] = os.path.getsize(path)
+        except OSError:
+            sizes[path] = 0
+    usage = total = sum(sizes.values())
+    ids = []
+    rows = db.session.query(PictureWrapper.id, PictureWrapper.status).order_by(PictureWrapper.created_at, PictureWrapper.id)
+    for id, status in rows:
+        if total <= max_bytes:
+            break
+        if status in QUEUED:
+            continue
+        ids.append(id)
+        for path in set(map(normalized, files.get(id, []))):
+            references[path] -= 1
+            if references[path] == 0:
+                total -= sizes[path]
+    return (ids, usage)
+
+
+def enforce_retention(max_age_days: float = STORAGE_MAX_AGE_DAYS, max_bytes: int = STORAGE_MAX_BYTES,
+                      batch: int = STORAGE_EVICT_BATCH, dry_run: bool = False) -> dict:
+    """
+    Deletes the expired rows, then the oldest rows over the byte limit, batch rows per transaction.
+    With dry_run only counts the rows that would be deleted.
+    """
+    stats = {'rows': 0, 'files': 0, 'bytes': 0}
+    for reason, limit in (('max_age', max_age_days), ('max_bytes', max_bytes)):
+        if not limit:
+            continue
+        if reason == 'max_age':
+            ids = expired_ids(max_age_days)
+        else:
+            ids, stats['usage_bytes'] = over_quota_ids(max_bytes)
+        if dry_run:
+            stats['rows'] += len(ids)
+            continue
+        for chunk in _chunks(ids, batch):
+            deleted = delete_pictures(chunk, reason)
+            for key in ('rows', 'files', 'bytes'):
+                stats[key] += deleted[key]
+    return stats
+
+
+def reap_orphans(min_age: int = STORAGE_ORPHAN_MIN_AGE, dry_run: bool = False) -> dict:
+    """
+    Removes the images in the subdirectories of PICTURES_FOLDER and the thumbnails no row references that were not
+    modified for min_age seconds, and the empty directories. Returns dict with the number of removed files and bytes.
+    """
+    referenced = referenced_paths()
+    for folder, in db.session.query(VideoJob.folder).filter(VideoJob.status.in_(QUEUED)):
+        if os.path.isdir(folder):
+            referenced.update(normalized(os.path.join(folder, filename)) for filename in os.listdir(folder))
+    thumb_keys = set(thumbs.thumb_key(path) for path in referenced)
+    cutoff = time.time() - min_age
+    stats = {'files': 0, 'bytes': 0}
+    for folder, is_orphan in (
+            (PICTURES_FOLDER, lambda path, filename: os.path.dirname(path) != PICTURES_FOLDER and
+                filename.rsplit('.', 1)[-1].lower() in ALLOWED_EXTENSIONS and normalized(path) not in referenced),
+            # <key>_<size>.<format>, see thumbs.thumb_path
+            (THUMB_FOLDER, lambda path, filename: filename.split('_', 1)[0] not in thumb_keys)):
+        # Bottom up, a directory is empty once its files and subdirectories are removed
+        walk = list(os.walk(folder, topdown=False))
+        # Before removing anything changes them
+        directory_mtimes = dict((root, os.path.getmtime(root)) for root, dirs, filenames in walk)
+        for root, dirs, filenames in walk:
+            for filename in filenames:
+                path = os.path.join(root, filename)
+                try:
+                    if not is_orphan(path, filename) or os.path.getmtime(path) >= cutoff:
+                        continue
+                except FileNotFoundError:
+                    continue
+                removed = _remove(path, 'orphan', dry_run)
+                if removed is not None:
+                    stats['files'] += 1
+                    stats['bytes'] += removed
+            if not dry_run and root != folder and directory_mtimes[root] < cutoff and len(os.listdir(root)) == 0:
+                try:
+                    os.rmdir(root)
+                except OSError:
+                    pass
+    return stats
+
+
+def reap(dry_run: bool = False) -> dict:
+    """
+    Applies the retention, then removes the orphans. Returns dict of their stats.
+    """
+    start = time.perf_counter()
+    result = {
+        'retention': enforce_retention(dry_run = dry_run),
+        'orphans': reap_orphans(dry_run = dry_run),
+        'dry_run': dry_run,
+        'finished_at': datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S")
+    }
+    result['seconds'] = round(time.perf_counter() - start, 3)
+    logger.info("storage: reaped%s, retention %s rows %s files %s bytes, orphans %s files %s bytes in %.1f s",
+                " (dry run)" if dry_run else "", result['retention']['rows'], result['retention']['files'], result['retention']['bytes'],
+                result['orphans']['files'], result['orphans']['bytes'], result['seconds'])
+    return result
+
+
+class Reaper:
+    """
+    Background thread reaping once at start and every `interval` seconds.
+    """
+    def __init__(self, interval: int = STORAGE_REAP_INTERVAL):
+        self.interval = interval
+        self.last = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name="lpr-storage-reaper", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, wait: bool = True):
+        self._stop.set()
+        if wait and self._thread is not None:
+            self._thread.join()
+
+    def run(self):
+        logger.info("storage: reaper started, interval %s s", self.interval)
+        with app.app_context():
+            while not self._stop.is_set():
+                try:
+                    self.last = reap()
+                except Exception as e:
+                    db.session.rollback()
+                    logger.error("storage: reaper error: '%s'", e)
+                finally:
+                    db.session.remove()
+                self._stop.wait(self.interval)
+        logger.info("storage: reaper stopped")
+
+
+_reaper = None
+_reaper_pid = None
+_reaper_lock = threading.Lock()
+
+
+def get_reaper():
+    return _reaper if _reaper_pid == os.getpid() else None
+
+
+def ensure_reaper(interval: int = STORAGE_REAP_INTERVAL):
+    """
+    Starts the reaper of this process if it is not running yet, a forked child starts its own.
+    """
+    global _reaper, _reaper_pid
+    with _reaper_lock:
+        if get_reaper() is None:
+            _reaper = Reaper(interval).start()
+            _reaper_pid = os.getpid()
+    return _reaper
+
+
+def stats() -> dict:
+    reaper = get_reaper()
+    return {
+        'max_age_days': STORAGE_MAX_AGE_DAYS,
+        'max_bytes': STORAGE_MAX_BYTES,
+        'orphan_min_age': STORAGE_ORPHAN_MIN_AGE,
+        'reap_interval': STORAGE_REAP_INTERVAL,
+        'deleted_rows': dict((reason, metrics.STORAGE_DELETED_ROWS.value(reason = reason)) for reason in ('deleted', 'max_age', 'max_bytes')),
+        'removed_files': dict((reason, metrics.STORAGE_REMOVED_FILES.value(reason = reason)) for reason in ('deleted', 'max_age', 'max_bytes', 'orphan')),
+        'last_reap': reaper.last if reaper is not None else None
+    }
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Delete expired rows and remove orphaned pictures, crops and thumbnails")
+    ap.add_argument("--dry-run", action="store_true",
+                    help="Only report what would be deleted")
+    ap.add_argument("--loop", action="store_true",
+                    help="Keep reaping every LPR_STORAGE_REAP_INTERVAL seconds")
+    args = ap.parse_args()
+
+    with app.app_context():
+        upgrade_db()
+    if args.loop:
+        Reaper().run()
+    else:
+        with app.app_context():
+            print(reap(dry_run = args.dry_run))
@@ -0,0 +1,84 @@
+"""
+Thumbnails of uploads and crops.
+
+The listing shows thumbnails instead of the full resolution uploads. They are generated once, by the
+recognition worker from the already decoded image (see lpr_eng.recognize): every size of THUMB_SIZES for
+the upload, CROP_THUMB_SIZE for the crops.
+A thumbnail is named after a hash of its source path, so it is found without a DB column:
+THUMB_FOLDER/<hh>/<sha1 of source path>_<size>.<THUMB_FORMAT>. Rows recognized before, or filled from the
+result cache, get their thumbnails on the first request, see ensure_thumb.
+"""
+import hashlib
+import os
+import cv2
+import numpy as np
+
+from components import utils
+from components.config import logger, THUMB_FOLDER, THUMB_SIZES, THUMB_FORMAT, THUMB_QUALITY
+
+MIMETYPES = {'webp': 'image/webp', 'jpg': 'image/jpeg'}
+# Size the listing shows the crops in
+CROP_THUMB_SIZE = 's'
+
+
+def thumb_key(source_path: str) -> str:
+    return hashlib.sha1(source_path.replace('\\', '/').encode()).hexdigest()
+
+
+def thumb_path(source_path: str, size: str) -> str:
+    key = thumb_key(source_path)
+    return utils.sharded_path(THUMB_FOLDER, key, "{}_{}.{}".format(key, size, THUMB_FORMAT), 1)
+
+
+def thumbnail(image: np.ndarray, max_side: int) -> np.ndarray:
+    """
+    Downscales the image to at most max_side pixels on the longest side, smaller images are not enlarged.
+    """
+    h, w = image.shape[:2]
+    scale = max_side / max(h, w)
+    if scale >= 1:
+        return image
+    return cv2.resize(image, (max(1, int(round(w * scale))), max(1, int(round(h * scale)))), interpolation=cv2.INTER_AREA)
+
+
+def encode(image: np.ndarray) -> bytes:
+    if THUMB_FORMAT == 'webp':
+        params = [cv2.IMWRITE_WEBP_QUALITY, THUMB_QUALITY]
+    else:
+        params = [cv2.IMWRITE_JPEG_QUALITY, THUMB_QUALITY]
+    ok, buffer = cv2.imencode('.' + THUMB_FORMAT, image, params)
+    if not ok:
+        raise ValueError("Can not encode thumbnail as '{}'".format(THUMB_FORMAT))
+    return buffer.tobytes()
+
+
+def make_thumbs(source_path: str, image: np.ndarray = None, sizes: dict = THUMB_SIZES) -> list:
+    """
+    Writes the thumbnails of all sizes, largest first so every size is downscaled from the previous one.
+    image is the decoded source, it is read from source_path when not given.
+    Returns list of the thumbnail paths, empty when the source can not be read.
+    """
+    if image is None:
+        image = cv2.imread(source_path)
+        if image is None:
+            logger.error("thumbs: can not read '%s'", source_path)
+            return []
+    paths = []
+    for size, max_side in sorted(sizes.items(), key=lambda item: -item[1]):
+        image = thumbnail(image, max_side)
+        paths.append(utils.write_file(thumb_path(source_path, size), encode(image)))
+    return paths
+
+
+def ensure_thumb(source_path: str, size: str) -> str:
+    """
+    Returns path of the thumbnail, generating it when it does not exist yet.
+    Returns None when the source does not exist.
+    """
+    path = thumb_path(source_path, size)
+    if os.path.exists(path):
+        return path
+    if not os.path.exists(source_path) or len(make_thumbs(source_path, sizes = {size: THUMB_SIZES[size]})) == 0:
+        return None
+    logger.debug("thumbs: generated '%s' thumbnail of '%s'", size, source_path)
+    return path
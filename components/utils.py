@@ -1,15 +1,39 @@
 import csv
-import cv2
+import io
 import os
-import matplotlib.pyplot as plt
-import numpy as np
+import atexit
 import logging
+import logging.handlers
+import multiprocessing.util
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 
 def remove_special_chars(text: str) -> str:
     return ''.join(e for e in text if e.isalnum() and (e.isdigit() or e.isupper()))
 
 
+# Characters OCR confuses with digits, mapped to the digit in plate keys
+PLATE_CONFUSIONS = str.maketrans({'O': '0', 'Q': '0', 'D': '0', 'I': '1', 'L': '1', 'B': '8', 'S': '5', 'Z': '2', 'G': '6'})
+
+
+def plate_key(text: str) -> str:
+    """
+    Normalized plate text for fuzzy search: special characters removed and letters OCR confuses with
+    digits replaced by the digit, e.g. 'I2O-B5' and '120 85' both give '12085'.
+    Returns None for an empty text or the 'None' of an image without a plate.
+    """
+    if text is None or text == 'None':
+        return None
+    key = remove_special_chars(text.upper()).translate(PLATE_CONFUSIONS)
+    return key if len(key) > 0 else None
+
+
 def print_progress_bar(iteration, total, prefix='', suffix='', decimals=1, length=100, fill='█', print_end="\r"):
     """
     Call in a loop to create terminal progress bar
@@ -33,7 +57,53 @@ def print_progress_bar(iteration, total, prefix='', suffix='', decimals=1, lengt
         print()
 
 
+def upload_buffer(file):
+    """
+    Returns the content of an uploaded werkzeug FileStorage as a buffer, without copying it when
+    the upload is kept in memory (see config.UploadRequest).
+    """
+    if hasattr(file.stream, 'getbuffer'):
+        return file.stream.getbuffer()
+    return file.read()
+
+
+# cv2, numpy and PIL are imported by the helpers that use them, components.config imports this module without needing them
+
+
+def decode_image(data):
+    """
+    Decodes an encoded image (bytes, bytearray or memoryview) to a BGR numpy array like cv2.imread.
+    Returns None when the data is not a supported image.
+    """
+    import cv2
+    import numpy as np
+    return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+
+def image_pixels(source) -> int:
+    """
+    Number of pixels of an encoded image (bytes, bytearray, memoryview or a path) from its header, without
+    decoding it. Returns 0 when the image can not be read.
+    """
+    from PIL import Image
+    try:
+        with Image.open(source if isinstance(source, str) else io.BytesIO(source)) as image:
+            return image.width * image.height
+    except Exception:
+        return 0
+
+
+def sharded_path(folder, key, filename, depth=2):
+    """
+    Path of filename in a directory tree sharded by the first characters of key (a hex hash),
+    e.g. folder/3e/71/filename for depth 2.
+    """
+    shards = [key[2 * i:2 * i + 2] for i in range(depth)]
+    return os.path.join(folder, *(shards + [filename]))
+
+
 def save_image_cv2(path, name, image):
+    import cv2
     if not os.path.exists(path):
         os.makedirs(path)
     img_path = "{}/{}.jpg".format(path, name)
@@ -41,7 +111,73 @@ def save_image_cv2(path, name, image):
     return img_path
 
 
+_image_writer = None
+_image_writer_pid = None
+
+
+def image_writer():
+    global _image_writer, _image_writer_pid
+    # A forked process does not inherit the writer thread
+    if _image_writer is None or _image_writer_pid != os.getpid():
+        _image_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="lpr-image-writer")
+        _image_writer_pid = os.getpid()
+    return _image_writer
+
+
+def save_image_async(path, name, image):
+    """
+    Queues cv2.imwrite of the image on a background thread and returns the path it will be written to.
+    Call wait_image_writes() before relying on the file.
+    """
+    img_path = "{}/{}.jpg".format(path, name)
+    image_writer().submit(save_image_cv2, path, name, image)
+    return img_path
+
+
+def write_file(path, data):
+    """
+    Writes data to a temporary file renamed to path, readers never see a partially written file.
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    return path
+
+
+def remove_file(path):
+    """
+    Removes the file if it exists.
+    """
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def write_file_async(path, data):
+    """
+    Queues writing of data to path on the image writer thread, see save_image_async.
+    """
+    image_writer().submit(write_file, path, data)
+    return path
+
+
+def wait_image_writes():
+    """
+    Blocks until all images queued by save_image_async are written.
+    """
+    if _image_writer is not None and _image_writer_pid == os.getpid():
+        # Single writer thread, so the marker completes after all previously queued writes
+        _image_writer.submit(lambda: None).result()
+
+
 def save_image_plt(path, name, image):
+    # matplotlib takes longer to import than the rest of the application, only this helper needs it
+    import matplotlib.pyplot as plt
     if not os.path.exists(path):
         os.makedirs(path)
     img_path = "{}/{}.jpg".format(path, name)
@@ -50,33 +186,119 @@ def save_image_plt(path, name, image):
                )
     return img_path
 
-def init_logger():
-    # global logger_name
-    # logger_name = "lpr_eng"
-    log_format ='%(asctime)s %(name)-12s %(levelname)-8s %(message)s'
-    filename='lpr_eng.log'
-    logger_name = "lpr_eng"
-
-    logging.basicConfig(level = logging.DEBUG,
-                     format = log_format,
-                     datefmt = '%m-%d %H:%M',
-                     filename = 'lpr_eng.log',
-                     filemode = 'w')
-    logger = logging.getLogger(logger_name)
-    #logger.setLevel(logging.DEBUG)
-    # create file handler which logs even debug messages
-    fh = logging.FileHandler('lpr_eng.log')
-    fh.setLevel(logging.DEBUG)
-    # create console handler with a higher log level
-    ch = logging.StreamHandler()
-    ch.setLevel(logging.DEBUG)
-    # create formatter and add it to the handlers
-    formatter = logging.Formatter(log_format)
-    fh.setFormatter(formatter)
-    ch.setFormatter(formatter)
-    # add the handlers to the logger
-    logger.addHandler(fh)
-    logger.addHandler(ch)
-
-    logging.getLogger(logger_name).info("Logger initiated (%s)" % (logger_name))
+
+class SharedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """
+    RotatingFileHandler for a log file written by several processes (gunicorn workers, recognition pool
+    processes): every process appends to the file, it is rotated under an exclusive lock of <filename>.lock
+    and a process that finds the file rotated by another one reopens it instead of rotating it again.
+    Without fcntl (Windows) it rotates like RotatingFileHandler.
+    """
+    def _open(self):
+        stream = super()._open()
+        stat = os.fstat(stream.fileno())
+        self._file_id = (stat.st_dev, stat.st_ino)
+        return stream
+
+    def _reopen_if_rotated(self):
+        try:
+            stat = os.stat(self.baseFilename)
+            if self.stream is not None and (stat.st_dev, stat.st_ino) == self._file_id:
+                return
+        except FileNotFoundError:
+            pass
+        if self.stream is not None:
+            self.stream.close()
+        self.stream = self._open()
+
+    def shouldRollover(self, record):
+        self._reopen_if_rotated()
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        if fcntl is None:
+            return super().doRollover()
+        with open(self.baseFilename + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                file_id = self._file_id
+                self._reopen_if_rotated()
+                # Another process rotated the file while this one waited for the lock
+                if self._file_id == file_id:
+                    super().doRollover()
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queues records as they are: the queue does not leave the process, so the message is %-formatted
+    by the listener thread instead of the logging thread.
+    """
+    def prepare(self, record):
+        return record
+
+
+_log_handler = None
+_log_listener = None
+_log_listener_pid = None
+
+
+def _start_log_listener(handlers: list):
+    global _log_listener, _log_listener_pid
+    _log_handler.queue = queue.SimpleQueue()
+    _log_listener = logging.handlers.QueueListener(_log_handler.queue, *handlers, respect_handler_level=True)
+    _log_listener_pid = os.getpid()
+    _log_listener.start()
+
+
+def _restart_log_listener():
+    # A forked child inherits the handler but not the listener thread
+    if _log_listener is not None and _log_listener_pid != os.getpid():
+        _start_log_listener(_log_listener.handlers)
+
+
+def _finalize_child_logging(handler):
+    # multiprocessing children exit without atexit handlers, but run multiprocessing finalizers
+    multiprocessing.util.Finalize(None, stop_logging, exitpriority=-100)
+
+
+def stop_logging():
+    """
+    Writes the queued records and stops the listener thread of this process.
+    """
+    global _log_listener
+    if _log_listener is not None and _log_listener_pid == os.getpid():
+        _log_listener.stop()
+        _log_listener = None
+
+
+def init_logger(level: str = 'INFO', filename: str = 'lpr_eng.log', max_bytes: int = 10 * 1024 * 1024, backup_count: int = 5, console: bool = True) -> logging.Logger:
+    """
+    Configures logging once per process: the root logger gets a single queue handler, a background
+    listener thread writes the records to a rotating file (appended to, not truncated on start, shared by the
+    processes, see SharedRotatingFileHandler) and the console.
+    Forked children start their own listener. Returns the application logger 'lpr_eng'.
+    """
+    global _log_handler
+    logger = logging.getLogger('lpr_eng')
+    if _log_handler is not None:
+        return logger
+    formatter = logging.Formatter('%(asctime)s %(name)-12s %(levelname)-8s %(process)d %(message)s')
+    handlers = []
+    if filename:
+        handlers.append(SharedRotatingFileHandler(filename, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8'))
+    if console:
+        handlers.append(logging.StreamHandler())
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    _log_handler = LogQueueHandler(None)
+    _start_log_listener(handlers)
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(_log_handler)
+    atexit.register(stop_logging)
+    os.register_at_fork(after_in_child=_restart_log_listener)
+    multiprocessing.util.register_after_fork(_log_handler, _finalize_child_logging)
+    logger.info("Logger initiated (level %s, file '%s')", level, filename)
     return logger
@@ -0,0 +1,324 @@
+"""
+Video and frame stream ingestion.
+
+Frames of a video file, camera or stream URL (anything cv2.VideoCapture opens, e.g. rtsp:// or an MJPEG
+http:// stream) are sampled at VIDEO_SAMPLE_FPS; skipped frames are grabbed but not decoded. A sampled frame
+whose difference hash is close to the last recognized frame is not recognized again. Recognized plates are
+merged into events: the same plate (plate keys within VIDEO_MERGE_DISTANCE edits) seen again within
+VIDEO_EVENT_GAP seconds belongs to the open event. Every event becomes one PictureWrapper row, with the
+most frequently recognized text and the frame it was first recognized in.
+
+An uploaded video (POST /video) is stored in a new event folder and queued as a VideoJob row, the job runner
+ingests it in one of its processes (see ingest_video and jobs.JobRunner) and saves its events when it is done.
+
+    python -m components.video --source <video file, camera index or stream URL> [--sample-fps 2] [--camera id] [--save]
+"""
+import argparse
+import json
+import os
+import time
+import uuid
+from collections import Counter
+import cv2
+import numpy as np
+
+from components import lpr_utils
+from components import metrics
+from components import thumbs
+from components import utils
+from components.config import app, logger, THUMB_SIZES, STRATEGY_MIN_CHARS
+from components.config import VIDEO_SAMPLE_FPS, VIDEO_DEDUP_DISTANCE, VIDEO_EVENT_GAP, VIDEO_MERGE_DISTANCE, VIDEO_FOLDER
+from components.lpr_eng import PIPELINE, STATUS_DONE, upgrade_db, save_batch
+
+
+def frame_hash(frame: np.ndarray) -> int:
+    """
+    64 bit difference hash: sign of the horizontal gradients of the frame downscaled to 9x8 grayscale.
+    """
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+    small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int(np.packbits(bits).view('>u8')[0])
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count('1')
+
+
+def edit_distance(a: str, b: str) -> int:
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        previous = current
+    return previous[-1]
+
+
+def event_folder(root: str = VIDEO_FOLDER) -> str:
+    """
+    New folder for the frames and crops of one video, a video of the same name or a repeated upload
+    does not overwrite the files of earlier events.
+    """
+    return os.path.join(root, uuid.uuid4().hex)
+
+
+def open_capture(source: str) -> cv2.VideoCapture:
+    """
+    Opens a video file, stream URL or camera index (a number).
+    """
+    capture = cv2.VideoCapture(int(source) if source.isdigit() else source)
+    if not capture.isOpened():
+        raise ValueError("Can not open video source '{}'".format(source))
+    return capture
+
+
+def frame_pixels(source: str) -> int:
+    """
+    Number of pixels of a frame of the video, 0 when it can not be opened.
+    """
+    capture = cv2.VideoCapture(int(source) if source.isdigit() else source)
+    try:
+        return int(capture.get(cv2.CAP_PROP_FRAME_WIDTH) * capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    finally:
+        capture.release()
+
+
+def sample_frames(capture: cv2.VideoCapture, sample_fps: float = VIDEO_SAMPLE_FPS):
+    """
+    Yields tuples (frame index, seconds from the start, frame) of frames at most sample_fps per second
+    (0 - every frame). Video time comes from the frame rate, wall clock time is used for streams without one.
+    """
+    fps = capture.get(cv2.CAP_PROP_FPS)
+    if not 0 < fps < 1000:
+        fps = 0
+    start = time.monotonic()
+    next_sample = 0.0
+    index = -1
+    while capture.grab():
+        index += 1
+        seconds = index / fps if fps else time.monotonic() - start
+        if seconds < next_sample:
+            continue
+        if sample_fps > 0:
+            next_sample = seconds + 1.0 / sample_fps
+        ok, frame = capture.retrieve()
+        if ok:
+            yield (index, seconds, frame)
+
+
+class PlateEvent:
+    """
+    One plate seen in consecutive frames. Keeps the first frame and crops of every recognized text,
+    the event's picture is the one of the most frequent text.
+    """
+    def __init__(self, key: str, seconds: float, camera: str = None):
+        self.key = key
+        self.camera = camera
+        self.first_seen = seconds
+        self.last_seen = seconds
+        self.votes = Counter()
+        self.frames = {}
+        self.timings = {}
+
+    def matches(self, key: str, seconds: float) -> bool:
+        return seconds - self.last_seen <= VIDEO_EVENT_GAP and edit_distance(key, self.key) <= VIDEO_MERGE_DISTANCE
+
+    def add(self, recognized_txt: str, seconds: float, index: int, frame: np.ndarray, small_pictures: list, strategy: str, timings: dict) -> list:
+        """
+        Adds a recognized frame. Returns list of crop paths that are not needed.
+        """
+        self.votes[recognized_txt] += 1
+        self.last_seen = seconds
+        for stage, value in timings.items():
+            self.timings[stage] = self.timings.get(stage, 0) + value
+        self.timings['frames'] = self.timings.get('frames', 0) + 1
+        if recognized_txt in self.frames:
+            return small_pictures
+        self.frames[recognized_txt] = (index, frame, small_pictures, strategy)
+        return []
+
+    def close(self, name: str, folder: str) -> tuple:
+        """
+        Writes the event's frame and its thumbnails.
+        Returns tuple (result dict for lpr_eng.save_batch, list of crop paths that are not needed).
+        """
+        # Most frequent text, the longer one on a tie
+        recognized_txt = max(self.votes, key=lambda text: (self.votes[text], len(text)))
+        index, frame, small_pictures, strategy = self.frames[recognized_txt]
+        picture_path = "{}/{}_{}.jpg".format(folder, name, index)
+        utils.write_file(picture_path, cv2.imencode('.jpg', frame)[1].tobytes())
+        thumbs.make_thumbs(picture_path, frame)
+        for small_picture in small_pictures:
+            thumbs.make_thumbs(small_picture, sizes = {thumbs.CROP_THUMB_SIZE: THUMB_SIZES[thumbs.CROP_THUMB_SIZE]})
+        unused = [path for text, (i, f, crops, s) in self.frames.items() if text != recognized_txt for path in crops]
+        result = {
+            'picture_path': picture_path,
+            'name': "{}@{:02d}:{:02d}".format(name, int(self.first_seen) // 60, int(self.first_seen) % 60)[:80],
+            'status': STATUS_DONE,
+            'recognized_txt': recognized_txt,
+            'small_pictures': small_pictures,
+            'timings': self.timings,
+            'strategy': strategy,
+            'camera': self.camera,
+            'error': None,
+            'first_seen': round(self.first_seen, 2),
+            'last_seen': round(self.last_seen, 2),
+            'frames': self.timings['frames'],
+            'votes': dict(self.votes)
+        }
+        return (result, unused)
+
+
+def remove_files(paths: list):
+    if len(paths) == 0:
+        return
+    utils.wait_image_writes()
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def ingest(source: str, name: str = None, folder: str = None, pipeline: dict = PIPELINE, sample_fps: float = VIDEO_SAMPLE_FPS, stats: dict = None, camera: str = None, frames: list = None):
+    """
+    Recognizes plates in a video file or stream, yields one result dict per plate event as the event ends
+    (see lpr_eng.save_batch, plus first_seen, last_seen, frames and votes).
+    Frames and crops of the events are stored in folder, a new event_folder() by default.
+
+    Parameters
+    ----------
+    source : str
+        Video file, stream URL or camera index
+    name : str
+        Name of the events, the video file name by default
+    camera : str
+        Fixed camera of the video, detection is limited to its ROI and plate size, see lpr_utils.camera_options
+    stats : dict
+        Filled with the counts of read, sampled, skipped (near identical) and recognized frames and events
+    frames : list
+        When given, the timings dict of every recognized frame is appended to it instead of being recorded
+        in the metrics of this process, see observe_frames
+    """
+    options = dict({'detector': pipeline['detector']}, **lpr_utils.camera_options(camera))
+    if stats is None:
+        stats = {}
+    for key in ('frames', 'sampled', 'skipped', 'recognized', 'events'):
+        stats[key] = 0
+    if name is None:
+        name = os.path.splitext(os.path.basename(source.rstrip('/')))[0] or 'stream'
+    if folder is None:
+        folder = event_folder()
+    os.makedirs(folder, exist_ok=True)
+    capture = open_capture(source)
+    event = None
+    last_hash = None
+    last_had_plate = False
+    try:
+        for index, seconds, frame in sample_frames(capture, sample_fps):
+            stats['frames'] = index + 1
+            stats['sampled'] += 1
+            if event is not None and seconds - event.last_seen > VIDEO_EVENT_GAP:
+                result, unused = event.close(name, folder)
+                remove_files(unused)
+                stats['events'] += 1
+                event = None
+                yield result
+            h = frame_hash(frame)
+            if last_hash is not None and hamming(h, last_hash) <= VIDEO_DEDUP_DISTANCE:
+                stats['skipped'] += 1
+                if frames is None:
+                    metrics.VIDEO_FRAMES.inc(result = 'skipped')
+                # The car is still there
+                if event is not None and last_had_plate:
+                    event.last_seen = seconds
+                continue
+            last_hash = h
+            timings = {}
+            recognized_txt, small_pictures, strategy = lpr_utils.recognize_cascade(
+                "{}/{}_{}.jpg".format(folder, name, index),
+                pipeline['strategies'],
+                pipeline['config_str'],
+                ocr_mode = pipeline['ocr_mode'],
+                timings = timings,
+                image = frame,
+                **options
+            )
+            stats['recognized'] += 1
+            if frames is None:
+                metrics.VIDEO_FRAMES.inc(result = 'recognized')
+                metrics.observe_recognition(timings, STATUS_DONE)
+            else:
+                frames.append(timings)
+            key = utils.plate_key(recognized_txt)
+            last_had_plate = strategy is not None and key is not None and len(key) >= STRATEGY_MIN_CHARS
+            if not last_had_plate:
+                remove_files(small_pictures)
+                continue
+            logger.debug("video: '%s' frame %s at %.2fs recognized_txt: '%s'", name, index, seconds, recognized_txt)
+            if event is not None and not event.matches(key, seconds):
+                result, unused = event.close(name, folder)
+                remove_files(unused)
+                stats['events'] += 1
+                event = None
+                yield result
+            if event is None:
+                event = PlateEvent(key, seconds, camera)
+            remove_files(event.add(recognized_txt, seconds, index, frame, small_pictures, strategy, timings))
+        if event is not None:
+            result, unused = event.close(name, folder)
+            remove_files(unused)
+            stats['events'] += 1
+            yield result
+    finally:
+        capture.release()
+        utils.wait_image_writes()
+    logger.info("video: '%s' done: %s", name, stats)
+
+
+def ingest_video(video_path: str, name: str, folder: str, pipeline: dict = PIPELINE, camera: str = None) -> tuple:
+    """
+    Ingests a queued video in a job runner process, see jobs.JobRunner.
+    Returns tuple (list of event result dicts, stats dict, list of the timings dicts of the recognized frames),
+    the runner saves the events and records the frames with observe_frames.
+    """
+    stats = {}
+    frames = []
+    results = list(ingest(video_path, name, folder, pipeline, stats = stats, camera = camera, frames = frames))
+    return (results, stats, frames)
+
+
+def observe_frames(stats: dict, frames: list):
+    """
+    Records the skipped frames counted in stats and the timings dicts of the recognized frames.
+    """
+    if stats['skipped'] > 0:
+        metrics.VIDEO_FRAMES.inc(stats['skipped'], result = 'skipped')
+    for timings in frames:
+        metrics.VIDEO_FRAMES.inc(result = 'recognized')
+        metrics.observe_recognition(timings, STATUS_DONE)
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Recognize license plates in a video or stream, prints one JSON line per plate event")
+    ap.add_argument("-s", "--source", required=True,
+                    help="Video file, camera index or stream URL")
+    ap.add_argument("-n", "--name",
+                    help="Name of the events, the video file name by default")
+    ap.add_argument("--sample-fps", type=float, default=VIDEO_SAMPLE_FPS,
+                    help="Frames per second to sample, 0 - every frame")
+    ap.add_argument("--camera",
+                    help="Camera id of the video, see config.CAMERAS")
+    ap.add_argument("--save", action="store_true",
+                    help="Store the events in the pictures DB as they end")
+    args = ap.parse_args()
+
+    if args.save:
+        with app.app_context():
+            upgrade_db()
+    stats = {}
+    for result in ingest(args.source, args.name, sample_fps = args.sample_fps, stats = stats, camera = args.camera):
+        if args.save:
+            with app.app_context():
+                result['id'] = save_batch([result])[0].id
+        print(json.dumps(dict(result, timings = metrics.timings_ms(result['timings']))), flush=True)
+    print(json.dumps({'stats': stats}), flush=True)
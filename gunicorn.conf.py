@@ -0,0 +1,57 @@
+"""
+gunicorn settings, see Procfile.
+
+With preload_app (LPR_PRELOAD=1, the default) the master imports the application and warms up the recognition
+pipeline once (OpenCV, the OCR engine, lpr_eng.warmup), workers are forked from it ready to serve instead of
+each paying the import and model loading time. Pooled DB connections opened by the master (upgrade_db) are
+closed before the fork and a worker discards whatever it inherited, so no connection is shared between processes.
+The OCR engine is thread local: the master's engine serves the requests of the sync workers (video ingestion),
+the recognition processes of a worker's job runner warm up their own when the runner starts (lpr_eng.recognition_pool).
+Without preload every worker imports the application itself, as before.
+Every worker keeps its own metrics, they are added up over LPR_METRICS_DIR (a temporary directory unless set),
+so /metrics reports the totals of all workers, see components.metrics.
+"""
+import glob
+import os
+import shutil
+import tempfile
+
+preload_app = os.environ.get('LPR_PRELOAD', '1') == '1'
+# Before the application is imported, the workers inherit it
+metrics_dir_created = 'LPR_METRICS_DIR' not in os.environ
+if metrics_dir_created:
+    os.environ['LPR_METRICS_DIR'] = tempfile.mkdtemp(prefix='lpr-metrics-')
+
+
+def on_starting(server):
+    # Values of a previous run in a configured LPR_METRICS_DIR
+    os.makedirs(os.environ['LPR_METRICS_DIR'], exist_ok=True)
+    for path in glob.glob(os.path.join(os.environ['LPR_METRICS_DIR'], '*.json')):
+        os.remove(path)
+
+
+def when_ready(server):
+    # The master, after loading the application and before forking the workers
+    if not preload_app:
+        return
+    from components.config import dispose_engines
+    from components.lpr_eng import warmup
+    warmup()
+    dispose_engines()
+
+
+def post_fork(server, worker):
+    if not preload_app:
+        return
+    from components.config import dispose_engines
+    dispose_engines(close = False)
+
+
+def child_exit(server, worker):
+    from components.metrics import mark_process_dead
+    mark_process_dead(worker.pid)
+
+
+def on_exit(server):
+    if metrics_dir_created:
+        shutil.rmtree(os.environ['LPR_METRICS_DIR'], ignore_errors=True)
@@ -0,0 +1,79 @@
+"""
+Tests run against a temporary SQLite database, set up before components.config is imported:
+
+    python -m pytest -q
+"""
+import os
+import shutil
+import tempfile
+
+import pytest
+
+TMP_DIR = tempfile.mkdtemp(prefix='lpr-tests-')
+DB_PATH = os.path.join(TMP_DIR, 'test.db')
+os.environ['LPR_DATABASE_URI'] = 'sqlite:///' + DB_PATH
+os.environ['LPR_LOG_FILE'] = ''
+os.environ['LPR_LOG_CONSOLE'] = '0'
+os.environ['LPR_CACHE_ENABLED'] = '0'
+os.environ['LPR_JOB_RUNNER_EMBEDDED'] = '0'
+os.environ['LPR_STORAGE_REAPER_EMBEDDED'] = '0'
+
+from components.config import db, app
+from components.lpr_eng import upgrade_db
+
+# Database of the first release: picture_wrapper only, crops in the small_pictures column
+BASELINE_DB = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'static', 'test_pictures.db')
+
+
+def reset_database(source: str = None):
+    """
+    Closes the connections and replaces the database file with a copy of source, or removes it.
+    """
+    db.engine.dispose()
+    for suffix in ('', '-wal', '-shm', '-journal'):
+        if os.path.exists(DB_PATH + suffix):
+            os.remove(DB_PATH + suffix)
+    if source is not None:
+        shutil.copyfile(source, DB_PATH)
+
+
+@pytest.fixture
+def app_context():
+    with app.app_context():
+        yield
+        db.session.remove()
+
+
+@pytest.fixture
+def database(app_context):
+    """
+    Empty database with the current schema.
+    """
+    reset_database()
+    upgrade_db()
+    yield db
+
+
+@pytest.fixture
+def baseline_database(app_context):
+    """
+    Copy of the first release database, not upgraded.
+    """
+    reset_database(BASELINE_DB)
+    yield db
+
+
+def pytest_sessionfinish(session, exitstatus):
+    with app.app_context():
+        db.engine.dispose()
+    shutil.rmtree(TMP_DIR, ignore_errors=True)
+
+
+@pytest.fixture
+def client(database, tmp_path, monkeypatch):
+    """
+    Test client of the web application, uploads are stored under tmp_path.
+    """
+    import app as web
+    monkeypatch.setitem(app.config, 'UPLOAD_FOLDER', str(tmp_path / 'pictures_photo'))
+    return web.app.test_client()
@@ -0,0 +1,139 @@
+import functools
+import io
+import os
+import threading
+import time
+from concurrent.futures import Future
+
+import cv2
+import numpy as np
+import pytest
+
+from components import admission
+from components import jobs
+from components import metrics
+from components.admission import AdmissionController, Overloaded
+from components.lpr_eng import PictureWrapper, STATUS_DONE, STATUS_FAILED
+
+
+def waiting(controller, count, timeout=5):
+    deadline = time.monotonic() + timeout
+    while controller.stats()['waiting'] != count:
+        assert time.monotonic() < deadline
+        time.sleep(0.005)
+
+
+def acquire_in_thread(controller, results, name, **kwargs):
+    def acquire():
+        try:
+            controller.acquire(**kwargs)
+            results.append(name)
+        except Overloaded as e:
+            results.append(e.reason)
+    thread = threading.Thread(target=acquire)
+    thread.start()
+    return thread
+
+
+def test_admits_within_limits():
+    controller = AdmissionController(max_in_flight=2, max_megapixels=10, max_waiting=0, wait=0)
+    controller.acquire(1, 4000000)
+    controller.acquire(1, 4000000)
+    assert controller.stats()['in_flight'] == 2
+    controller.release(1, 4000000)
+    controller.release(1, 4000000)
+    assert controller.stats()['in_flight'] == 0 and controller.stats()['megapixels'] == 0
+
+
+def test_oversized_request_admitted_when_idle():
+    controller = AdmissionController(max_in_flight=1, max_megapixels=1, max_waiting=0, wait=0)
+    controller.acquire(3, 50000000)
+    with pytest.raises(Overloaded):
+        controller.acquire(1, 0)
+
+
+def test_queue_full():
+    controller = AdmissionController(max_in_flight=1, max_megapixels=0, max_waiting=1, wait=5, retry_after=7)
+    controller.acquire()
+    results = []
+    thread = acquire_in_thread(controller, results, 'waiter')
+    waiting(controller, 1)
+    with pytest.raises(Overloaded) as e:
+        controller.acquire()
+    assert e.value.reason == 'queue_full' and e.value.retry_after == 7
+    controller.release()
+    thread.join()
+    assert results == ['waiter']
+
+
+def test_timeout():
+    controller = AdmissionController(max_in_flight=1, max_megapixels=0, max_waiting=1, wait=0.05)
+    controller.acquire()
+    start = time.monotonic()
+    with pytest.raises(Overloaded) as e:
+        controller.acquire()
+    assert e.value.reason == 'timeout'
+    assert time.monotonic() - start >= 0.05
+    # The expired request left the queue
+    assert controller.stats()['waiting'] == 0 and controller.stats()['in_flight'] == 1
+
+
+def test_waiters_admitted_in_order():
+    controller = AdmissionController(max_in_flight=1, max_megapixels=0, max_waiting=2, wait=5)
+    controller.acquire()
+    results = []
+    first = acquire_in_thread(controller, results, 'first')
+    waiting(controller, 1)
+    second = acquire_in_thread(controller, results, 'second')
+    waiting(controller, 2)
+    controller.release()
+    first.join()
+    assert results == ['first']
+    controller.release()
+    second.join()
+    assert results == ['first', 'second']
+    controller.release()
+    assert controller.stats()['in_flight'] == 0
+
+
+@pytest.fixture
+def upload(client):
+    data = cv2.imencode('.jpg', np.zeros((30, 40, 3), dtype=np.uint8))[1].tobytes()
+
+    def upload():
+        return client.post('/', data = {'file': (io.BytesIO(data), 'car.jpg')}, headers = {'Accept': 'application/json'})
+    return upload
+
+
+def test_upload_admitted_until_queued(database, upload, monkeypatch):
+    # This process runs a runner (not started), another runner claims and finishes the job
+    monkeypatch.setattr(jobs, '_runner', jobs.JobRunner(1))
+    monkeypatch.setattr(jobs, '_runner_pid', os.getpid())
+    response = upload()
+    assert response.status_code == 202
+    assert admission.controller.stats()['in_flight'] == 0
+    other = jobs.JobRunner(1)
+    job_id, picture_path, camera = other._claim_next()
+    assert job_id == response.get_json()['id']
+    future = Future()
+    future.set_result(('A123BC', [], {'ocr': 0.01}, 'median_blur+adaptive_threshold'))
+    other._in_flight[future] = job_id
+    other._collect()
+    assert database.session.get(PictureWrapper, job_id).status == STATUS_DONE
+    assert admission.controller.stats()['in_flight'] == 0
+
+
+def test_backlog_rejects_uploads_of_every_runner(database, upload, monkeypatch):
+    monkeypatch.setattr(jobs, 'check_backlog', functools.partial(jobs.check_backlog, 2))
+    assert upload().status_code == 202
+    first = upload()
+    assert first.status_code == 202
+    rejected = metrics.ADMISSION_REJECTED.value(reason = 'backlog')
+    response = upload()
+    assert response.status_code == 503 and response.get_json()['reason'] == 'backlog'
+    assert response.headers['Retry-After'] == str(admission.controller.retry_after)
+    assert metrics.ADMISSION_REJECTED.value(reason = 'backlog') == rejected + 1
+    # A job failed by any runner leaves the backlog
+    PictureWrapper.query.filter(PictureWrapper.id == first.get_json()['id']).update({'status': STATUS_FAILED})
+    database.session.commit()
+    assert upload().status_code == 202
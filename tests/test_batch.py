@@ -0,0 +1,55 @@
+import io
+import json
+import os
+import zipfile
+
+import app as web
+from components.lpr_eng import PictureWrapper, STATUS_DONE
+
+
+def fake_recognize_batch(picture_paths, workers, camera=None):
+    for picture_path in picture_paths:
+        yield {'picture_path': picture_path, 'name': os.path.splitext(os.path.basename(picture_path))[0], 'status': STATUS_DONE,
+               'recognized_txt': 'A123BC', 'small_pictures': [], 'timings': {'ocr': 0.25, 'candidates': 2}, 'strategy': None,
+               'camera': camera, 'error': None}
+
+
+def zip_file(files: dict) -> io.BytesIO:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        for name, data in files.items():
+            archive.writestr(name, data)
+    buffer.seek(0)
+    return buffer
+
+
+def post_batch(client, files):
+    response = client.post('/batch', data = {'files': files}, content_type = 'multipart/form-data')
+    return response, [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+
+def test_batch_ndjson(client, monkeypatch):
+    monkeypatch.setattr(web, 'recognize_batch', fake_recognize_batch)
+    archive = zip_file({'a/plate.jpg': b'first', 'b/plate.jpg': b'second', 'notes.txt': b'not an image'})
+    response, lines = post_batch(client, [(archive, 'images.zip'), (io.BytesIO(b'third'), 'car.png')])
+    assert response.status_code == 200 and response.mimetype == 'application/x-ndjson'
+    results, summary = lines[:-1], lines[-1]
+    assert len(results) == 3 and summary['saved'] == 3
+    # Images of the same name are stored apart, under their content hash
+    paths = [result['picture_path'] for result in results]
+    assert len(set(paths)) == 3 and all(os.path.exists(path) for path in paths)
+    # Milliseconds, counts as they are
+    assert all(result['timings'] == {'ocr': 250.0, 'candidates': 2} for result in results)
+    rows = PictureWrapper.query.filter(PictureWrapper.id.in_(summary['ids'])).all()
+    assert sorted(row.picture_path for row in rows) == sorted(paths)
+    assert all(row.recognized_txt == 'A123BC' and row.content_hash for row in rows)
+
+
+def test_batch_without_images(client):
+    response, lines = post_batch(client, [(io.BytesIO(b'text'), 'notes.txt')])
+    assert response.status_code == 400
+
+
+def test_batch_bad_zip(client):
+    response, lines = post_batch(client, [(io.BytesIO(b'not a zip'), 'images.zip')])
+    assert response.status_code == 400 and lines[0]['error'] == 'Bad zip file'
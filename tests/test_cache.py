@@ -0,0 +1,76 @@
+import os
+
+import pytest
+
+from components import cache
+from components.lpr_eng import PIPELINE
+
+
+@pytest.fixture
+def cache_folder(tmp_path, monkeypatch):
+    folder = str(tmp_path / 'pictures_cache')
+    monkeypatch.setattr(cache, 'CACHE_FOLDER', folder)
+    return folder
+
+
+def write(path, data=b'crop'):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
+
+
+def test_content_hash_is_the_byte_hash():
+    assert cache.content_hash(b'image') == cache.content_hash(bytearray(b'image'))
+    assert cache.content_hash(b'image') != cache.content_hash(b'other image')
+
+
+def test_cache_key_changes_with_the_settings(tmp_path, monkeypatch):
+    key = cache.cache_key(cache.content_hash(b'image'))
+    assert cache.cache_key(cache.content_hash(b'image')) == key
+    assert cache.cache_key(cache.content_hash(b'other image')) != key
+    assert cache.cache_key(cache.content_hash(b'image'), camera = 'gate1') != key
+    assert cache.cache_key(cache.content_hash(b'image'), dict(PIPELINE, ocr_mode = 'montage' if PIPELINE['ocr_mode'] != 'montage' else 'sequential')) != key
+    # A trained or retrained classifier model invalidates the cached texts
+    model = str(tmp_path / 'chars.npz')
+    monkeypatch.setattr(cache, 'OCR_CLASSIFIER_MODEL', model)
+    assert cache.cache_key(cache.content_hash(b'image')) == key
+    write(model, b'model')
+    trained = cache.cache_key(cache.content_hash(b'image'))
+    assert trained != key
+    os.utime(model, ns = (1, 1))
+    assert cache.cache_key(cache.content_hash(b'image')) != trained
+
+
+def test_store_and_lookup(database, cache_folder, tmp_path):
+    crops = [write(str(tmp_path / 'a' / 'first_0.jpg')), write(str(tmp_path / 'a' / 'first_1.jpg'), b'second crop')]
+    key = cache.cache_key(cache.content_hash(b'image'))
+    cache.store(key, 'A123BC', crops)
+    picture_path = str(tmp_path / 'b' / 'again.jpg')
+    os.makedirs(os.path.dirname(picture_path))
+    recognized_txt, small_pictures = cache.lookup(key, picture_path)
+    assert recognized_txt == 'A123BC'
+    assert small_pictures == [str(tmp_path / 'b' / 'again_0.jpg'), str(tmp_path / 'b' / 'again_1.jpg')]
+    with open(small_pictures[1], 'rb') as f:
+        assert f.read() == b'second crop'
+    assert cache.lookup(cache.cache_key(cache.content_hash(b'other image')), picture_path) is None
+
+
+def test_lookup_drops_entry_without_crops(database, cache_folder, tmp_path):
+    key = cache.cache_key(cache.content_hash(b'image'))
+    cache.store(key, 'A123BC', [write(str(tmp_path / 'first_0.jpg'))])
+    for cached_picture in os.listdir(cache_folder):
+        os.remove(os.path.join(cache_folder, cached_picture))
+    assert cache.lookup(key, str(tmp_path / 'again.jpg')) is None
+    assert cache.RecognitionCache.query.count() == 0
+
+
+def test_evict_least_recently_used(database, cache_folder, tmp_path):
+    keys = [cache.cache_key(cache.content_hash(str(i).encode())) for i in range(3)]
+    for i, key in enumerate(keys):
+        cache.store(key, str(i), [write(str(tmp_path / '{}_0.jpg'.format(i)))])
+    # The first entry is used again, the second is the least recently used
+    assert cache.lookup(keys[0], str(tmp_path / 'again.jpg')) is not None
+    assert cache.evict(max_entries = 2, max_bytes = 10 ** 9) == 1
+    assert sorted(entry.content_hash for entry in cache.RecognitionCache.query) == sorted([keys[0], keys[2]])
+    assert not os.path.exists(os.path.join(cache_folder, '{}_0.jpg'.format(keys[1])))
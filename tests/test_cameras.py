@@ -0,0 +1,84 @@
+import cv2
+import numpy as np
+import pytest
+
+from components import lpr_utils
+
+
+@pytest.fixture
+def cameras(monkeypatch):
+    cameras = {
+        'gate1': {'roi': [[0.25, 0.5], [0.75, 0.5], [0.75, 1.2], [0.5, 1.0]], 'plate_width': [0.1, 0.3]},
+        'plain': {},
+        'cascade': {'detector': 'cascade'}
+    }
+    monkeypatch.setattr(lpr_utils, 'CAMERAS', cameras)
+    return cameras
+
+
+def test_camera_options(cameras):
+    assert lpr_utils.camera_options(None) == {}
+    assert lpr_utils.camera_options('plain') == {}
+    assert lpr_utils.camera_options('cascade') == {'detector': 'cascade'}
+    options = lpr_utils.camera_options('gate1')
+    # Points outside the image are clipped to its border
+    assert options['roi'].tolist() == [[0.25, 0.5], [0.75, 0.5], [0.75, 1.0], [0.5, 1.0]]
+    assert options['plate_width'] == (0.1, 0.3)
+    with pytest.raises(ValueError):
+        lpr_utils.camera_options('unknown')
+
+
+@pytest.mark.parametrize('definition', [
+    {'roi': [[0, 0], [1, 1]]},
+    {'roi': [0.1, 0.2, 0.3]},
+    {'plate_width': [0.3, 0.1]},
+    {'plate_width': [0.1]},
+    {'detector': 'yolo'},
+])
+def test_camera_options_invalid(cameras, definition):
+    cameras['bad'] = definition
+    with pytest.raises(ValueError):
+        lpr_utils.camera_options('bad')
+
+
+class RecordingDetector:
+    per_strategy = True
+
+    def detect(self, work_img, blurring_method, binarization_method, mask, width_range, timings):
+        self.work_img = work_img
+        self.mask = mask
+        self.width_range = width_range
+        return []
+
+
+def test_roi_limits_detection(cameras, monkeypatch):
+    detector = RecordingDetector()
+    monkeypatch.setattr(lpr_utils, 'get_detector', lambda name: detector)
+    image = np.zeros((400, 800, 3), dtype=np.uint8)
+    result = lpr_utils.license_plate_recognition('car.jpg', None, lpr_utils.median_blur, lpr_utils.adaptive_threshold,
+                                                 save_crops=False, work_max_side=200, image=image, **lpr_utils.camera_options('gate1'))
+    assert result == ('None', [])
+    # Bounding box of the ROI (400x200 pixels) downscaled to the working size
+    assert detector.work_img.shape[:2] == (100, 200)
+    assert detector.mask.shape == (100, 200)
+    assert detector.mask[50, 100] == 255
+    # The slanted left edge leaves the bottom left corner outside
+    assert detector.mask[95, 5] == 0 and detector.mask[95, 195] == 255
+    # Plate width relative to the whole image, in working image pixels
+    assert detector.width_range == pytest.approx((0.1 * 800 * 0.5, 0.3 * 800 * 0.5), rel = 0.01)
+
+
+def test_plate_width_filters_candidates():
+    binary = np.zeros((300, 600), dtype=np.uint8)
+    cv2.rectangle(binary, (20, 20), (80, 40), 255, -1)
+    cv2.rectangle(binary, (200, 100), (440, 180), 255, -1)
+    widths = lambda candidates: sorted(cv2.boundingRect(c)[2] for c, score in candidates)
+    assert len(lpr_utils.plate_candidates(binary)) == 2
+    assert widths(lpr_utils.plate_candidates(binary, width_range = (100, 300))) == [241]
+    assert widths(lpr_utils.plate_candidates(binary, width_range = (40, 90))) == [61]
+
+
+def test_unknown_camera_rejected(client):
+    response = client.post('/batch', data = {'camera': 'unknown'})
+    assert response.status_code == 400
+    assert 'unknown' in response.get_json()['error']
@@ -0,0 +1,47 @@
+import cv2
+import imutils
+import numpy as np
+
+from components import lpr_utils
+
+
+def shapes_image() -> np.ndarray:
+    image = np.zeros((400, 600), dtype=np.uint8)
+    # A plate-like rectangle (aspect 3), a square, a rotated rectangle, a triangle and noise
+    cv2.rectangle(image, (100, 250), (340, 330), 255, -1)
+    cv2.rectangle(image, (420, 40), (520, 140), 255, -1)
+    cv2.fillPoly(image, [cv2.boxPoints(((200, 100), (150, 40), 20)).astype(np.int32)], 255)
+    cv2.fillPoly(image, [np.array([[450, 300], [560, 380], [430, 390]], dtype=np.int32)], 255)
+    rng = np.random.default_rng(0)
+    image[rng.integers(0, 400, 200), rng.integers(0, 600, 200)] = 255
+    return image
+
+
+def test_contour_features_match_cv2():
+    cnts = imutils.grab_contours(cv2.findContours(shapes_image(), cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE))
+    area, x, y, w, h = lpr_utils.contour_features(cnts)
+    assert np.allclose(area, [cv2.contourArea(c) for c in cnts])
+    assert np.array_equal(np.stack([x, y, w, h], axis=1), np.array([cv2.boundingRect(c) for c in cnts], dtype=np.float64))
+
+
+def test_plate_candidates_rank_the_plate_first():
+    candidates = lpr_utils.plate_candidates(shapes_image())
+    assert len(candidates) >= 1
+    assert [score for contour, score in candidates] == sorted((score for contour, score in candidates), reverse=True)
+    contour, score = candidates[0]
+    assert len(contour) == 4
+    assert cv2.boundingRect(contour) == (100, 250, 241, 81)
+    # The square scores far below the plate, the triangle does not approximate to 4 points
+    assert all(score < 0.5 for contour, score in candidates[1:])
+    assert all(cv2.boundingRect(contour)[1] < 300 for contour, score in candidates[1:])
+
+
+def test_plate_candidates_width_range():
+    image = shapes_image()
+    assert lpr_utils.plate_candidates(image, width_range = (300, 400)) == []
+    candidates = lpr_utils.plate_candidates(image, width_range = (200, 260))
+    assert [cv2.boundingRect(contour) for contour, score in candidates] == [(100, 250, 241, 81)]
+
+
+def test_plate_candidates_empty_image():
+    assert lpr_utils.plate_candidates(np.zeros((100, 100), dtype=np.uint8)) == []
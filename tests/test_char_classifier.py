@@ -0,0 +1,52 @@
+import cv2
+import numpy as np
+
+from components import char_classifier
+
+
+def plate(text: str, shift: int = 0) -> np.ndarray:
+    """
+    Light plate crop with dark characters of one font, spaced apart and narrowed like plate characters.
+    """
+    image = np.full((60, 30 + 36 * len(text), 3), 235, dtype=np.uint8)
+    for i, character in enumerate(text):
+        cv2.putText(image, character, (15 + shift + 36 * i, 47), cv2.FONT_HERSHEY_SIMPLEX, 1.4, (20, 20, 20), 3)
+    return cv2.resize(image, (int(image.shape[1] * 0.6), image.shape[0]), interpolation=cv2.INTER_AREA)
+
+
+def write_plates(tmp_path, texts: list) -> list:
+    samples = []
+    for i, text in enumerate(texts):
+        path = str(tmp_path / 'crop_{}.png'.format(i))
+        cv2.imwrite(path, plate(text, shift = 2 * (i % 2)))
+        samples.append((path, text))
+    return samples
+
+
+def test_segment_plate_characters():
+    assert len(char_classifier.segment(plate('A123BC'))) == 6
+    assert char_classifier.segment(np.full((60, 200, 3), 235, dtype=np.uint8)) == []
+
+
+def test_train_save_load_round_trip(tmp_path):
+    samples = write_plates(tmp_path, ['A123BC', 'K456EH', 'M789OP', 'T012XY', 'A345KM', 'B678CE'])
+    # A crop segmented into fewer glyphs than its text is not used, nor one without a text
+    samples += [(samples[0][0], 'A123BCD'), (samples[1][0], '')]
+    glyphs, characters, used = char_classifier.training_glyphs(samples)
+    assert used == 6 and len(glyphs) == len(characters) == 36
+    classifier = char_classifier.CharClassifier.train(glyphs, characters)
+    path = str(tmp_path / 'models' / 'chars.npz')
+    classifier.save(path)
+    loaded = char_classifier.CharClassifier.load(path)
+    assert loaded.labels.tolist() == classifier.labels.tolist()
+    assert loaded.reject_distance == classifier.reject_distance
+    assert np.allclose(loaded.features, classifier.features, atol = 1e-3)
+    text, confidence = loaded.read(plate('B345AC', shift = 2))
+    assert text == 'B345AC' and confidence > 0
+    assert loaded.read(np.full((60, 200, 3), 235, dtype=np.uint8)) == ('', -1.0)
+
+
+def test_get_classifier_without_model(tmp_path, monkeypatch):
+    monkeypatch.setattr(char_classifier, '_classifier', None)
+    monkeypatch.setattr(char_classifier, '_classifier_loaded', False)
+    assert char_classifier.get_classifier(str(tmp_path / 'missing.npz')) is None
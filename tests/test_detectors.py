@@ -0,0 +1,104 @@
+import numpy as np
+import pytest
+
+from components import lpr_utils
+
+
+@pytest.fixture
+def detectors(monkeypatch):
+    """
+    Detectors created by the test only.
+    """
+    monkeypatch.setattr(lpr_utils, '_detectors', {})
+    monkeypatch.setattr(lpr_utils, 'CAMERAS', {})
+
+
+def test_get_detector_once_per_process(detectors):
+    detector = lpr_utils.get_detector('contour')
+    assert isinstance(detector, lpr_utils.ContourDetector)
+    assert lpr_utils.get_detector('contour') is detector
+    with pytest.raises(ValueError):
+        lpr_utils.get_detector('yolo')
+
+
+def test_cascade_needs_a_cascade_file(detectors, tmp_path):
+    with pytest.raises(ValueError, match='LPR_PLATE_CASCADE'):
+        lpr_utils.CascadeDetector('')
+    with pytest.raises(ValueError, match='Can not load'):
+        lpr_utils.CascadeDetector(str(tmp_path / 'missing.xml'))
+
+
+def test_check_detectors_of_cameras(detectors, monkeypatch):
+    lpr_utils.check_detectors()
+    assert list(lpr_utils._detectors) == ['contour']
+    # A camera with the cascade detector fails on startup while LPR_PLATE_CASCADE is not set
+    monkeypatch.setattr(lpr_utils, 'CAMERAS', {'gate1': {'detector': 'cascade'}})
+    with pytest.raises(ValueError):
+        lpr_utils.check_detectors()
+
+
+class FakeClassifier:
+    def __init__(self, boxes, neighbors):
+        self.boxes = boxes
+        self.neighbors = neighbors
+        self.kwargs = None
+
+    def detectMultiScale2(self, gray, **kwargs):
+        self.gray = gray
+        self.kwargs = kwargs
+        return (np.array(self.boxes), np.array(self.neighbors))
+
+
+def cascade(boxes, neighbors, max_side=100):
+    detector = lpr_utils.CascadeDetector.__new__(lpr_utils.CascadeDetector)
+    detector.classifier = FakeClassifier(boxes, neighbors)
+    detector.max_side = max_side
+    detector.min_neighbors = 3
+    return detector
+
+
+def test_cascade_boxes_become_padded_candidates():
+    # Boxes of the 100x50 detection image, the working image is twice as big
+    detector = cascade([[10, 10, 20, 10], [60, 30, 30, 10]], [2, 8])
+    image = np.zeros((100, 200, 3), dtype=np.uint8)
+    candidates = detector.detect(image)
+    assert detector.classifier.gray.shape == (50, 100)
+    assert [score for contour, score in candidates] == [1.0, 0.25]
+    # Back in working image coordinates, padded by 5% of the width and 10% of the height, clipped to the image
+    assert candidates[0][0].reshape(-1, 2).tolist() == [[117, 58], [183, 58], [183, 82], [117, 82]]
+    assert candidates[1][0].reshape(-1, 2).tolist() == [[18, 18], [62, 18], [62, 42], [18, 42]]
+
+
+def test_cascade_mask_and_plate_width():
+    detector = cascade([[10, 10, 20, 10], [60, 30, 30, 10]], [2, 8])
+    mask = np.zeros((100, 200), dtype=np.uint8)
+    mask[:, :100] = 255
+    candidates = detector.detect(np.zeros((100, 200, 3), dtype=np.uint8), mask = mask, width_range = (40, 120))
+    # The box centered outside the ROI is dropped, scores stay relative to all detections
+    assert [score for contour, score in candidates] == [0.25]
+    # Plate width limits in detection image pixels
+    assert detector.classifier.kwargs['minSize'][0] == 20 and detector.classifier.kwargs['maxSize'][0] == 61
+
+
+class OnceDetector:
+    name = 'once'
+    per_strategy = False
+
+    def detect(self, image, blurring_method, binarization_method, mask=None, width_range=None, timings=None):
+        self.calls = getattr(self, 'calls', 0) + 1
+        return []
+
+
+def test_camera_detector_runs_once_per_image(detectors, monkeypatch):
+    monkeypatch.setattr(lpr_utils, 'DETECTORS', dict(lpr_utils.DETECTORS, once=OnceDetector))
+    monkeypatch.setattr(lpr_utils, 'CAMERAS', {'gate1': {'detector': 'once'}})
+    strategies = lpr_utils.parse_strategies('median_blur:adaptive_threshold;gaussian_blur:canny')
+    timings = {}
+    text, crops, winner = lpr_utils.recognize_cascade('picture.jpg', strategies, image = np.zeros((40, 80, 3), np.uint8),
+                                                      save_crops = False, timings = timings, **lpr_utils.camera_options('gate1'))
+    assert (text, crops, winner) == ('None', [], None)
+    assert lpr_utils.get_detector('once').calls == 1 and timings['strategies'] == 1
+    # Without the camera the contour detector runs every strategy
+    timings = {}
+    lpr_utils.recognize_cascade('picture.jpg', strategies, image = np.zeros((40, 80, 3), np.uint8), save_crops = False, timings = timings)
+    assert timings['strategies'] == 2
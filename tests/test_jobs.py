@@ -0,0 +1,89 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+
+from components import jobs
+from components.config import JOB_LEASE_TIMEOUT, JOB_MAX_ATTEMPTS
+from components.lpr_eng import PictureWrapper, STATUS_PENDING, STATUS_RUNNING, STATUS_FAILED
+
+
+def add_job(db, name, **columns):
+    job = PictureWrapper(name = name, picture_path = 'static/pictures_photo/{}.jpg'.format(name), recognized_txt = '',
+                         small_pictures = str([]), status = STATUS_PENDING, **columns)
+    db.session.add(job)
+    db.session.commit()
+    return job.id
+
+
+def expire_lease(db, job_id):
+    PictureWrapper.query.filter(PictureWrapper.id == job_id).update(
+        {'claimed_at': datetime.utcnow() - timedelta(seconds = JOB_LEASE_TIMEOUT + 1)}, synchronize_session=False)
+    db.session.commit()
+
+
+def test_claim_oldest_pending(database):
+    first = add_job(database, 'first', camera = 'gate1')
+    second = add_job(database, 'second')
+    runner = jobs.JobRunner(1)
+    assert runner._claim_next() == (first, 'static/pictures_photo/first.jpg', 'gate1')
+    assert runner._claim_next()[0] == second
+    assert runner._claim_next() is None
+    job = database.session.get(PictureWrapper, first)
+    assert job.status == STATUS_RUNNING and job.attempts == 1 and job.claimed_at is not None
+
+
+def test_claimed_job_skipped_by_other_runners(database):
+    job_id = add_job(database, 'job')
+    claims = [jobs.JobRunner(1)._claim_next() for i in range(3)]
+    assert [claim[0] for claim in claims if claim is not None] == [job_id]
+
+
+def test_expired_lease_claimed_again(database):
+    job_id = add_job(database, 'job')
+    runner = jobs.JobRunner(1)
+    assert runner._claim_next()[0] == job_id
+    # A running job within its lease belongs to the runner that claimed it
+    assert runner._claim_next() is None
+    expire_lease(database, job_id)
+    assert runner._claim_next()[0] == job_id
+    database.session.expire_all()
+    assert database.session.get(PictureWrapper, job_id).attempts == 2
+
+
+def test_expired_lease_after_last_attempt_fails(database):
+    job_id = add_job(database, 'job', attempts = JOB_MAX_ATTEMPTS - 1)
+    runner = jobs.JobRunner(1)
+    assert runner._claim_next()[0] == job_id
+    expire_lease(database, job_id)
+    assert runner._claim_next() is None
+    database.session.expire_all()
+    job = database.session.get(PictureWrapper, job_id)
+    assert job.status == STATUS_FAILED and job.error == 'lease expired'
+
+
+def test_failed_job_retried_until_max_attempts(database):
+    job_id = add_job(database, 'job')
+    runner = jobs.JobRunner(1)
+    for attempt in range(1, JOB_MAX_ATTEMPTS + 1):
+        assert runner._claim_next()[0] == job_id
+        runner._fail(job_id, RuntimeError('attempt {}'.format(attempt)))
+        database.session.commit()
+    job = database.session.get(PictureWrapper, job_id)
+    assert job.status == STATUS_FAILED and job.attempts == JOB_MAX_ATTEMPTS and job.error == 'attempt {}'.format(JOB_MAX_ATTEMPTS)
+    assert runner._claim_next() is None
+
+
+def test_payload_limit(monkeypatch):
+    monkeypatch.setattr(jobs, 'JOB_MAX_PAYLOAD_BYTES', 10)
+    runner = jobs.JobRunner(1)
+    assert runner.add_payload(1, memoryview(b'123456'))
+    assert not runner.add_payload(2, b'123456')
+    assert runner._take_payload(1) == b'123456'
+    assert runner._take_payload(2) is None
+    assert runner.add_payload(2, b'123456')
+
+
+def test_claim_uses_status_index(database):
+    claimable = "status = 'pending' OR (status = 'running' AND claimed_at < '2024-01-01') ORDER BY id LIMIT 1"
+    plan = database.session.execute(text("EXPLAIN QUERY PLAN SELECT id FROM picture_wrapper WHERE " + claimable)).fetchall()
+    assert any('ix_picture_wrapper_status_id' in row[-1] for row in plan)
@@ -0,0 +1,103 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from components import utils
+from components.lpr_eng import PictureWrapper, list_pictures, parse_cursor, search_pictures
+
+
+def add_picture(db, name, created_at=None, **columns):
+    picture = PictureWrapper(name = name, picture_path = 'static/pictures_photo/{}.jpg'.format(name), recognized_txt = columns.pop('recognized_txt', 'None'),
+                             small_pictures = str([]), created_at = created_at or datetime.utcnow(), **columns)
+    db.session.add(picture)
+    db.session.commit()
+    return picture
+
+
+def test_list_pictures_pages(database):
+    created_at = datetime(2024, 1, 1)
+    # Pictures of the same second share created_at, the id breaks the tie
+    ids = [add_picture(database, 'p{}'.format(i), created_at + timedelta(seconds = i // 3)).id for i in range(7)]
+    expected = sorted(ids, key=lambda id: ((id - ids[0]) // 3, id), reverse=True)
+    seen = []
+    after = None
+    while True:
+        pictures, after = list_pictures(2, after)
+        seen.extend(picture.id for picture in pictures)
+        if after is None:
+            break
+    assert seen == expected
+
+
+def test_list_pictures_cursor_stable_under_inserts(database):
+    created_at = datetime(2024, 1, 1)
+    for i in range(4):
+        add_picture(database, 'p{}'.format(i), created_at)
+    first, after = list_pictures(2)
+    # Uploads arriving between the pages are newer, they do not shift the next page
+    add_picture(database, 'new', created_at + timedelta(seconds = 1))
+    add_picture(database, 'same_time', created_at)
+    second, last = list_pictures(2, after)
+    assert last is None
+    assert [picture.id for picture in second] == sorted([picture.id for picture in PictureWrapper.query.filter(PictureWrapper.name.in_(['p0', 'p1']))], reverse=True)
+    assert set(picture.id for picture in first).isdisjoint(picture.id for picture in second)
+
+
+def test_parse_cursor_malformed():
+    with pytest.raises(ValueError):
+        parse_cursor('2024-01-01_1')
+    with pytest.raises(ValueError):
+        parse_cursor('2024-01-01T00:00:00.000000_x')
+
+
+def test_plate_key():
+    assert utils.plate_key('I2O-B5') == utils.plate_key('120 85') == '12085'
+    assert utils.plate_key('a123bc') == utils.plate_key('A123BC')
+    assert utils.plate_key('None') is None
+    assert utils.plate_key('--') is None
+
+
+def test_plate_key_follows_recognized_txt(database):
+    picture = add_picture(database, 'car', recognized_txt = 'AB-1O2')
+    assert picture.plate_key == utils.plate_key('AB-1O2')
+    picture.recognized_txt = 'None'
+    database.session.commit()
+    assert picture.plate_key is None
+
+
+def search_ids(plate, **kwargs):
+    return [picture.id for picture in search_pictures(plate, **kwargs)[0]]
+
+
+def test_search_exact_prefix_fuzzy(database):
+    exact = add_picture(database, 'exact', recognized_txt = 'AB102').id
+    longer = add_picture(database, 'longer', recognized_txt = 'AB1023').id
+    confused = add_picture(database, 'confused', recognized_txt = 'A8IO2').id
+    add_picture(database, 'other', recognized_txt = 'XY999')
+    add_picture(database, 'none')
+    assert search_ids('ab-102') == [exact]
+    assert search_ids('AB10', prefix = True) == [longer, exact]
+    assert search_ids('AB102', fuzzy = True) == [confused, exact]
+    assert search_ids('AB10', prefix = True, fuzzy = True) == [confused, longer, exact]
+    assert search_ids('ZZ') == []
+    with pytest.raises(ValueError):
+        search_pictures('--')
+
+
+def test_search_pages(database):
+    ids = [add_picture(database, 'p{}'.format(i), recognized_txt = 'AB102').id for i in range(5)]
+    pictures, after = search_pictures('AB102', limit = 2)
+    seen = [picture.id for picture in pictures]
+    while after is not None:
+        pictures, after = search_pictures('AB102', limit = 2, after = after)
+        seen.extend(picture.id for picture in pictures)
+    assert seen == sorted(ids, reverse = True)
+
+
+def test_search_route(client, database):
+    picture = add_picture(database, 'car', recognized_txt = 'AB102')
+    response = client.get('/search?plate=A8IO2&fuzzy=1')
+    assert response.status_code == 200
+    assert [row['id'] for row in response.get_json()['pictures']] == [picture.id]
+    assert client.get('/search?plate=AB&prefix=1').status_code == 400
+    assert client.get('/search?plate=').status_code == 400
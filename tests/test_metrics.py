@@ -0,0 +1,71 @@
+import json
+import os
+from concurrent.futures import Future
+
+import pytest
+
+from components import jobs
+from components import metrics
+from components.lpr_eng import PictureWrapper, STATUS_PENDING, STATUS_DONE
+
+
+@pytest.fixture
+def metrics_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, 'METRICS_DIR', str(tmp_path))
+    return tmp_path
+
+
+def write_process(metrics_dir, pid, values):
+    with open(os.path.join(str(metrics_dir), '{}.json'.format(pid)), 'w') as f:
+        json.dump(values, f)
+
+
+def test_render_adds_up_the_processes(metrics_dir):
+    counter = metrics.CACHE_HITS.value()
+    images = metrics.IMAGES.value(status = 'done')
+    bucket_counts = list(metrics.OCR_CALLS._values.get((), [0] * (len(metrics.OCR_CALLS.buckets) + 2)))
+    write_process(metrics_dir, 1, {
+        'lpr_cache_hits_total': [[[], 3]],
+        'lpr_images_total': [[['done'], 2]],
+        'lpr_ocr_calls_per_image': [[[], [0, 1, 1, 1, 1, 1, 2.0, 1]]],
+        'lpr_admission_in_flight': [[[], 4]],
+        'unknown_metric': [[[], 1]]
+    })
+    write_process(metrics_dir, 2, {'lpr_cache_hits_total': [[[], 5]]})
+    collected = metrics.collect()
+    assert collected['lpr_cache_hits_total'][()] == counter + 8
+    assert collected['lpr_images_total'][('done',)] == images + 2
+    assert collected['lpr_ocr_calls_per_image'][()] == [a + b for a, b in zip(bucket_counts, [0, 1, 1, 1, 1, 1, 2.0, 1])]
+    assert collected['lpr_admission_in_flight'][()] == metrics.ADMISSION_IN_FLIGHT.value() + 4
+    text = metrics.render()
+    assert 'lpr_cache_hits_total {}'.format(counter + 8) in text
+    assert 'unknown_metric' not in text
+
+
+def test_flush_and_dead_process(metrics_dir):
+    metrics.ADMISSION_IN_FLIGHT.set(3)
+    metrics.flush()
+    path = os.path.join(str(metrics_dir), '{}.json'.format(os.getpid()))
+    with open(path) as f:
+        assert json.load(f)['lpr_admission_in_flight'] == [[[], 3]]
+    write_process(metrics_dir, 1, {'lpr_admission_in_flight': [[[], 4]], 'lpr_cache_hits_total': [[[], 5]]})
+    metrics.mark_process_dead(1)
+    with open(os.path.join(str(metrics_dir), '1.json')) as f:
+        assert json.load(f) == {'lpr_admission_in_flight': [[[], 0]], 'lpr_cache_hits_total': [[[], 5]]}
+    metrics.ADMISSION_IN_FLIGHT.set(0)
+
+
+def test_job_timings_include_the_commit(database):
+    job = PictureWrapper(name = 'job', picture_path = 'static/pictures_photo/job.jpg', recognized_txt = '', small_pictures = str([]), status = STATUS_PENDING)
+    database.session.add(job)
+    database.session.commit()
+    runner = jobs.JobRunner(1)
+    future = Future()
+    future.set_result(('A123BC', [], {'ocr': 0.01, 'candidates': 1}, 'median_blur+adaptive_threshold'))
+    runner._in_flight[future] = job.id
+    runner._collect()
+    database.session.expire_all()
+    job = database.session.get(PictureWrapper, job.id)
+    timings = json.loads(job.timings)
+    assert job.status == STATUS_DONE and job.recognized_txt == 'A123BC'
+    assert timings['ocr'] == 10.0 and timings['candidates'] == 1 and timings['db_commit'] >= 0
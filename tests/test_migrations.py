@@ -0,0 +1,33 @@
+from sqlalchemy import inspect
+
+from components import utils
+from components.lpr_eng import PictureWrapper, Crop, SchemaVersion, MIGRATIONS, STATUS_DONE, upgrade_db
+
+
+def test_upgrade_db_baseline(baseline_database):
+    db = baseline_database
+    upgrade_db()
+    columns = set(column['name'] for column in inspect(db.engine).get_columns('picture_wrapper'))
+    assert {'status', 'attempts', 'content_hash', 'timings', 'strategy', 'plate_key', 'camera'} <= columns
+    indexes = set(index['name'] for index in inspect(db.engine).get_indexes('picture_wrapper'))
+    assert {'ix_picture_wrapper_created_at_id', 'ix_picture_wrapper_recognized_txt', 'ix_picture_wrapper_plate_key', 'ix_picture_wrapper_picture_path'} <= indexes
+    assert 'ix_crop_path' in set(index['name'] for index in inspect(db.engine).get_indexes('crop'))
+    assert [version for version, in db.session.query(SchemaVersion.version).order_by(SchemaVersion.version)] == [version for version, name, migration in MIGRATIONS]
+
+    pictures = PictureWrapper.query.order_by(PictureWrapper.id).all()
+    assert len(pictures) == 5
+    assert all(picture.status == STATUS_DONE and picture.attempts == 0 for picture in pictures)
+    # Windows separators of the first release are normalized
+    assert pictures[2].picture_path == 'static/pictures_photo/rear_view_lp.jpg'
+    assert [crop.path for crop in pictures[2].crops] == [
+        'static/pictures_photo/rear_view_lp_0.jpg', 'static/pictures_photo/rear_view_lp_0_1.jpg', 'static/pictures_photo/rear_view_lp_0_1_2.jpg']
+    assert pictures[4].crops == []
+    assert [picture.plate_key for picture in pictures] == [utils.plate_key(picture.recognized_txt) for picture in pictures]
+
+
+def test_upgrade_db_twice(baseline_database):
+    upgrade_db()
+    crops = Crop.query.count()
+    upgrade_db()
+    assert Crop.query.count() == crops
+    assert SchemaVersion.query.count() == len(MIGRATIONS)
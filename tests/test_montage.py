@@ -0,0 +1,57 @@
+import numpy as np
+
+from components import lpr_utils
+
+
+def crops():
+    gradient = np.tile(np.linspace(0, 255, 90, dtype=np.uint8), (30, 1))
+    return [np.dstack([gradient] * 3), np.full((60, 60), 200, dtype=np.uint8), gradient[:, :45]]
+
+
+def test_montage_layout():
+    canvas, rows = lpr_utils.montage(crops(), tile_height = 40)
+    gap = 20
+    assert rows == [(20, 60), (80, 120), (140, 180)]
+    # The widest tile keeps its aspect ratio (90x30 -> 120x40), surrounded by the gaps
+    assert canvas.shape == (gap + 3 * (40 + gap), 120 + 2 * gap)
+    assert set(np.unique(canvas)) <= {0, 255}
+    for top, bottom in [(0, 20), (60, 80), (120, 140), (180, 200)]:
+        assert (canvas[top:bottom] == 255).all()
+
+
+def test_montage_config():
+    assert lpr_utils.montage_config('-l eng --oem 1 --psm 7', 6) == '-l eng --oem 1 --psm 6'
+    assert lpr_utils.montage_config('', 11) == '--psm 11'
+
+
+def test_montage_ocr_maps_words_to_tiles(monkeypatch):
+    images = crops()
+    canvas, rows = lpr_utils.montage(images)
+    configs = []
+
+    def image_to_data(image, config_str):
+        configs.append(config_str)
+        assert image.size == (canvas.shape[1], canvas.shape[0])
+        (top0, bottom0), (top1, bottom1), (top2, bottom2) = rows
+        return [
+            # Words of a tile are joined left to right whatever order the engine returns them in
+            ('123', 80.0, 60, top0 + 2, 30, bottom0 - top0 - 4),
+            ('A', 90.0, 5, top0 + 1, 20, bottom0 - top0 - 2),
+            # A box reaching into the gap still belongs to the tile of its center
+            ('X-9', 60.0, 5, top2 - 10, 20, bottom2 - top2),
+            # Noise in a gap is dropped
+            ('.', 10.0, 5, 0, 5, 4),
+        ]
+
+    monkeypatch.setattr(lpr_utils.ocr_engine, 'image_to_data', image_to_data)
+    results = lpr_utils.montage_ocr(images, '--psm 7')
+    assert configs == [lpr_utils.montage_config('--psm 7')]
+    assert results == [('A123', 85.0), ('', -1.0), ('X9', 60.0)]
+
+
+def test_montage_ocr_engine_error(monkeypatch):
+    def image_to_data(image, config_str):
+        raise RuntimeError('engine')
+
+    monkeypatch.setattr(lpr_utils.ocr_engine, 'image_to_data', image_to_data)
+    assert lpr_utils.montage_ocr(crops(), '') == [('', -1.0)] * 3
@@ -0,0 +1,105 @@
+import os
+import time
+
+import pytest
+from sqlalchemy import text
+
+from components import storage
+from components import thumbs
+from components.lpr_eng import PictureWrapper, Crop
+
+
+@pytest.fixture
+def folders(tmp_path, monkeypatch):
+    pictures = str(tmp_path / 'pictures_photo')
+    thumb_folder = str(tmp_path / 'thumbs')
+    os.makedirs(pictures)
+    os.makedirs(thumb_folder)
+    monkeypatch.setattr(storage, 'PICTURES_FOLDER', pictures)
+    monkeypatch.setattr(storage, 'THUMB_FOLDER', thumb_folder)
+    monkeypatch.setattr(thumbs, 'THUMB_FOLDER', thumb_folder)
+    return pictures
+
+
+def write(path, size=10, age=3600):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(b'0' * size)
+    mtime = time.time() - age
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+def add_picture(db, picture_path, crops=()):
+    picture = PictureWrapper(name = os.path.basename(picture_path), picture_path = picture_path, recognized_txt = 'None', small_pictures = str([]))
+    picture.set_small_pictures(list(crops))
+    db.session.add(picture)
+    db.session.commit()
+    return picture.id
+
+
+def test_delete_pictures_removes_unshared_files(database, folders):
+    shared = write(os.path.join(folders, 'ab', 'cd', 'abcd.jpg'), 100)
+    crop = write(os.path.join(folders, 'ab', 'cd', 'abcd_0.jpg'), 20)
+    other_crop = write(os.path.join(folders, 'ab', 'cd', 'abcd_1.jpg'), 30)
+    thumb = write(thumbs.thumb_path(shared, 's'), 5)
+    deleted = add_picture(database, shared, [crop])
+    # A repeated upload of the same picture shares its file
+    kept = add_picture(database, shared, [other_crop])
+
+    assert storage.delete_pictures([deleted]) == {'rows': 1, 'files': 1, 'bytes': 20}
+    assert not os.path.exists(crop)
+    assert os.path.exists(shared) and os.path.exists(thumb) and os.path.exists(other_crop)
+    assert database.session.get(PictureWrapper, deleted) is None
+    assert Crop.query.filter(Crop.picture_id == deleted).count() == 0
+
+    assert storage.delete_pictures([kept]) == {'rows': 1, 'files': 3, 'bytes': 135}
+    assert not os.path.exists(shared) and not os.path.exists(thumb) and not os.path.exists(other_crop)
+
+
+def test_delete_pictures_unknown_ids(database, folders):
+    assert storage.delete_pictures([12345]) == {'rows': 0, 'files': 0, 'bytes': 0}
+
+
+def test_reap_orphans(database, folders):
+    referenced = write(os.path.join(folders, 'ab', 'cd', 'abcd.jpg'))
+    orphan = write(os.path.join(folders, 'ef', '01', 'ef01.jpg'))
+    young_orphan = write(os.path.join(folders, 'ab', 'cd', 'abce.jpg'), age=0)
+    # Sample pictures and uploads of older versions lie directly in PICTURES_FOLDER and have no row
+    sample = write(os.path.join(folders, 'sample.jpg'))
+    not_image = write(os.path.join(folders, 'ab', 'cd', 'notes.txt'))
+    thumb = write(thumbs.thumb_path(referenced, 's'))
+    orphan_thumb = write(thumbs.thumb_path(orphan, 's'))
+    add_picture(database, referenced)
+    for directory in (os.path.dirname(orphan), os.path.dirname(os.path.dirname(orphan)), os.path.dirname(orphan_thumb)):
+        os.utime(directory, (time.time() - 3600, time.time() - 3600))
+
+    assert storage.reap_orphans(min_age = 60, dry_run = True) == {'files': 2, 'bytes': 20}
+    assert os.path.exists(orphan) and os.path.exists(orphan_thumb)
+
+    assert storage.reap_orphans(min_age = 60) == {'files': 2, 'bytes': 20}
+    assert not os.path.exists(orphan) and not os.path.exists(orphan_thumb)
+    assert not os.path.exists(os.path.join(folders, 'ef'))
+    for path in (referenced, young_orphan, sample, not_image, thumb):
+        assert os.path.exists(path)
+
+
+def test_delete_pictures_keeps_files_of_windows_rows(database, folders):
+    picture = write(os.path.join(folders, 'ab', 'cd', 'abcd.jpg'))
+    deleted = add_picture(database, picture)
+    # A row of the first release names the same file with backslashes
+    add_picture(database, picture.replace('/', '\\'))
+    assert storage.delete_pictures([deleted])['files'] == 0
+    assert os.path.exists(picture)
+
+
+def test_referenced_paths_of_candidates(database, folders):
+    add_picture(database, 'static/pictures_photo/a.jpg', ['static/pictures_photo/a_0.jpg'])
+    add_picture(database, 'static\\pictures_photo\\b.jpg')
+    candidates = ['static/pictures_photo/a_0.jpg', 'static/pictures_photo/b.jpg', 'static/pictures_photo/c.jpg']
+    assert storage.referenced_paths(candidates) == {storage.normalized('static/pictures_photo/a_0.jpg'), storage.normalized('static/pictures_photo/b.jpg')}
+    assert len(storage.referenced_paths()) == 3
+    # Index lookups, not a scan of every row
+    for table, column, index in (('picture_wrapper', 'picture_path', 'ix_picture_wrapper_picture_path'), ('crop', 'path', 'ix_crop_path')):
+        plan = database.session.execute(text("EXPLAIN QUERY PLAN SELECT {1} FROM {0} WHERE {1} IN ('x', 'y')".format(table, column))).fetchall()
+        assert any(index in row[-1] for row in plan)
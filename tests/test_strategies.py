@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+
+from components import lpr_utils
+from components.config import WORK_MAX_SIDE
+
+
+def test_parse_strategies():
+    strategies = lpr_utils.parse_strategies('median_blur:adaptive_threshold:1024:3; gaussian_blur:threshold_otsu;bilateral_filter:canny:640x480;')
+    assert strategies == [
+        lpr_utils.Strategy('median_blur', 'adaptive_threshold', None, 1024, 3.0),
+        lpr_utils.Strategy('gaussian_blur', 'threshold_otsu', None, WORK_MAX_SIDE, None),
+        lpr_utils.Strategy('bilateral_filter', 'canny', (640, 480), WORK_MAX_SIDE, None),
+    ]
+    assert lpr_utils.strategy_name(strategies[0]) == 'median_blur+adaptive_threshold@1024'
+    assert lpr_utils.strategy_name(strategies[2]) == 'bilateral_filter+canny@640x480'
+
+
+@pytest.mark.parametrize('spec', ['median_blur', 'median_blur:nothing', 'os:adaptive_threshold', 'median_blur:canny:big', 'a:b:c:d:e'])
+def test_parse_strategies_invalid(spec):
+    with pytest.raises(ValueError):
+        lpr_utils.parse_strategies(spec)
+
+
+@pytest.fixture
+def attempts(monkeypatch, tmp_path):
+    """
+    Replaces license_plate_recognition: the canny strategy reads a plate, the others a short text,
+    every strategy writes a crop of its own.
+    """
+    calls = []
+
+    def license_plate_recognition(img_path, new_size, blurring_method, binarization_method, *args):
+        timings = args[4]
+        timings['ocr'] = 0.5
+        crop = str(tmp_path / '{}.jpg'.format(binarization_method.__name__))
+        open(crop, 'wb').close()
+        calls.append(binarization_method.__name__)
+        return ('A123BC' if binarization_method.__name__ == 'canny' else 'A1', [crop])
+
+    monkeypatch.setattr(lpr_utils, 'license_plate_recognition', license_plate_recognition)
+    return calls
+
+
+def test_recognize_cascade_escalates(attempts, tmp_path):
+    strategies = lpr_utils.parse_strategies('median_blur:adaptive_threshold;gaussian_blur:canny;bilateral_filter:threshold_otsu')
+    timings = {}
+    text, crops, winner = lpr_utils.recognize_cascade('picture.jpg', strategies, image = np.zeros((10, 10, 3), np.uint8), min_chars = 5, timings = timings)
+    assert attempts == ['adaptive_threshold', 'canny']
+    assert (text, winner) == ('A123BC', 'gaussian_blur+canny@{}'.format(WORK_MAX_SIDE))
+    assert timings['strategies'] == 2 and timings['ocr'] == 1.0
+    # The crop of the first strategy is removed, the result keeps its own
+    assert crops == [str(tmp_path / 'canny.jpg')]
+    assert not (tmp_path / 'adaptive_threshold.jpg').exists()
+
+
+def test_recognize_cascade_without_winner(attempts):
+    strategies = lpr_utils.parse_strategies('median_blur:adaptive_threshold;bilateral_filter:threshold_otsu')
+    timings = {}
+    text, crops, winner = lpr_utils.recognize_cascade('picture.jpg', strategies, image = np.zeros((10, 10, 3), np.uint8), min_chars = 5, timings = timings)
+    assert attempts == ['adaptive_threshold', 'threshold_otsu']
+    assert (text, winner) == ('A1', None) and timings['strategies'] == 2
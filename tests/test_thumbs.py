@@ -0,0 +1,62 @@
+import os
+
+import cv2
+import numpy as np
+import pytest
+
+from components import thumbs
+from components.config import THUMB_SIZES, THUMB_MAX_AGE
+from components.lpr_eng import PictureWrapper
+
+
+@pytest.fixture
+def picture(database, tmp_path, monkeypatch):
+    monkeypatch.setattr(thumbs, 'THUMB_FOLDER', str(tmp_path / 'thumbs'))
+    path = str(tmp_path / 'car.jpg')
+    cv2.imwrite(path, np.full((900, 1200, 3), 128, dtype=np.uint8))
+    crop = str(tmp_path / 'car_0.jpg')
+    cv2.imwrite(crop, np.full((40, 120, 3), 255, dtype=np.uint8))
+    row = PictureWrapper(name = 'car', picture_path = path, recognized_txt = 'A123BC', small_pictures = str([]))
+    row.set_small_pictures([crop])
+    database.session.add(row)
+    database.session.commit()
+    return row
+
+
+def test_make_thumbs_sizes(tmp_path, monkeypatch):
+    monkeypatch.setattr(thumbs, 'THUMB_FOLDER', str(tmp_path / 'thumbs'))
+    image = np.zeros((900, 1200, 3), dtype=np.uint8)
+    paths = thumbs.make_thumbs('static/car.jpg', image)
+    assert len(paths) == len(THUMB_SIZES)
+    for size, max_side in THUMB_SIZES.items():
+        thumb = cv2.imread(thumbs.thumb_path('static/car.jpg', size))
+        assert max(thumb.shape[:2]) == max_side
+    # Windows separators name the same thumbnail
+    assert thumbs.thumb_path('static\\car.jpg', 's') == thumbs.thumb_path('static/car.jpg', 's')
+    # Smaller images are not enlarged
+    assert thumbs.thumbnail(np.zeros((10, 20, 3), dtype=np.uint8), 160).shape == (10, 20, 3)
+
+
+def test_thumb_etag_and_not_modified(client, picture):
+    response = client.get('/thumb/{}/s'.format(picture.id))
+    assert response.status_code == 200
+    assert response.mimetype == thumbs.MIMETYPES[thumbs.THUMB_FORMAT]
+    assert 'max-age={}'.format(THUMB_MAX_AGE) in response.headers['Cache-Control']
+    etag = response.headers['ETag']
+    assert etag and response.headers.get('Last-Modified')
+    assert os.path.exists(thumbs.thumb_path(picture.picture_path, 's'))
+    response.close()
+    again = client.get('/thumb/{}/s'.format(picture.id), headers = {'If-None-Match': etag})
+    assert again.status_code == 304 and again.get_data() == b''
+    changed = client.get('/thumb/{}/s'.format(picture.id), headers = {'If-None-Match': '"other"'})
+    assert changed.status_code == 200
+    changed.close()
+
+
+def test_crop_thumb_and_missing(client, picture):
+    response = client.get('/thumb/{}/s/0'.format(picture.id))
+    assert response.status_code == 200
+    response.close()
+    assert client.get('/thumb/{}/s/1'.format(picture.id)).status_code == 404
+    assert client.get('/thumb/{}/xl'.format(picture.id)).status_code == 404
+    assert client.get('/thumb/12345/s').status_code == 404
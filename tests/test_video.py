@@ -0,0 +1,143 @@
+import io
+import os
+from concurrent.futures import Future
+
+import cv2
+import numpy as np
+import pytest
+
+from components import jobs
+from components import thumbs
+from components import video
+from components.config import VIDEO_DEDUP_DISTANCE, VIDEO_EVENT_GAP
+from components.lpr_eng import PictureWrapper, VideoJob, STATUS_DONE, STATUS_FAILED, STATUS_PENDING
+
+
+def scene(seed: int) -> np.ndarray:
+    return cv2.resize(np.random.RandomState(seed).randint(0, 255, (12, 16, 3), dtype=np.uint8), (320, 240), interpolation=cv2.INTER_NEAREST)
+
+
+def test_frame_hash_near_duplicates():
+    frame = scene(1)
+    noisy = np.clip(frame.astype(int) + np.random.RandomState(2).randint(-3, 4, frame.shape), 0, 255).astype(np.uint8)
+    assert video.hamming(video.frame_hash(frame), video.frame_hash(frame)) == 0
+    assert video.hamming(video.frame_hash(frame), video.frame_hash(noisy)) <= VIDEO_DEDUP_DISTANCE
+    assert video.hamming(video.frame_hash(frame), video.frame_hash(scene(3))) > VIDEO_DEDUP_DISTANCE
+
+
+def test_event_merges_close_plates(tmp_path, monkeypatch):
+    monkeypatch.setattr(thumbs, 'THUMB_FOLDER', str(tmp_path / 'thumbs'))
+    event = video.PlateEvent('A123BC', 1.0, 'gate1')
+    assert event.matches('A123BO', 1.5)
+    assert not event.matches('X999YZ', 1.5)
+    assert not event.matches('A123BC', 1.0 + VIDEO_EVENT_GAP + 0.1)
+    assert event.add('A123BC', 1.0, 2, scene(1), ['a.jpg'], 'first', {'ocr': 0.1}) == []
+    assert event.add('A123BO', 1.5, 3, scene(2), ['b.jpg'], 'first', {'ocr': 0.2}) == []
+    # The crops of a text already seen are not kept
+    assert event.add('A123BC', 2.0, 4, scene(3), ['c.jpg'], 'first', {'ocr': 0.1}) == ['c.jpg']
+    result, unused = event.close('car', str(tmp_path))
+    assert result['recognized_txt'] == 'A123BC' and result['small_pictures'] == ['a.jpg']
+    assert result['picture_path'] == '{}/car_2.jpg'.format(tmp_path) and os.path.exists(result['picture_path'])
+    assert result['frames'] == 3 and result['votes'] == {'A123BC': 2, 'A123BO': 1}
+    assert unused == ['b.jpg']
+
+
+def write_video(path: str, scenes: list, fps: int = 2):
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), fps, (320, 240))
+    for seed in scenes:
+        writer.write(scene(seed))
+    writer.release()
+
+
+@pytest.fixture
+def fake_recognition(monkeypatch, tmp_path):
+    """
+    Recognizes the text of the scene a frame was made from, see scene().
+    """
+    monkeypatch.setattr(thumbs, 'THUMB_FOLDER', str(tmp_path / 'thumbs'))
+    texts = {}
+    calls = []
+
+    def recognize_cascade(img_path, strategies, config_str, timings=None, image=None, **options):
+        calls.append(img_path)
+        h = video.frame_hash(image)
+        text = next((text for seed, text in texts.items() if video.hamming(h, video.frame_hash(scene(seed))) <= VIDEO_DEDUP_DISTANCE), 'None')
+        timings['ocr'] = 0.01
+        return (text, [], 'first' if text != 'None' else None)
+
+    monkeypatch.setattr(video.lpr_utils, 'recognize_cascade', recognize_cascade)
+    return (texts, calls)
+
+
+def test_ingest_skips_duplicates_and_merges_events(tmp_path, fake_recognition):
+    texts, calls = fake_recognition
+    texts.update({1: 'A123BC', 2: 'A123BO', 3: 'X999YZ'})
+    path = str(tmp_path / 'gate.avi')
+    # 1 and 2 read the same plate differently, 3 is another car, 4 has no plate
+    write_video(path, [1, 1, 1, 2, 4, 3, 3])
+    folder = str(tmp_path / 'events')
+    stats = {}
+    frames = []
+    results = list(video.ingest(path, 'gate', folder, sample_fps = 0, stats = stats, frames = frames))
+    assert stats['frames'] == 7 and stats['skipped'] == 3 and stats['recognized'] == 4 and stats['events'] == 2
+    assert len(calls) == len(frames) == 4
+    assert [result['recognized_txt'] for result in results] == ['A123BC', 'X999YZ']
+    assert results[0]['frames'] == 2 and results[0]['votes'] == {'A123BC': 1, 'A123BO': 1}
+    assert all(os.path.dirname(result['picture_path']) == folder for result in results)
+
+
+def test_event_folders_unique(tmp_path):
+    assert video.event_folder(str(tmp_path)) != video.event_folder(str(tmp_path))
+
+
+def test_video_job_saves_events(database, tmp_path, fake_recognition):
+    texts, calls = fake_recognition
+    texts.update({1: 'A123BC'})
+    folder = video.event_folder(str(tmp_path))
+    os.makedirs(folder)
+    path = os.path.join(folder, 'gate.avi')
+    write_video(path, [1, 1, 4])
+    job_id = jobs.enqueue_video('gate', folder, path).id
+    runner = jobs.JobRunner(1)
+    assert runner._claim_next_video() == (job_id, 'gate', folder, path, None)
+    assert runner._claim_next_video() is None
+    future = Future()
+    future.set_result(video.ingest_video(path, 'gate', folder))
+    runner._finish_video(job_id, future)
+    job = database.session.get(VideoJob, job_id)
+    assert job.status == STATUS_DONE and job.to_dict()['stats']['events'] == 1
+    assert [(event.recognized_txt, event.video_id) for event in job.events] == [('A123BC', job_id)]
+    assert job.events[0].timings is not None
+    # Only the event frames stay
+    assert not os.path.exists(path) and os.path.exists(job.events[0].picture_path)
+
+
+def test_failed_video_job_retried(database, tmp_path):
+    path = str(tmp_path / 'gate.avi')
+    open(path, 'wb').close()
+    job_id = jobs.enqueue_video('gate', str(tmp_path), path).id
+    runner = jobs.JobRunner(1)
+    for attempt in range(3):
+        assert runner._claim_next_video()[0] == job_id
+        future = Future()
+        future.set_exception(ValueError("Can not open video source"))
+        runner._finish_video(job_id, future)
+    job = database.session.get(VideoJob, job_id)
+    assert job.status == STATUS_FAILED and job.attempts == 3
+    assert not os.path.exists(path)
+    assert PictureWrapper.query.count() == 0
+
+
+def test_video_route_queues_job(client, database, tmp_path, monkeypatch):
+    monkeypatch.setattr(video, 'event_folder', lambda: str(tmp_path / 'event'))
+    path = str(tmp_path / 'upload.avi')
+    write_video(path, [1, 2])
+    with open(path, 'rb') as f:
+        response = client.post('/video', data = {'file': (f, 'gate.avi')})
+    assert response.status_code == 202
+    job = response.get_json()
+    assert job['status'] == STATUS_PENDING and job['name'] == 'gate'
+    assert os.path.exists(str(tmp_path / 'event' / 'gate.avi'))
+    status = client.get('/videos/{}'.format(job['id'])).get_json()
+    assert status['id'] == job['id'] and status['events'] == []
+    assert client.post('/video', data = {'file': (io.BytesIO(b'text'), 'gate.txt')}).status_code == 400